@@ -0,0 +1,95 @@
+'''Event driven (asyncio) top level loop for the smart UV controllers.
+
+Instead of running a cycle every second, the controller sleeps until one of the following happens:
+    - a socket registered in the wifiCommunicator selector has data,
+    - a PIR sensor reports motion (through PIR.setListener),
+    - the disinfection timer reaches its deadline,
+    - a trigger notification is due to be resent (SEQ feature, see retransmitQueue) or a connection retried,
+    - the housekeeping period runs out (reconnection attempts and trigger resends still need a regular tick).
+By default the controller uses asyncWifi.asyncWifiCommunicator, whose connections are transports of the same
+event loop, so messages from the base station are answered and wake the controller as soon as they arrive.
+With nativeWifi=False the selector of the multiconnClientClass2 communicator is watched instead.
+Every wake up runs one normal cycle of the controller (pre_cycle, state function, post_cycle), so the
+state functions and the DETECT -> IDLE start up are exactly the ones used by main().
+
+Usage:
+    controller = asyncController(mySmartUV)
+    controller.run()
+'''
+import asyncio
+import asyncWifi
+
+
+class asyncController:
+    def __init__(self, smartUV, housekeeping=1, nativeWifi=True):
+        self.smartUV = smartUV
+        self.housekeeping = housekeeping    # longest time (s) between two cycles
+        self.nativeWifi = nativeWifi        # use asyncWifi instead of the selector wifiCommunicator
+        self.loop = None
+        self.wake = None
+        self.cycles = 0                     # number of cycles run so far
+
+    def run(self):
+        asyncio.run(self.main())
+
+    def notify(self):
+        # Wake the controller up. Safe to call from the sensor threads.
+        self.loop.call_soon_threadsafe(self.wake.set)
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        uv = self.smartUV
+
+        uv.wifiTimeout = 0      # never block inside checkWifi, the event loop does the waiting
+        uv.asyncWifi = self.nativeWifi
+        uv.motionSensor.setListener(self.notify)
+
+        self.runCycle()         # DETECT -> IDLE, this also creates the wifiCommunicator
+        self.watchWifi()
+
+        while True:
+            timeout = self.housekeeping
+            # the deadlines are times of the timer's and the wifi's clock (a simClock), not of time.time()
+            for (deadline, clock) in [(uv.timer.deadline(), uv.timer.clock), (uv.wifi.deadline(), uv.wifi.clock)]:
+                if deadline is not None:
+                    timeout = max(0, min(timeout, deadline - clock.time()))
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            self.runCycle()
+
+    def runCycle(self):
+        # A transition (eg. INITIAL -> ACTIVE) only takes effect on the next cycle, so keep
+        # cycling until the state settles instead of waiting for the next event.
+        uv = self.smartUV
+        for i in range(0, 3):
+            before = (uv.state, uv.lampON)
+            uv.cycle()
+            self.cycles += 1
+            if (uv.state, uv.lampON) == before:
+                break
+
+    def watchWifi(self):
+        if isinstance(self.smartUV.wifi, asyncWifi.asyncWifiCommunicator):
+            self.smartUV.wifi.setListener(self.wake.set)    # called from the event loop, no need for notify()
+            return
+        try:
+            fd = self.smartUV.wifi.sel.fileno()
+        except AttributeError:
+            # Selector without a file descriptor (SelectSelector): rely on the housekeeping tick
+            print("Selector cannot be watched, polling wifi every", self.housekeeping, "s")
+            return
+        self.loop.add_reader(fd, self.wifiReady)
+
+    def wifiReady(self):
+        # The selector is ready when a socket has data, or has queued messages and can send them
+        # (write interest is only registered while there is something to send). Only received
+        # data needs a cycle, sending is done by checkWifi itself.
+        wifi = self.smartUV.wifi
+        readEvents = wifi.readEvents
+        wifi.checkWifi(0)
+        if wifi.readEvents != readEvents:
+            self.wake.set()
@@ -0,0 +1,145 @@
+'''Connection state of one light module connection to the base station, kept across its sockets.
+
+    CONNECTING   a non blocking connect() is in progress. The socket is watched for writability and the
+                 result is read with SO_ERROR (see wifiCommunicator.finishConnect).
+    ESTABLISHED  the TCP connection is up. The base station is expected to send ;CONNECTED within
+                 HANDSHAKE_TIMEOUT, after which the failure count is reset.
+    BACKOFF      the last attempt failed or the connection was lost. The next attempt is made at retryAt.
+
+The wait before attempt n is a random time between 0 and min(MAX_BACKOFF, BASE_BACKOFF * 2^n) ("full jitter"),
+so after a base station restart the modules of a room do not all reconnect at the same moment.
+
+setKeepalive() tunes TCP keepalive on a socket, so a base station that vanishes is noticed within seconds even
+when it does not speak the HEARTBEAT feature (see wireProtocol).
+'''
+import random
+import socket
+
+CONNECTING = "CONNECTING"
+ESTABLISHED = "ESTABLISHED"
+BACKOFF = "BACKOFF"
+
+BASE_BACKOFF = 0.5      # s
+MAX_BACKOFF = 8         # s
+CONNECT_TIMEOUT = 5     # s, longest time a connect() may take
+HANDSHAKE_TIMEOUT = 2   # s, longest time between the TCP connection and ;CONNECTED
+KEEPALIVE = (5, 1, 3)   # s of silence before the first keepalive probe, s between probes, probes lost before the connection is dropped
+
+
+def setKeepalive(sock, idle, interval, count):
+    # Turns TCP keepalive on with the given timing, the options the platform does not have are skipped
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for (option, value) in [("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", interval), ("TCP_KEEPCNT", count),
+                            ("TCP_USER_TIMEOUT", int((idle + interval * count) * 1000))]:  # also bounds unacknowledged sends
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+class connectionManager:
+    def __init__(self, rng=None):
+        self.state = BACKOFF
+        self.since = 0          # time the current state was entered
+        self.retryAt = 0        # time of the next attempt (BACKOFF)
+        self.failures = 0       # attempts failed in a row
+        self.handshaken = False # ;CONNECTED received on the current connection
+        self.rng = rng
+        if self.rng is None:
+            self.rng = random.Random()
+        # counters
+        self.attempts = 0       # connect() calls
+        self.connects = 0       # connections established
+        self.connectFailures = 0    # connect() refused or timed out
+        self.handshakeFailures = 0  # no ;CONNECTED after the connection was established
+        self.disconnects = 0    # established connections lost
+
+    def connecting(self, now):
+        self.state = CONNECTING
+        self.since = now
+        self.attempts += 1
+
+    def established(self, now):
+        self.state = ESTABLISHED
+        self.since = now
+        self.handshaken = False
+        self.connects += 1
+
+    def handshakeDone(self):
+        self.handshaken = True
+        self.failures = 0
+
+    def failed(self, now):
+        # The attempt or the connection is over, returns the wait (s) before the next attempt
+        if self.state == CONNECTING:
+            self.connectFailures += 1
+        elif self.handshaken:
+            self.disconnects += 1     # the connection had been working
+        else:
+            self.handshakeFailures += 1
+        self.handshaken = False
+        delay = self.rng.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** self.failures))
+        self.failures += 1
+        self.state = BACKOFF
+        self.since = now
+        self.retryAt = now + delay
+        return delay
+
+    def timedOut(self, now):
+        # True if the connect or the handshake is taking too long, from deadline() on (a loop that sleeps until the
+        # deadline must find it timed out, or it would spin)
+        if self.state == CONNECTING:
+            return now - self.since >= CONNECT_TIMEOUT
+        if self.state == ESTABLISHED and not self.handshaken:
+            return now - self.since >= HANDSHAKE_TIMEOUT
+        return False
+
+    def deadline(self):
+        # Time of the next thing to do for this connection, None if it only waits for socket events
+        if self.state == BACKOFF:
+            return self.retryAt
+        if self.state == CONNECTING:
+            return self.since + CONNECT_TIMEOUT
+        if self.state == ESTABLISHED and not self.handshaken:
+            return self.since + HANDSHAKE_TIMEOUT
+        return None
+
+    def stats(self):
+        return {"state": self.state, "failures": self.failures, "attempts": self.attempts, "connects": self.connects,
+                "connectFailures": self.connectFailures, "handshakeFailures": self.handshakeFailures, "disconnects": self.disconnects}
+
+
+def test_timedOut():
+    manager = connectionManager(random.Random(0))
+    manager.connecting(10.0)
+    if manager.timedOut(manager.deadline() - 0.001) or not manager.timedOut(manager.deadline()):
+        print("Error. Connect not timed out at its deadline")
+        return False
+    manager.established(20.0)
+    if not manager.timedOut(manager.deadline()):
+        print("Error. Handshake not timed out at its deadline")
+        return False
+    print("timedOut OK")
+    return True
+
+
+if __name__ == "__main__":
+    test_timedOut()
+
+    # Reconnection times of a room of modules after the base station restarts (it is back after 20 s)
+    modules = [connectionManager(random.Random(i)) for i in range(0, 50)]
+    back = 20
+    times = []
+    for manager in modules:
+        now = 0.0
+        manager.established(-10)
+        manager.handshakeDone()
+        manager.failed(now)     # connection lost
+        while True:
+            now = manager.retryAt
+            manager.connecting(now)
+            if now >= back:
+                times.append(now)
+                break
+            manager.failed(now + 0.01)  # refused
+    times.sort()
+    print("50 modules reconnect between %.1f s and %.1f s after the restart (old: all at the same 2 s tick)" % (times[0], times[-1]))
+    print("most in any 100 ms: %d" % max(len([t for t in times if start <= t < start + 0.1]) for start in times))
@@ -0,0 +1,31 @@
+'''Measures the motion detection to lamp off latency of the safety fast path.
+
+Turns the lamp on, fires the motion sensor and records how long it takes until the lamp and warning
+GPIO are off (PIR.killLatency), then prints the histogram. The detections are fired from here through
+the PIR callback, test1_smartUV.py prints the histogram of the real detections when it exits.
+
+Usage: python3 killLatency.py [number of detections]
+'''
+import sys
+from test1_smartUV import *
+
+
+def measure(count):
+    uv = sim_smartUV()
+    for i in range(0, count):
+        uv.warning_turnOn()
+        uv.lamp_turnOn()
+        uv.motionSensor.detected(0)     # Same path as the callback of a real PIR
+        if GPIO.input(GPIO_lamp) != GPIO.LOW or GPIO.input(GPIO_warning) != GPIO.LOW:
+            raise RuntimeError("lamp or warning still on after the detection")
+        uv.motionSensor.getReadings()   # Clears the detection like pre_cycle does
+        uv.lamp_turnOff()
+    return uv.motionSensor.killLatency
+
+
+if __name__ == "__main__":
+    count = 1000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    hist = measure(count)
+    print(hist.report())
@@ -8,24 +8,58 @@ Log:
 '''
 import time
 from grove_mini_pir_motion_sensor import *
+from latencyStats import latencyHistogram
+import motionEvents
+import sensorTrace
 
 class PIR:
-    def __init__(self, pin0, pin1, pin2):
+    # holdOff: s a sensor's repeated detections are merged into its first one while the controller has not read it
+    # recorder: a sensorTrace.traceRecorder to record every detection into
+    def __init__(self, pin0, pin1, pin2, holdOff=motionEvents.HOLD_OFF, recorder=None):
         self.motion0 = GroveMiniPIRMotionSensor(pin0)
         self.motion1 = GroveMiniPIRMotionSensor(pin1)
         self.motion2 = GroveMiniPIRMotionSensor(pin2)
 
-        self.motDet = False
-        def callback():
-            self.motDet = True
-        self.motion0.on_detect = callback
-        self.motion1.on_detect = callback
-        self.motion2.on_detect = callback
+        self.events = motionEvents.motionChannel(3, holdOff) # detections not read by getReadings yet
+        self.lastEvents = [] # the detections (time, sensor) the last getReadings returned True for
+        self.recorder = recorder
+        self.listener = None # called for every queued detection, see setListener
+        self.killSwitch = None # turns the lamp off, see setKillSwitch
+        self.killLatency = latencyHistogram("detection to lamp off")
+        self.motion0.on_detect = lambda: self.detected(0)
+        self.motion1.on_detect = lambda: self.detected(1)
+        self.motion2.on_detect = lambda: self.detected(2)
+
+    def detected(self, sensor):
+        # Sensor callback (GPIO thread) of sensor 0, 1 or 2
+        start = time.perf_counter()
+        event = self.events.post(sensor) # queued before the kill so the controller cannot turn the lamp back on in between
+        if self.killSwitch is not None:
+            self.killSwitch() # on every detection, debounced or not
+            self.killLatency.addSince(start)
+        if event is not None and self.listener is not None:
+            self.listener()
+        if self.recorder is not None:
+            self.recorder.record(sensorTrace.PIR + sensor, 1.0)
+
+    def setListener(self, listener):
+        # listener() is called from the sensor callback every time a detection is queued
+        # (lets the controller wake up without polling)
+        self.listener = listener
+
+    def setKillSwitch(self, killSwitch):
+        # Safety fast path: killSwitch() is called straight from the sensor callback to turn the lamp
+        # and warning off, before the state machine and the wifi are told about the motion.
+        self.killSwitch = killSwitch
+
+    def pending(self):
+        # True if motion was detected since the last getReadings
+        return self.events.pending()
 
     def getReadings(self):
-        if self.motDet == True:
-            self.motDet = False
-            print('Motion')
+        self.lastEvents = self.events.take() # a detection arriving now is kept for the next call
+        if self.lastEvents:
+            print('Motion', [event.sensor for event in self.lastEvents])
             #time.sleep(1)
             return True
         else:
@@ -38,4 +72,5 @@ if __name__ == "__main__":
     # Edit (Jordan): moved while loop from getReadings to here.
     # TODO: test on PCB.
     while True:
+        pir.events.wait()
         pir.getReadings()
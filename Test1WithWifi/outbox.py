@@ -0,0 +1,240 @@
+'''Outgoing message queue of one connection to the base station.
+
+Messages (already encoded, see wireProtocol) wait in a deque. When the socket is writable, flush() hands
+all of them to the kernel in one sendmsg() call (a vectored write, no joining of the messages). If the
+kernel only takes part of the data, the fully sent messages are dropped and the offset into the first
+remaining one is kept, so the next flush continues from a memoryview instead of re-slicing the bytes.
+
+The queue is bounded: messages of the same kind (eg. the latest state or trigger notification) replace
+each other instead of piling up while the base station is unreachable, and once maxLength messages
+are waiting the oldest one is dropped. dropped/coalesced count how often that happened. Messages appended with
+keep=True (the replies to requests with a correlation id, the protocol negotiation and heartbeat messages) are
+never dropped and do not count against maxLength: losing one would leave a request unanswered or break the
+framing of the rest of the connection.
+'''
+import collections
+
+IOV_MAX = 64    # most messages handed to one sendmsg() call
+MAX_LENGTH = 64 # default bound of the queue
+
+
+class queuedMessage:
+    # One message waiting in the outbox. The canned messages (wireProtocol.cannedReply) are shared bytes objects
+    # that can be queued several times, so the outbox matches on this entry and never on the bytes
+    __slots__ = ("message", "keep")
+
+    def __init__(self, message, keep):
+        self.message = message
+        self.keep = keep    # True if it must never be dropped
+
+
+class outbox:
+    def __init__(self, maxLength=MAX_LENGTH):
+        self.queue = collections.deque()    # queuedMessage of the encoded messages, the first one possibly partially sent
+        self.offset = 0                     # bytes of queue[0] already sent
+        self.kept = 0                       # number of queued messages that must never be dropped
+        self.maxLength = maxLength
+        self.kinds = {}                     # kind -> the queuedMessage of that kind
+        self.sendCalls = 0                  # number of sendmsg()/send() calls made
+        self.bytesSent = 0
+        self.dropped = 0                    # messages dropped because the queue was full
+        self.coalesced = 0                  # messages replaced by a newer one of the same kind
+        self.maxDepth = 0                   # largest number of messages that have been waiting
+
+    def __len__(self):
+        return len(self.queue)
+
+    def append(self, message, kind=None, keep=False):
+        # kind: messages of the same kind are idempotent, only the latest one is kept
+        # keep: the message is never dropped and does not count against maxLength
+        entry = queuedMessage(message, keep)
+        if kind is not None:
+            old = self.kinds.get(kind)
+            if old is not None and self.remove(old):
+                self.coalesced += 1
+            self.kinds[kind] = entry
+        if not keep and len(self.queue) - self.kept >= self.maxLength:
+            self.dropOldest()
+        self.queue.append(entry)
+        if keep:
+            self.kept += 1
+        if len(self.queue) > self.maxDepth:
+            self.maxDepth = len(self.queue)
+
+    def remove(self, entry):
+        # Removes a waiting queuedMessage (never the partially sent one), returns False if it is not waiting
+        start = 0
+        if self.offset:
+            start = 1
+        for i in range(start, len(self.queue)):
+            if self.queue[i] is entry:
+                self.unqueue(i)
+                return True
+        return False
+
+    def unqueue(self, index):
+        entry = self.queue[index]
+        del self.queue[index]
+        if entry.keep:
+            self.kept -= 1
+        self.forget(entry)
+
+    def dropOldest(self):
+        # Drops the oldest message that may be dropped
+        index = 0
+        if self.offset:
+            index = 1   # the partially sent message has to go out whole
+        while index < len(self.queue) and self.queue[index].keep:
+            index += 1
+        if index < len(self.queue):
+            self.unqueue(index)
+            self.dropped += 1
+
+    def forget(self, entry):
+        # entry leaves the queue, it is no longer the latest of its kind
+        for kind in list(self.kinds):
+            if self.kinds[kind] is entry:
+                del self.kinds[kind]
+
+    def peek(self, limit=IOV_MAX):
+        # The messages the next flush() will try to send
+        return [self.queue[i].message for i in range(0, min(limit, len(self.queue)))]
+
+    def take(self):
+        # Removes and returns all the messages (offline mode, nothing is sent)
+        messages = [entry.message for entry in self.queue]
+        self.queue.clear()
+        self.kept = 0
+        self.kinds.clear()
+        self.offset = 0
+        return messages
+
+    def flush(self, sock):
+        # Sends as much as the socket takes in one call, returns the number of bytes sent
+        if not self.queue:
+            return 0
+        buffers = self.peek()
+        if self.offset:
+            buffers[0] = memoryview(buffers[0])[self.offset:]
+        try:
+            if hasattr(sock, "sendmsg"):
+                sent = sock.sendmsg(buffers)
+            else:
+                sent = sock.send(b"".join(buffers))
+        except BlockingIOError:
+            return 0
+        self.sendCalls += 1
+        self.bytesSent += sent
+
+        # Drop the messages that went out completely, remember how far into the next one we got
+        remaining = sent + self.offset
+        while self.queue and remaining >= len(self.queue[0].message):
+            remaining -= len(self.queue[0].message)
+            self.unqueue(0)
+        self.offset = remaining
+        return sent
+
+
+def test_outbox():
+    # A trigger resent every second during a long outage is only queued once
+    box = outbox(maxLength=4)
+    box.append(b";HELLO_FRAMED")
+    for i in range(0, 3600):
+        box.append(b";MOTIONTRIGGERED", "TRIGGER")
+    if box.peek() != [b";HELLO_FRAMED", b";MOTIONTRIGGERED"] or box.coalesced != 3599:
+        print("Error. Trigger not coalesced:", box.peek())
+        return False
+
+    # The newest message of a kind replaces the older one, at the back of the queue
+    box.append(b";STATEIS_ON", "STATEIS")
+    box.append(b";TIMERTRIGGERED", "TRIGGER")
+    if box.peek() != [b";HELLO_FRAMED", b";STATEIS_ON", b";TIMERTRIGGERED"]:
+        print("Error. Wrong order after coalescing:", box.peek())
+        return False
+
+    # Full: the oldest message is dropped, never more than maxLength wait
+    box.append(b";NAMEIS_a")
+    box.append(b";NAMEIS_b")
+    if box.peek() != [b";STATEIS_ON", b";TIMERTRIGGERED", b";NAMEIS_a", b";NAMEIS_b"] or box.dropped != 1 or box.maxDepth != 4:
+        print("Error. Queue not bounded:", box.peek())
+        return False
+
+    # A partially sent message is never dropped or replaced, it has to go out whole
+    box.offset = 3
+    box.append(b";STATEIS_OFF", "STATEIS")
+    if box.peek()[0] != b";STATEIS_ON" or len(box) != 4:
+        print("Error. Partially sent message removed:", box.peek())
+        return False
+
+    # Kept messages (correlated replies, negotiation) are never dropped, however many are waiting
+    box = outbox(maxLength=4)
+    box.append(b";FRAMESTART", keep=True)
+    for i in range(0, 10):
+        box.append(b";STATEIS_ON@%d" % i, keep=True)
+        box.append(b";NAMEIS_%d" % i)
+    waiting = box.peek(limit=100)
+    if [message for message in waiting if b"@" in message] != [b";STATEIS_ON@%d" % i for i in range(0, 10)] or waiting[0] != b";FRAMESTART" \
+            or [message for message in waiting if b"NAMEIS" in message] != [b";NAMEIS_%d" % i for i in range(6, 10)] or box.dropped != 6:
+        print("Error. Kept message dropped:", waiting)
+        return False
+
+    # The same canned bytes queued twice: sending the partially sent copy does not make the later copy escape coalescing
+    reply = b";STATEIS_ON"
+    box = outbox()
+    box.append(reply, "STATEIS")
+    box.offset = 3
+    box.append(b";NAMEIS_a")
+    box.append(reply, "STATEIS")
+    class slowSocket:
+        def send(self, data):
+            return len(reply) - 3   # the rest of the partially sent copy only
+    box.flush(slowSocket())
+    box.append(reply, "STATEIS")
+    if box.peek() != [b";NAMEIS_a", reply] or box.coalesced != 1:
+        print("Error. Copy of a shared message not coalesced:", box.peek(), box.coalesced)
+        return False
+
+    print("outbox OK")
+    return True
+
+
+if __name__ == "__main__":
+    test_outbox()
+
+    # Benchmark: send bursts of replies one send() per message (the old write path) against flush()
+    import socket
+    import time
+
+    burst = [b";STATEIS_ON", b";NAMEIS_lamp", b";STATECHANGED_ON", b";MOTIONTRIGGERED"] * 4
+    bursts = 20000
+    (a, b) = socket.socketpair()
+    b.setblocking(False)
+
+    def drain():
+        try:
+            while b.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    start = time.perf_counter()
+    calls = 0
+    for i in range(0, bursts):
+        messages = list(burst)
+        while messages:
+            a.send(messages.pop(0))
+            calls += 1
+        drain()
+    elapsed = time.perf_counter() - start
+    print("send() per message: %d syscalls, %.0f messages/s" % (calls, bursts * len(burst) / elapsed))
+
+    box = outbox()
+    start = time.perf_counter()
+    for i in range(0, bursts):
+        for message in burst:
+            box.append(message)
+        while box:
+            box.flush(a)
+        drain()
+    elapsed = time.perf_counter() - start
+    print("outbox.flush():     %d syscalls, %.0f messages/s" % (box.sendCalls, bursts * len(burst) / elapsed))
@@ -0,0 +1,115 @@
+'''Clocks and event scheduler for the light module.
+
+Everything that needs the time (TimeTrack, wifiCommunicator, the simulated sensors and the main loop)
+asks a clock instead of calling time.time() directly. All clocks share the same scheduler: callbacks
+queued with callAt()/callLater() run in the thread that waits on the clock, in time order.
+
+    - realClock:    wall clock time, wait() really sleeps.
+    - virtualClock: simulated time, wait() jumps straight to the next scheduled event (or the end of the
+                    wait), so a 20 minute disinfection cycle runs in milliseconds.
+    - scaledClock:  wall clock running speed times faster, wait() sleeps 1/speed of the time waited (eg. to
+                    replay a sensor trace at 10x, see sensorTrace).
+
+Usage:
+    clock = virtualClock()
+    mySmartUV = sim_smartUV(clock)
+    clock.callAt(300, mySmartUV.motionSensor.setReadings)   # motion 5 minutes in
+    mySmartUV.main(1200)                                     # 20 minutes of simulated time
+'''
+import heapq
+import threading
+import time
+
+
+class realClock:
+    def __init__(self):
+        self.queue = []     # heap of (time, order, callback, args)
+        self.order = 0      # keeps callbacks queued for the same time in order
+        self.speed = 1      # s of clock time per s of wall time
+
+    def time(self):
+        return time.time()
+
+    def callAt(self, when, callback, *args):
+        heapq.heappush(self.queue, (when, self.order, callback, args))
+        self.order += 1
+
+    def callLater(self, delay, callback, *args):
+        self.callAt(self.time() + delay, callback, *args)
+
+    def nextEvent(self):
+        # Time of the next scheduled callback, None if nothing is scheduled
+        if self.queue:
+            return self.queue[0][0]
+        return None
+
+    def runDue(self):
+        # Run every callback that is due, returns the number of callbacks run
+        count = 0
+        while self.queue and self.queue[0][0] <= self.time():
+            when, order, callback, args = heapq.heappop(self.queue)
+            callback(*args)
+            count += 1
+        return count
+
+    def wait(self, event, timeout):
+        # Wait until event (threading.Event) is set or timeout (s) has passed, running scheduled
+        # callbacks as they become due. Returns True if the event was set.
+        deadline = self.time() + timeout
+        while True:
+            self.runDue()
+            if event.is_set():
+                return True
+            now = self.time()
+            if now >= deadline:
+                return False
+            wake = deadline
+            if self.queue:
+                wake = min(wake, self.queue[0][0])
+            event.wait((wake - now) / self.speed)
+
+    def sleep(self, seconds):
+        self.wait(threading.Event(), seconds)
+
+
+class scaledClock(realClock):
+    def __init__(self, speed, start=None):
+        realClock.__init__(self)
+        self.speed = float(speed)
+        self.origin = time.time()
+        self.start = start      # clock time at origin
+        if self.start is None:
+            self.start = self.origin
+
+    def time(self):
+        return self.start + (time.time() - self.origin) * self.speed
+
+
+class virtualClock(realClock):
+    def __init__(self, start=0.0):
+        realClock.__init__(self)
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def wait(self, event, timeout):
+        deadline = self.now + timeout
+        while True:
+            self.runDue()
+            if event.is_set():
+                return True
+            if self.queue and self.queue[0][0] <= deadline:
+                self.now = max(self.now, self.queue[0][0])    # jump to the next event
+            else:
+                self.now = deadline
+                return False
+
+
+if __name__ == "__main__":
+    clock = virtualClock()
+    for t in [5, 1, 3]:
+        clock.callAt(t, print, "event at", t)
+    start = time.time()
+    clock.sleep(3600)
+    print("1 hour of virtual time took %.3f ms, clock is at %.0f s" % ((time.time() - start) * 1e3, clock.time()))
@@ -27,13 +27,18 @@
 ##  - Timer.TO:         Timeout flag. True when time=0. Reset to False. 
 
 
+import sys
 import selectors
+import threading
 import RPi.GPIO as GPIO
 import controlLamp
 from time_track_2 import *
 from motion_sensor_3 import *
 from ultrasonic_sensor_3 import *
 import multiconnClientClass2
+import asyncControl
+import asyncWifi
+import sensorTrace
 
 '''
 # State constants
@@ -74,7 +79,8 @@ sel = selectors.DefaultSelector()
 
 class sim_smartUV:
 
-    def __init__(self):
+    # recorder: a sensorTrace.traceRecorder recording the PIR and ultrasonic sensors, None to record nothing
+    def __init__(self, recorder=None):
 
         # Declare parameters
         self.lampON = 0
@@ -86,32 +92,68 @@ class sim_smartUV:
         #Declare wifi parameters
         self.wifiName = "defaultName"
         self.wifi = None
+        self.wifiTimeout = 0    ## longest time (s) checkWifi() may block waiting for the base station (main() does the waiting)
+        self.asyncWifi = False  ## True to use asyncWifi.asyncWifiCommunicator (set by asyncControl, needs a running event loop)
+        self.lampLock = threading.Lock()    ## serialises lamp GPIO writes between the control loop and the motion callback
+        self.wakeUp = threading.Event()     ## set by the motion sensor to cut main()'s sleep short
 
         self.setup_GPIO()       # Setup GPIO
 
         # Initialize utility classes with respective GPIO pins
-        self.distanceSensor = Ultrasonic(GPIO_DIST0, GPIO_DIST1, GPIO_DIST2)
-        self.motionSensor   = PIR(GPIO_PIR0, GPIO_PIR1, GPIO_PIR2)
+        self.distanceSensor = Ultrasonic(GPIO_DIST0, GPIO_DIST1, GPIO_DIST2, background=True, tracking=True, recorder=recorder)
+        self.distanceSensor.setSampling(False)    # until the first INITIAL state
+        self.motionSensor   = PIR(GPIO_PIR0, GPIO_PIR1, GPIO_PIR2, recorder=recorder)
         self.timer          = TimeTrack()
         self.context        = IDLE
+
+        # Motion turns the lamp off from the sensor callback, without waiting for the next cycle
+        self.motionSensor.setKillSwitch(self.lamp_kill)
     
     def main(self):
         """ Main function to loop through when system is not in IDLE state.
         """
+        self.motionSensor.setListener(self.wakeUp.set)
         while True:
-            self.pre_cycle()    # Check connection and update information from PyUI
-            
-            if (self.state==IDLE):
-                self.state_IDLE()
-            elif (self.state==INITIAL):
-                self.state_INITIAL()
-            elif (self.state==ACTIVE):
-                self.state_ACTIVE()
+            self.cycle()
+            self.wakeUp.wait(self.sleepTime())     # Sleeps 1s, or less if motion is detected
+            self.wakeUp.clear()
 
-            self.post_cycle()   # Confirms state and context with PyUI
-            self.print_state()
-            time.sleep(1)
+        return 0
+
+    def sleepTime(self):
+        """ Time (s) to sleep before the next cycle: 1s, or less if the wifi has a trigger to resend or a connection to retry before then
+        """
+        wait = 1
+        if self.wifi is not None:
+            deadline = self.wifi.deadline()
+            if deadline is not None:
+                wait = max(0, min(wait, deadline - self.wifi.clock.time()))
+        return wait
+
+    def main_async(self):
+        """ Event driven version of main(). Runs a cycle as soon as wifi data, motion or a timer deadline arrives
+            instead of once a second. See asyncControl.py
+        """
+        controller = asyncControl.asyncController(self)
+        controller.run()
+        return 0
+
+    def cycle(self):
+        """ Runs one pass of the state machine.
+        """
+        self.pre_cycle()    # Check connection and update information from PyUI
+        # The rangers are only sampled while the distance is needed
+        self.distanceSensor.setSampling(self.state in (INITIAL, ACTIVE))
+        
+        if (self.state==IDLE):
+            self.state_IDLE()
+        elif (self.state==INITIAL):
+            self.state_INITIAL()
+        elif (self.state==ACTIVE):
+            self.state_ACTIVE()
 
+        self.post_cycle()   # Confirms state and context with PyUI
+        self.print_state()
         return 0
     
     #------------------- Raspberry PI GPIO Functions ----------------------------------#
@@ -124,19 +166,23 @@ class sim_smartUV:
         GPIO.setmode(GPIO.BCM)
 
         # Set pin mode for warning and lamps as write
-        GPIO.setup(GPIO_warning, GPIO.out)
-        GPIO.setup(GPIO_lamp, GPIO.out)
+        GPIO.setup(GPIO_warning, GPIO.OUT)
+        GPIO.setup(GPIO_lamp, GPIO.OUT)
 
         print ("Setting up GPIO")
 
         return True
 
     def lamp_turnOn(self):
-        """ Turns lamp on 
+        """ Turns lamp on, unless motion has been detected since the last pre_cycle
         """
-        GPIO.output(GPIO_lamp, GPIO.HIGH)
+        with self.lampLock:
+            if (self.motionSensor.pending()):
+                print ("Motion detected, lamp stays off")
+                return False
+            GPIO.output(GPIO_lamp, GPIO.HIGH)
+            self.lampON = 1
         print ("Turning lamp ON")
-        self.lampON = 1
         return True
 
     def lamp_turnOff(self):
@@ -147,6 +193,15 @@ class sim_smartUV:
         self.lampON = 0
         return True
         
+    def lamp_kill(self):
+        """ Safety fast path, called from the motion sensor callback. Turns lamp and warning off straight away.
+            lampON is left as is so state_IDLE still pauses the timer on the next cycle.
+        """
+        with self.lampLock:
+            GPIO.output(GPIO_lamp, GPIO.LOW)
+            GPIO.output(GPIO_warning, GPIO.LOW)
+        return True
+
     def warning_turnOn(self):
         """ Turns warning on
         """
@@ -197,12 +252,18 @@ class sim_smartUV:
         """
         State when UV light emitting
         """
+        # Follow the distance while emitting, a moved fixture or cart shows up without a new scan
+        tracked = self.distanceSensor.trackedDistance()
+        if tracked is not None:
+            self.dist = tracked
+
         # check timer 
         self.timer.check()
 
         # Turn on lamp if currently off
         if (self.lampON==0):
-            self.lamp_turnOn()      # Turns lamp off
+            if not self.lamp_turnOn():
+                return 0            # Motion detected, pre_cycle moves to IDLE on the next cycle
             self.warning_turnOn()   # Turns warning off
             self.timer.startTimer()
             self.context = ACTIVE
@@ -233,7 +294,10 @@ class sim_smartUV:
             else:
                 initialStateList = ["OFF", self.wifiName, 0]                
 
-            self.wifi = multiconnClientClass2.wifiCommunicator(sel, initialStateList)
+            if self.asyncWifi:
+                self.wifi = asyncWifi.asyncWifiCommunicator(initialStateList)
+            else:
+                self.wifi = multiconnClientClass2.wifiCommunicator(sel, initialStateList)
             print ("Connected")
 
         if (self.state==IDLE):
@@ -257,7 +321,7 @@ class sim_smartUV:
         #-------------------------------------------#
 
         # Check connection
-        self.wifi.checkWifi() # This updates the internal memory
+        self.wifi.checkWifi(self.wifiTimeout) # This updates the internal memory
 
         # Fetch updated data from checkwifi()
         (Connection, wifiState, self.wifiName, resetTimer) = self.wifi.getState()
@@ -312,10 +376,11 @@ class sim_smartUV:
                 self.context = HUMAN
             
         # self.wifi.confirmState(self.state, self.context)
+        timeLeft = self.timer.timeLeft()  # seconds left on the timer, pushed to the base station
         if self.state == ACTIVE:    
-            self.wifi.confirmState("ON", self.wifiName, None, self.context)
+            self.wifi.confirmState("ON", self.wifiName, timeLeft, self.context, distance=self.dist)
         else:
-            self.wifi.confirmState("OFF", self.wifiName, None, self.context)
+            self.wifi.confirmState("OFF", self.wifiName, timeLeft, self.context, distance=self.dist)
 
         return 0
 
@@ -334,5 +399,17 @@ class sim_smartUV:
 
 
 if __name__ == "__main__":
-    mySmartUV = sim_smartUV()
-    mySmartUV.main()
+    recorder = None
+    if "--record" in sys.argv:
+        # python3 test1_smartUV.py --record room.trace: records the sensors for simulationWithWifi/traceReplay.py
+        recorder = sensorTrace.traceRecorder(sys.argv[sys.argv.index("--record") + 1])
+    mySmartUV = sim_smartUV(recorder)
+    try:
+        if "--async" in sys.argv:
+            mySmartUV.main_async()
+        else:
+            mySmartUV.main()
+    finally:
+        if recorder is not None:
+            recorder.close()    # writes out the last second of records (eg. on Ctrl-C)
+        print(mySmartUV.motionSensor.killLatency.report())     # detection to lamp off of every real detection
@@ -3,15 +3,135 @@ Class for Ultrasonic Sensors to be used for simulations
 Status: Complete
 By: Bipasha Goyal
 Last modified: November 6, 2020
+
+With latency=True the three rangers are simulated (simRanger): every reading takes as long as a real echo,
+and getReadings() scans them like the hardware class, one after the other or (concurrent=True) at the same time
+on a thread pool (rangeSampler.concurrentScanner). The waits are real time, keep latency off with a virtual clock.
+An estimator (distanceEstimator) replaces the average of the scans, see ultrasonic_sensor_3. sequential=True
+stops a scan once the readings pin the distance down to +- tolerance (rangeSampler.sequentialScan).
+tracking=True makes trackedDistance() follow the simulated distance: directly, or with latency through a
+rangeSampler feeding a distanceTracker like on the hardware. replayReading() sets the distance from the
+readings of a recorded trace (sensorTrace.traceReplay).
+
+traceRanger replays recorded readings. python3 Ultrasonic_Test.py [trace.csv ...] compares the fixed 10 round
+scan with the sequential scans on recorded traces (one round per line: the three readings in m, separated by
+commas or spaces), or on generated ones without arguments.
 '''
 import time 
+import random
 #from grove_ultrasonic_ranger import *
+import simClock
+import rangeSampler
+import distanceTracker
+
+SPEED_OF_SOUND = 343.0  # m/s
+ECHO_OVERHEAD = 0.0005  # s of trigger pulse and ping burst before the echo is timed
+MAX_RANGE = 4.0         # m, further away the ranger waits for an echo that does not come
+
+class simRanger:
+    '''A GroveUltrasonicRanger with the latency of a real one: get_distance() takes the time of the echo.'''
+    def __init__(self, sensor):
+        self.sensor = sensor    # the Ultrasonic_sim it belongs to
+        self.readings = 0
+
+    def distance(self):
+        return self.sensor.distance
+
+    def get_distance(self):
+        distance = self.distance()
+        time.sleep(echoTime(distance))
+        self.readings += 1
+        return distance
+
+class traceRanger:
+    '''Replays the recorded readings of one ranger. Does not sleep, busy adds up the time a real ranger would
+    have taken for the readings returned.'''
+    def __init__(self, values):
+        self.values = values
+        self.position = 0
+        self.busy = 0.0     # s
+
+    def remaining(self):
+        return len(self.values) - self.position
+
+    def get_distance(self):
+        distance = self.values[self.position]
+        self.position += 1
+        self.busy += echoTime(distance)
+        return distance
+
+def loadTrace(path):
+    # Rounds of readings ([reading0, reading1, reading2] per line) of a trace file, lines starting with # are skipped
+    rounds = []
+    with open(path) as traceFile:
+        for line in traceFile:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                rounds.append([float(value) for value in line.replace(",", " ").split()])
+    return rounds
+
+def generatedTrace(distance, noise, glitches=0.0, rounds=1000, seed=1):
+    # rounds of three readings around distance (m) with gaussian noise (m), a share glitches of them multipath echoes
+    rng = random.Random(seed)
+    trace = []
+    for i in range(0, rounds):
+        readings = []
+        for sensor in range(0, 3):
+            if rng.random() < glitches:
+                readings.append(min(MAX_RANGE, distance + rng.uniform(1, 2)))
+            else:
+                readings.append(distance + rng.gauss(0, noise))
+        trace.append(readings)
+    return trace
+
+def echoTime(distance):
+    # s a ranger takes to measure distance (m)
+    return ECHO_OVERHEAD + 2 * min(distance, MAX_RANGE) / SPEED_OF_SOUND
 
 class Ultrasonic_sim:
-    def __init__(self,pin0,pin1,pin2):
+    def __init__(self,pin0,pin1,pin2,clock=None,latency=False,concurrent=False,stagger=rangeSampler.STAGGER,estimator=None,
+                 sequential=False,tolerance=rangeSampler.TOLERANCE,tracking=False):
         self.dist0 = 0 
         self.dist1 = 0 
         self.dist2 = 0 
+        self.distance = 0.5 # distance (m) returned by getReadings
+        self.clock = clock # simClock used by distanceAt
+        if self.clock is None:
+            self.clock = simClock.realClock()
+        self.estimator = estimator
+        self.sequential = sequential
+        self.tolerance = tolerance # m
+        self.scanner = None
+        if latency:
+            self.dist0 = simRanger(self)
+            self.dist1 = simRanger(self)
+            self.dist2 = simRanger(self)
+            if concurrent:
+                rangeFilter = rangeSampler.meanOfMeans
+                if estimator is not None:
+                    rangeFilter = estimator
+                self.scanner = rangeSampler.concurrentScanner([self.dist0, self.dist1, self.dist2], stagger, estimator=rangeFilter)
+        self.tracking = tracking
+        self.replayed = [None, None, None] # last replayed reading of each ranger
+        self.tracker = None
+        self.sampler = None
+        if tracking and latency:
+            self.tracker = distanceTracker.distanceTracker()
+            self.sampler = rangeSampler.rangeSampler([self.dist0, self.dist1, self.dist2], scanner=self.scanner, tracker=self.tracker)
+            self.sampler.start()
+
+    def setDistance(self, distance):
+        self.distance = distance
+
+    def replayReading(self, ranger, value):
+        # A recorded reading (m) of ranger 0, 1 or 2: the distance becomes the mean of the last reading of each ranger
+        self.replayed[ranger] = value
+        values = [reading for reading in self.replayed if reading is not None]
+        self.setDistance(sum(values) / len(values))
+
+    def distanceAt(self, when, distance):
+        # Schedules a change of the simulated distance at time when (s) of self.clock
+        self.clock.callAt(when, self.setDistance, distance)
 
     def getReadings(self):
         '''
@@ -48,5 +168,84 @@ class Ultrasonic_sim:
         #return  dist_final = mean([mean(dist0_read),mean(dist1_read),mean(dist2_read)])
         '''
         print ("Scanning")
-        distance = 0.5
-        return distance 
+        if self.scanner is not None:
+            distance = self.scanner.scan(rangeSampler.BUFFER_SIZE)
+            if distance is None:
+                return -1
+            return distance
+        if isinstance(self.dist0, simRanger) and self.estimator is not None:
+            result = self.estimator.scan(lambda: [self.dist0.get_distance(), self.dist1.get_distance(), self.dist2.get_distance()])
+            if result.distance is None:
+                return -1
+            return result.distance
+        if isinstance(self.dist0, simRanger) and self.sequential:
+            return rangeSampler.sequentialScan([self.dist0, self.dist1, self.dist2], self.tolerance)[0]
+        if isinstance(self.dist0, simRanger):
+            return rangeSampler.fixedScan([self.dist0, self.dist1, self.dist2])
+        return self.distance 
+
+    def setSampling(self, sampling):
+        # Pauses (False) or resumes (True) the background sampler, as ultrasonic_sensor_3.Ultrasonic
+        if self.sampler is None:
+            return
+        if sampling:
+            self.sampler.resume()
+        else:
+            self.sampler.pause()
+
+    def trackedDistance(self):
+        # Latest tracked distance (O(1), no scan), None without tracking or before the first reading
+        if not self.tracking:
+            return None
+        if self.tracker is None:
+            return self.distance
+        return self.tracker.distance
+
+    def close(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+        if self.scanner is not None:
+            self.scanner.close()
+            self.scanner = None
+
+
+if __name__ == "__main__":
+    # Benchmark: scan time and error of the fixed 10 round scan and of the sequential scans on traces
+    import sys
+    traces = []
+    for path in sys.argv[1:]:
+        trace = loadTrace(path)
+        column = sorted([reading for readings in trace for reading in readings])
+        traces.append((path, trace, column[len(column) // 2]))  # no true distance, the median of the trace stands in
+    if not traces:
+        traces = [("steady 1 m", generatedTrace(1.0, 0.001), 1.0),
+                  ("steady 2.9 m", generatedTrace(2.9, 0.001), 2.9),
+                  ("noisy 2 m (2 cm)", generatedTrace(2.0, 0.02), 2.0),
+                  ("glitches 2 m (5%)", generatedTrace(2.0, 0.002, 0.05), 2.0)]
+    scans = [("fixed 10 rounds", lambda rangers: (rangeSampler.fixedScan(rangers), rangeSampler.BUFFER_SIZE)),
+             ("sequential", lambda rangers: rangeSampler.sequentialScan(rangers))]
+    try:
+        import distanceEstimator
+        distanceEstimator.loadNumpy()
+        estimator = distanceEstimator.distanceEstimator()
+        def robustScan(rangers):
+            result = estimator.scan(lambda: [ranger.get_distance() for ranger in rangers])
+            return (result.distance, result.samples)
+        scans.append(("robust sequential", robustScan))
+    except ImportError:
+        print("NumPy missing, robust sequential scan skipped")
+
+    print("%-20s %-18s %6s %9s %8s %9s %9s" % ("trace", "scan", "scans", "ms/scan", "rounds", "mean err", "max err"))
+    for (name, trace, reference) in traces:
+        for (scanName, scan) in scans:
+            rangers = [traceRanger([readings[i] for readings in trace]) for i in range(0, 3)]
+            errors = []
+            rounds = 0
+            while rangers[0].remaining() >= rangeSampler.BUFFER_SIZE:
+                (distance, samples) = scan(rangers)
+                rounds += samples
+                errors.append(abs(distance - reference) if distance is not None else float("inf"))
+            busy = sum([ranger.busy for ranger in rangers])
+            print("%-20s %-18s %6d %9.1f %8.1f %7.1f mm %6.0f mm" % (name, scanName, len(errors), 1e3 * busy / len(errors),
+                  rounds / float(len(errors)), 1e3 * sum(errors) / len(errors), 1e3 * max(errors)))
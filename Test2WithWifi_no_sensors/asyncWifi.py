@@ -0,0 +1,267 @@
+'''wifiCommunicator on asyncio: the sockets are asyncio transports instead of a selector polled by checkWifi().
+
+The messages, commands, negotiation, outbox and retransmit queue are the ones of multiconnClientClass2, only
+the transport changes:
+    - each light module connection is a lightModuleProtocol (asyncio.Protocol). Received bytes are parsed and
+      answered as soon as the event loop delivers them, and the listener (see setListener) is called so the
+      controller can run a cycle straight away.
+    - connect, timeouts and backoff run in one task per light module (connectLoop), with the same
+      connectionManager as the selector version.
+    - a housekeeping timer resends triggers (and sends heartbeats and status records) when they are due, so the
+      communicator also works without a controller calling checkWifi(). It is armed for the earliest deadline
+      and moved forward when a message brings an earlier one. checkWifi() is still there for the controllers
+      and never blocks.
+getState() and confirmState() are unchanged. Must be created inside a running event loop, any number of
+communicators can share that loop:
+
+    async def main():
+        wifi = asyncWifiCommunicator(["OFF", "lamp", 0], host="127.0.0.1")
+        ...
+        wifi.close()
+'''
+import asyncio
+import socket
+import time
+import wireProtocol
+import multiconnClientClass2
+import connectionManager
+
+
+class lightModuleProtocol(asyncio.Protocol):
+    '''One TCP connection of a light module, hands everything to the asyncWifiCommunicator.'''
+    def __init__(self, communicator, connid):
+        self.communicator = communicator
+        self.connid = connid
+        self.closed = asyncio.get_running_loop().create_future()   # done when the connection is lost
+
+    def connection_made(self, transport):
+        self.communicator.connectionMade(self.connid, transport)
+
+    def data_received(self, chunk):
+        self.communicator.dataReceived(self.connid, chunk)
+
+    def connection_lost(self, exc):
+        self.communicator.connectionLost(self.connid)
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    def pause_writing(self):
+        self.communicator.connData[self.connid].paused = True
+
+    def resume_writing(self):
+        data = self.communicator.connData[self.connid]
+        data.paused = False
+        self.communicator.flush(data)
+
+
+class asyncWifiCommunicator(multiconnClientClass2.wifiCommunicator):
+    def __init__(self, initialStateList, clock=None, host=multiconnClientClass2.BASE_STATION_HOST, port=multiconnClientClass2.BASE_STATION_PORT, housekeeping=1):
+        self.loop = asyncio.get_running_loop()
+        self.housekeepingPeriod = housekeeping    # longest time (s) between two housekeeping runs
+        self.listener = None
+        self.tasks = []
+        self.timer = None       # asyncio.TimerHandle of the next housekeeping run
+        self.timerAt = None     # clock time it is armed for
+        self.closed = False
+        multiconnClientClass2.wifiCommunicator.__init__(self, None, initialStateList, clock, False, host, port)
+        self.scheduleHousekeeping()
+
+    def setListener(self, callback):
+        # callback() is called after messages from the base station have been handled
+        self.listener = callback
+
+    def start_connections(self, initialStateList):
+        for i in range(0, self.num_conns):
+            connid = i + 1
+            self.lightModuleDict[connid] = multiconnClientClass2.lightModuleClient(connid, initialStateList[i][0], initialStateList[i][1], initialStateList[i][2])
+            self.connections[connid] = connectionManager.connectionManager()
+            self.newConnData(connid, None)
+            self.tasks.append(self.loop.create_task(self.connectLoop(connid)))
+
+    def newConnData(self, connid, sock):
+        data = multiconnClientClass2.wifiCommunicator.newConnData(self, connid, sock)
+        data.transport = None   # asyncio transport of the connection, None while not connected
+        data.paused = False     # the transport buffer is full, keep messages in the outbox
+        return data
+
+    #connect, wait for the connection to end, back off, repeat
+    async def connectLoop(self, connid):
+        connection = self.connections[connid]
+        while True:
+            print("    attempting connection", connid, "to", (self.host, self.port))
+            connection.connecting(self.clock.time())
+            self.lightModuleDict[connid].lastConnectionAttemptTime = self.clock.time()
+            try:
+                (transport, protocol) = await asyncio.wait_for(
+                    self.loop.create_connection(lambda: lightModuleProtocol(self, connid), self.host, self.port),
+                    connectionManager.CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as e:
+                print("    connection", connid, "failed:", repr(e))
+            else:
+                try:
+                    await asyncio.wait_for(asyncio.shield(protocol.closed), connectionManager.HANDSHAKE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    if not connection.handshaken:
+                        print("    connection", connid, "timed out while", connection.state)
+                        transport.abort()
+                await protocol.closed
+            delay = connection.failed(self.clock.time())
+            print("    next connection attempt", connid, "in %.2f s" % delay)
+            await asyncio.sleep(delay)
+
+    def connectionMade(self, connid, transport):
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.keepalive is not None:
+                connectionManager.setKeepalive(sock, *self.keepalive)
+        data = self.newConnData(connid, None)
+        data.transport = transport
+        self.connections[connid].established(self.clock.time())
+        print("    connection", connid, "established")
+
+    def dataReceived(self, connid, chunk):
+        data = self.connData[connid]
+        lightModule = self.lightModuleDict[connid]
+        self.readEvents += 1
+        data.lastReceived = self.clock.time()
+        for (msgType, recv_data) in data.parser.feed(chunk, data.lastReceived):
+            if msgType == wireProtocol.MSG_TEXT:
+                self.processMessage(data, lightModule, recv_data)
+        self.flush(data)
+        self.scheduleHousekeeping()
+        if self.listener is not None:
+            self.listener()
+
+    def connectionLost(self, connid):
+        data = self.connData[connid]
+        data.transport = None
+        self.lightModuleDict[connid].disconnect()
+        if self.listener is not None:
+            self.listener()#the controller falls back to IDLE without waiting for its next cycle
+
+    #hand the queued messages to the transport (once the base station has sent ;CONNECTED)
+    def flush(self, data):
+        if data.transport is None or data.paused or not data.outbox:
+            return
+        if self.lightModuleDict[data.connid].connectionStatus != "CONNECTED":
+            return
+        messages = data.outbox.take()
+        print("    sending", messages, "to connection", data.connid)
+        data.transport.writelines(messages)
+
+    #trigger notifications and heartbeat, the connections are looked after by connectLoop
+    def housekeeping(self, data):
+        lightModule = self.lightModuleDict[data.connid]
+        now = self.clock.time()
+        received = self.processExpired(data, lightModule, now)
+        if wireProtocol.FEATURE_SEQ in data.features:
+            self.sendTriggerEvents(data, lightModule, now)
+        else:
+            self.sendTriggerMessages(data, lightModule, now)
+        self.sendStatus(data, lightModule, now)
+        if not self.heartbeat(data, lightModule, now) and data.transport is not None:
+            data.transport.abort()#connection_lost follows, then connectLoop backs off and reconnects
+            return
+        self.flush(data)
+        if received and self.listener is not None:
+            self.listener()
+
+    #arm the housekeeping timer for the next deadline (at most housekeepingPeriod away), unless it is already armed earlier
+    def scheduleHousekeeping(self):
+        if self.closed:
+            return
+        now = self.clock.time()
+        at = now + self.housekeepingPeriod
+        deadline = self.deadline()
+        if deadline is not None:
+            at = max(now, min(at, deadline))
+        if self.timer is not None:
+            if self.timerAt <= at:
+                return
+            self.timer.cancel()
+        self.timerAt = at
+        self.timer = self.loop.call_later(at - now, self.housekeepingTimer)
+
+    def housekeepingTimer(self):
+        self.timer = None
+        self.checkWifi(0)
+
+    #connection deadlines are handled by connectLoop, only the trigger resends, heartbeat, status records
+    #and held legacy messages are left for the caller
+    def deadline(self):
+        deadlines = [data.retransmit.deadline() for data in self.connData.values()]
+        deadlines += [data.parser.deadline() for data in self.connData.values()]
+        deadlines += [self.heartbeatDeadline(data) for data in self.connData.values()]
+        deadlines += [self.statusDeadline(data) for data in self.connData.values()]
+        deadlines = [d for d in deadlines if d is not None]
+        if not deadlines:
+            return None
+        return min(deadlines)
+
+    #the event loop delivers the messages, so this only does the housekeeping and never waits
+    def checkWifi(self, timeout=0):
+        for connid in list(self.connData):
+            self.housekeeping(self.connData[connid])
+        self.scheduleHousekeeping()
+
+    def confirmState(self, stateInput, nameInput, currentTime, context, connid=1, distance=None):
+        result = multiconnClientClass2.wifiCommunicator.confirmState(self, stateInput, nameInput, currentTime, context, connid, distance)
+        if connid in self.connData:
+            self.housekeeping(self.connData[connid])#a new trigger goes out now instead of at the next cycle
+            self.scheduleHousekeeping()
+        return result
+
+    def close(self):
+        self.closed = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for task in self.tasks:
+            task.cancel()
+        for data in self.connData.values():
+            if data.transport is not None:
+                data.transport.close()
+
+
+if __name__ == "__main__":
+    # Many communicators in one process against a minimal base station: round trip of GET STATE
+    import contextlib
+    import io
+    import latencyStats
+
+    async def demo(count=200, rounds=20):
+        replies = asyncio.Queue()
+
+        async def station(reader, writer):
+            writer.write(b";CONNECTED")
+            await writer.drain()
+            stationClients.append(writer)
+            while True:
+                chunk = await reader.read(4096)
+                if not chunk:
+                    break
+                if b"STATEIS" in chunk:
+                    replies.put_nowait(time.perf_counter())
+
+        stationClients = []
+        server = await asyncio.start_server(station, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        with contextlib.redirect_stdout(io.StringIO()):
+            fleet = [asyncWifiCommunicator(["OFF", "lamp%d" % i, 0], host="127.0.0.1", port=port) for i in range(0, count)]
+            while len(stationClients) < count or any(w.getState()[0] != "CONNECTED" for w in fleet):
+                await asyncio.sleep(0.01)
+            histogram = latencyStats.latencyHistogram("GET STATE round trip")
+            for i in range(0, rounds):
+                writer = stationClients[i % count]
+                start = time.perf_counter()
+                writer.write(b";GET STATE")
+                histogram.add(await replies.get() - start)
+            for w in fleet:
+                w.close()
+            await asyncio.sleep(0.1)    # let the transports call connection_lost
+        server.close()
+        print("%d communicators in one event loop" % count)
+        print(histogram.report())
+
+    asyncio.run(demo())
@@ -0,0 +1,137 @@
+'''Command table for the messages the light module receives from the base station.
+
+A message is routed to its handler with one dict lookup. Parameterised commands (eg. CHANGENAME_newName)
+are registered by prefix and the rest of the message is passed to the handler as the argument.
+Handlers are called as handler(data, lightModule, argument), where data is the connection data of the
+wifiCommunicator and lightModule the lightModuleClient the message is for.
+
+New commands can be added without touching the communicator:
+    def blink(data, lightModule, argument):
+        ...
+    myWifiCommunicator.commands.register(b"BLINK", blink)
+'''
+
+
+class commandTable:
+    def __init__(self):
+        self.exact = {}         # command -> handler
+        self.prefixes = {}      # prefix -> handler
+        self.prefixLengths = [] # lengths of the registered prefixes, longest first
+        self.whole = set()      # commands no other command starts with, see isComplete
+
+    def register(self, command, handler):
+        self.exact[command] = handler
+        self.updateWhole()
+
+    def registerPrefix(self, prefix, handler):
+        self.prefixes[prefix] = handler
+        if len(prefix) not in self.prefixLengths:
+            self.prefixLengths.append(len(prefix))
+            self.prefixLengths.sort(reverse=True)
+        self.updateWhole()
+
+    def unregister(self, command):
+        self.exact.pop(command, None)
+        self.prefixes.pop(command, None)
+        self.updateWhole()
+
+    def updateWhole(self):
+        commands = list(self.exact) + list(self.prefixes)
+        self.whole = set(command for command in self.exact
+                         if not any(other != command and other.startswith(command) for other in commands))
+
+    def isComplete(self, message):
+        # True if message is a whole command that is not the beginning of another one, so a legacy message
+        # read up to here cannot be the first part of a longer command (see wireProtocol.streamParser)
+        return message in self.whole
+
+    def lookup(self, message):
+        # Returns [handler, argument], [None, None] if the message is not a known command
+        handler = self.exact.get(message)
+        if handler is not None:
+            return [handler, b""]
+        for length in self.prefixLengths:
+            handler = self.prefixes.get(message[0:length])
+            if handler is not None:
+                return [handler, message[length:]]
+        return [None, None]
+
+    def dispatch(self, data, lightModule, message):
+        # Runs the handler of message, returns False if there is none (same as lookup, inlined as it runs for every message)
+        handler = self.exact.get(message)
+        if handler is not None:
+            handler(data, lightModule, b"")
+            return True
+        for length in self.prefixLengths:
+            handler = self.prefixes.get(message[0:length])
+            if handler is not None:
+                handler(data, lightModule, message[length:])
+                return True
+        return False
+
+
+def ifChainLookup(message):
+    # The comparisons service_connection used to make for every message, kept for the benchmark below
+    found = None
+    if (message == b"TRIGGEROFFCONFIRMED"):
+        found = "TRIGGEROFFCONFIRMED"
+    if (message == b"CHANGE STATE"):
+        found = "CHANGE STATE"
+    if (message == b"CONFIRM STATE"):
+        found = "CONFIRM STATE"
+    if (message == b"GET STATE"):
+        found = "GET STATE"
+    if (message == b"CONNECTED"):
+        found = "CONNECTED"
+    if (isinstance(message, bytes) and len(message)>7 and message[0:7] == b"CHANGEN"):
+        found = "CHANGENAME_"
+    if (message==b'CONFIRMNAMECHANGE'):
+        found = "CONFIRMNAMECHANGE"
+    if (message == b"GETNAME"):
+        found = "GETNAME"
+    if (message == b"RESETTIMER"):
+        found = "RESETTIMER"
+    return found
+
+
+if __name__ == "__main__":
+    # Benchmark 1: routing only, the old if-chain against the table
+    # Benchmark 2: messages per second through wifiCommunicator.processMessage (offline, prints discarded)
+    import contextlib
+    import io
+    import time
+    import multiconnClientClass2
+
+    mix = [b"GET STATE", b"CONFIRM STATE", b"GETNAME", b"CHANGENAME_lamp", b"CONFIRMNAMECHANGE",
+           b"RESETTIMER", b"TRIGGEROFFCONFIRMED", b"CHANGE STATE", b"UNKNOWN"]
+    rounds = 20000
+
+    table = commandTable()
+    for message in mix[0:-1]:
+        if message.startswith(b"CHANGENAME_"):
+            table.registerPrefix(b"CHANGENAME_", message)
+        else:
+            table.register(message, message)
+    for (name, route) in [("if-chain", ifChainLookup), ("table", table.lookup)]:
+        start = time.perf_counter()
+        for i in range(0, rounds):
+            for message in mix:
+                route(message)
+        elapsed = time.perf_counter() - start
+        print("routing, %-8s: %.0f messages/s" % (name, rounds * len(mix) / elapsed))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        wifi = multiconnClientClass2.wifiCommunicator(None, ["OFF", "lamp", 0], offline=True)
+        wifi.receive(1, [b"CONNECTED"])
+        data = wifi.connData[1]
+        lightModule = wifi.lightModuleDict[1]
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        start = time.perf_counter()
+        for i in range(0, rounds):
+            for message in mix:
+                wifi.processMessage(data, lightModule, message)
+            data.outbox.take()
+            out.seek(0)
+            out.truncate()
+        elapsed = time.perf_counter() - start
+    print("processMessage: %.0f messages/s" % (rounds * len(mix) / elapsed))
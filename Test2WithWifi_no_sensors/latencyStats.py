@@ -0,0 +1,69 @@
+'''Latency histogram used to measure the control paths (eg. motion detection to lamp off).
+
+Latencies are stored in power of two buckets of microseconds, so adding a sample is cheap enough
+to be done inside a sensor callback. Percentiles are approximate (upper edge of the bucket).
+'''
+import time
+
+
+class latencyHistogram:
+    def __init__(self, name="latency"):
+        self.name = name
+        self.buckets = [0] * 40     # bucket i holds latencies in [2^(i-1), 2^i) us, bucket 0 is < 1 us
+        self.count = 0
+        self.total = 0.0            # sum of all latencies (s)
+        self.min = None
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = int(seconds * 1e6)
+        i = us.bit_length()
+        if i >= len(self.buckets):
+            i = len(self.buckets) - 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def addSince(self, start):
+        # start is a time.perf_counter() value
+        self.add(time.perf_counter() - start)
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, p):
+        # Returns the upper edge (s) of the bucket holding the p-th percentile (0 < p <= 100)
+        if self.count == 0:
+            return 0.0
+        target = self.count * p / 100.0
+        seen = 0
+        for i in range(0, len(self.buckets)):
+            seen += self.buckets[i]
+            if seen >= target:
+                return min((1 << i) / 1e6, self.max)
+        return self.max
+
+    def report(self):
+        lines = ["%s: %d samples, mean %.3f ms, min %.3f ms, max %.3f ms, p50 <= %.3f ms, p99 <= %.3f ms" % (
+            self.name, self.count, self.mean() * 1e3, (self.min or 0) * 1e3, self.max * 1e3,
+            self.percentile(50) * 1e3, self.percentile(99) * 1e3)]
+        for i in range(0, len(self.buckets)):
+            if self.buckets[i]:
+                low = 0 if i == 0 else (1 << (i - 1))
+                lines.append("    %8d - %8d us: %d" % (low, 1 << i, self.buckets[i]))
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    hist = latencyHistogram("sleep(1ms)")
+    for i in range(0, 100):
+        start = time.perf_counter()
+        time.sleep(0.001)
+        hist.addSince(start)
+    print(hist.report())
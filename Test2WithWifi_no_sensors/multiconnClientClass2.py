@@ -2,11 +2,20 @@
 ##### Comment NIMA (2)
 
 import sys
+import os
+import errno
 import socket
 import selectors
 import types
 import time
 import copy
+import math
+import simClock
+import wireProtocol
+import commandTable
+import outbox
+import retransmitQueue
+import connectionManager
 
 #chris made change
 #chris made change2
@@ -68,6 +77,7 @@ class lightModuleClient:
         self.triggerMessageSent = False #whether a message has been sent to the base station to inform it that the light module ahs been triggered off
         self.lightTriggerConfirmationTime = 0#the last time at which we asked the base station whether it has understood that the light has been triggered off
         self.resetTimerRequested = False #this is True if the wifi has requested that the timer be reset, and will be changed to False again once the getState function has been called
+        self.lastTriggerSeq = 0 #sequence number of the last trigger event sent with the SEQ feature, kept across reconnections
 
         self.connid = connid #the ID number of the light
         
@@ -75,10 +85,13 @@ class lightModuleClient:
         #the above used to = None, but has been changed to start as the same as the actualName
         self.actualName = actualName #the current actual currently stored name of the light module
         
-        self.actualCurrentTime = actualCurrentTime #the time the light has been on for
+        self.actualCurrentTime = actualCurrentTime #the seconds left on the timer of the light, -1 if no timer is set
 
         self.lastConnectionAttemptTime = 0#The time of the last attempt to connect to the base station
 
+        self.context = "IDLE"#the context the main loop program last gave in confirmState ("IDLE", "ACTIVE", "MOTION" or "TIMER")
+        self.distance = None#the last distance (cm) the main loop program measured, None if not known
+
         print("        Light ", self.connid, " is NOT YET CONNECTED.")
 
     #the light gets triggered to be off with cause as either "MOTION" or "TIMER"
@@ -145,205 +158,567 @@ class lightModuleClient:
     #    print("    Light ", self.connid, "is now OFFLINE.")
 
 
+#kinds of messages that supersede each other in the outbox: only the latest one of each kind is worth sending
+KIND_TRIGGER = "TRIGGER" #the light was triggered off (motion or timer), resent every second until confirmed
+KIND_STATEIS = "STATEIS" #answer to GET STATE
+KIND_STATECHANGED = "STATECHANGED" #answer to CONFIRM STATE
+KIND_NAMEIS = "NAMEIS" #answer to GETNAME
+KIND_NAMECHANGED = "NAMECHANGED" #answer to CONFIRMNAMECHANGE
+KIND_PUSHSTATE = "PUSHSTATE" #state change notification (PUSH feature)
+KIND_PUSHNAME = "PUSHNAME" #name change notification (PUSH feature)
+KIND_PUSHTIMER = "PUSHTIMER" #timer change notification (PUSH feature)
+KIND_STATUS = "STATUS" #binary status record (STATUS feature)
+
+#replies that never change, encoded once instead of for every message
+REPLY_MOTIONTRIGGERED = wireProtocol.cannedReply(b"MOTIONTRIGGERED", KIND_TRIGGER)
+REPLY_TIMERTRIGGERED = wireProtocol.cannedReply(b"TIMERTRIGGERED", KIND_TRIGGER)
+REPLY_STATENOTCHANGED_ON = wireProtocol.cannedReply(b"STATENOTCHANGED_ON", KIND_STATECHANGED)
+REPLY_STATENOTCHANGED_OFF = wireProtocol.cannedReply(b"STATENOTCHANGED_OFF", KIND_STATECHANGED)
+REPLY_STATECHANGED_ON = wireProtocol.cannedReply(b"STATECHANGED_ON", KIND_STATECHANGED)
+REPLY_STATECHANGED_OFF = wireProtocol.cannedReply(b"STATECHANGED_OFF", KIND_STATECHANGED)
+REPLY_STATEIS_ON = wireProtocol.cannedReply(b"STATEIS_ON", KIND_STATEIS)
+REPLY_STATEIS_OFF = wireProtocol.cannedReply(b"STATEIS_OFF", KIND_STATEIS)
+REPLY_NAMENOTCHANGED = wireProtocol.cannedReply(b"NAMENOTCHANGED", KIND_NAMECHANGED)
+
+#address of the base station (the access point of the piui)
+BASE_STATION_HOST = "192.168.4.1"
+BASE_STATION_PORT = 50007
+
 class wifiCommunicator():
-    #initialStateList is in the format [actualState, actualName, actualCurrentTime]
-    def __init__(self, selector, initialStateList):
+    #initialStateList is in the format [actualState, actualName, actualCurrentTime] for one light, or a list of those
+    #for several lights (lamp heads) driven by this pi0; light i of the list gets connid i+1 and its own connection
+    #clock is the simClock used for all timing (real time if None)
+    #offline=True opens no sockets: the (simulated) base station talks to the light module through receive() and takeMessages()
+    #host, port: address of the base station
+    def __init__(self, selector, initialStateList, clock=None, offline=False, host=BASE_STATION_HOST, port=BASE_STATION_PORT):
         self.sel = selector
         self.lightModuleDict = {}
-        initialStateList = [copy.copy(initialStateList)]#the program used to take more than one light per light module, and hence used to be a list of lists
+        self.connData = {} #the per connection data (socket, outgoing messages) of each light module, by connid
+        self.connections = {} #the connectionManager (connect state, backoff, counters) of each light module, by connid
+        if initialStateList and isinstance(initialStateList[0], (list, tuple)):
+            initialStateList = [copy.copy(state) for state in initialStateList]#one [actualState, actualName, actualCurrentTime] per light
+        else:
+            initialStateList = [copy.copy(initialStateList)]#a single light
         self.num_conns = len(initialStateList) 
-        self.host = "192.168.4.1"
-        self.port = int("50007")
+        self.host = host
+        self.port = int(port)
+        self.clock = clock
+        if self.clock is None:
+            self.clock = simClock.realClock()
+        self.offline = offline
+        self.features = list(wireProtocol.SUPPORTED_FEATURES) #protocol features offered to the base station, see wireProtocol
+        self.maxRead = 65536 #most bytes read from a socket per read event
+        self.heartbeatInterval = 1 #s of silence from the base station after which a PING is sent (HEARTBEAT feature)
+        self.heartbeatTimeout = 3 #s of silence after which the base station is taken as dead (HEARTBEAT feature)
+        self.keepalive = connectionManager.KEEPALIVE #TCP keepalive (idle, interval, count), None to leave the system default
+        self.statusRate = 0 #status records sent per second (STATUS feature) until the base station asks for another rate, 0 for none
+        self.registerCommands()
+        self.readEvents = 0 #number of read events serviced so far, lets an event loop tell whether anything arrived
         self.start_connections(initialStateList)
 
     #attempt to start the wifi connections and create lightModuleClient objects in the lightModuleDict for each light
     def start_connections(self, initialStateList):
-        server_addr = (self.host, self.port)
         for i in range(0, self.num_conns):
             connid = i + 1
-            print("    attempting connection", connid, "to", server_addr)
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.setblocking(False)
-            sock.connect_ex(server_addr)
-            events = selectors.EVENT_READ | selectors.EVENT_WRITE
-            data = types.SimpleNamespace(
-                connid=connid,
-                #msg_total=sum(len(m) for m in messages),
-                #recv_total=0,
-                messages=[],#list(messages),
-                outb=b"",
-            )
-            self.sel.register(sock, events, data=data)
             self.lightModuleDict[connid] = lightModuleClient(connid, initialStateList[i][0], initialStateList[i][1], initialStateList[i][2])
-            self.lightModuleDict[connid].lastConnectionAttemptTime = time.time()#record the time this connection attempt was made
-
-    #reattempt to connect to a light module if it was not able to connect to base station (the old socket must first be unregistered)
+            if self.offline:
+                self.newConnData(connid, None)
+            else:
+                print("    attempting connection", connid, "to", (self.host, self.port))
+                self.connections[connid] = connectionManager.connectionManager()
+                self.openSocket(connid)
+            self.lightModuleDict[connid].lastConnectionAttemptTime = self.clock.time()#record the time this connection attempt was made
+
+    #reattempt to connect to a light module if it was not able to connect to base station (the old socket must first be closed)
     def attemptReconnection(self,connid):
-        server_addr = (self.host, self.port)
-        print("    reattempting connection", connid, "to", server_addr)
+        print("    reattempting connection", connid, "to", (self.host, self.port))
+        self.openSocket(connid)
+        self.lightModuleDict[connid].lastConnectionAttemptTime = self.clock.time()#record the time this connection attempt was made
+
+    #start a non blocking connection to the base station and register it with the selector
+    #the socket becomes writable once the connect has finished, successfully or not (see finishConnect)
+    def openSocket(self, connid):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setblocking(False)
-        sock.connect_ex(server_addr)
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
+        if self.keepalive is not None:
+            connectionManager.setKeepalive(sock, *self.keepalive)
+        self.connections[connid].connecting(self.clock.time())
+        err = sock.connect_ex((self.host, self.port))
+        data = self.newConnData(connid, sock)
+        data.events = selectors.EVENT_READ | selectors.EVENT_WRITE
+        self.sel.register(sock, data.events, data=data)#after the connect, write events are only asked for when there is something to send, see updateInterest
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            print("    connection", connid, "failed:", os.strerror(err))
+            self.connectionFailed(data)
+
+    #the connect of data.sock has finished, find out whether it worked; returns True if the connection is established
+    def finishConnect(self, data):
+        err = data.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            print("    connection", data.connid, "failed:", os.strerror(err))
+            self.connectionFailed(data)
+            return False
+        self.connections[data.connid].established(self.clock.time())
+        print("    connection", data.connid, "established")
+        return True
+
+    #the connect failed, timed out, or the connection was lost: close the socket and wait before the next attempt
+    def connectionFailed(self, data):
+        self.closeSocket(data)
+        delay = self.connections[data.connid].failed(self.clock.time())
+        print("    next connection attempt", data.connid, "in %.2f s" % delay)
+
+    def newConnData(self, connid, sock):
         data = types.SimpleNamespace(
             connid=connid,
+            sock=sock,
             #msg_total=sum(len(m) for m in messages),
             #recv_total=0,
-            messages=[],#list(messages),
-            outb=b"",
+            outbox=outbox.outbox(),#encoded messages waiting to be sent
+            parser=wireProtocol.streamParser(),#reassembles the incoming messages
+            features=set(),#protocol features negotiated with the base station
+            framed=False,#whether outgoing messages are framed (legacy ";" otherwise)
+            events=selectors.EVENT_READ,#the events the socket is registered for
+            retransmit=retransmitQueue.retransmitQueue(self.lightModuleDict[connid].lastTriggerSeq + 1),#trigger events waiting for their ack (SEQ feature)
+            triggerSeq=None,#sequence number of the event for the current trigger, None if it has not been sent on this connection
+            lastReceived=self.clock.time(),#time anything was last received from the base station
+            lastPing=0,#time the last PING was sent (HEARTBEAT feature)
+            pushed={},#the last state, name and timer pushed on this connection (PUSH feature)
+            correlation=None,#correlation id of the command being handled, added to its replies (CORRID feature)
+            statusPeriod=None,#s between two status records, None if they are not streamed (STATUS feature)
+            nextStatus=0,#time the next status record is due
+            statusSeq=0,#sequence number of the last status record sent on this connection
         )
-        self.sel.register(sock, events, data=data)
-        self.lightModuleDict[connid].lastConnectionAttemptTime = time.time()#record the time this connection attempt was made
-
-    def service_connection(self, key, mask):
-        sock = key.fileobj
-        data = key.data
+        data.parser.complete = lambda message: self.isWholeMessage(data, message)
+        self.connData[connid] = data
+        return data
+
+    #legacy messages the parser hands over without waiting for more bytes: whole commands (see commandTable.isComplete).
+    #they never carry a correlation id, CORRID is only used with FRAMED (see wireProtocol.FRAMED_ONLY)
+    def isWholeMessage(self, data, message):
+        return self.commands.isComplete(message)
+
+    #a connected socket is writable nearly all the time, so only ask the selector for write events while there
+    #is something to send (otherwise select() returns straight away on every call)
+    def updateInterest(self, data):
+        if data.sock is None:
+            return
+        events = selectors.EVENT_READ
+        if data.outbox and self.lightModuleDict[data.connid].connectionStatus == "CONNECTED":
+            events |= selectors.EVENT_WRITE
+        elif self.connections[data.connid].state == connectionManager.CONNECTING:
+            events |= selectors.EVENT_WRITE#writable = the connect has finished
+        if events != data.events:
+            self.sel.modify(data.sock, events, data=data)
+            data.events = events
+
+    def closeSocket(self, data):
+        print("    closing socket", data.connid)
+        self.sel.unregister(data.sock)
+        data.sock.close()
+        data.sock = None
+        self.lightModuleDict[data.connid].disconnect()#properly disconnect the light module socket
+
+    #work that does not depend on socket events: trigger notifications and reconnection attempts
+    def housekeeping(self, data):
         lightModule = self.lightModuleDict[data.connid]
-        
+        now = self.clock.time()
+        self.processExpired(data, lightModule, now)
+
+        if wireProtocol.FEATURE_SEQ in data.features:
+            self.sendTriggerEvents(data, lightModule, now)
+        else:
+            self.sendTriggerMessages(data, lightModule, now)
+        self.sendStatus(data, lightModule, now)
+
+        if not self.offline:
+            connection = self.connections[data.connid]
+            if connection.state == connectionManager.BACKOFF:
+                if now >= connection.retryAt:#the wait after the last failure is over
+                    self.attemptReconnection(data.connid)
+                return
+            if connection.timedOut(now):#the connect or the ;CONNECTED from the base station is taking too long
+                print("    connection", data.connid, "timed out while", connection.state)
+                self.connectionFailed(data)
+                return
+            if not self.heartbeat(data, lightModule, now):
+                self.connectionFailed(data)
+                return
+        self.updateInterest(data)
+
+    #HEARTBEAT feature: ping a silent base station, returns False once it has been silent for too long (taken as dead)
+    def heartbeat(self, data, lightModule, now):
+        if wireProtocol.FEATURE_HEARTBEAT not in data.features or lightModule.connectionStatus != "CONNECTED":
+            return True
+        silent = now - data.lastReceived
+        if silent > self.heartbeatTimeout:
+            print("    connection", data.connid, "silent for %.1f s, base station taken as dead" % silent)
+            return False
+        if silent >= self.heartbeatInterval and now - data.lastPing >= self.heartbeatInterval:
+            self.queueMessage(data, wireProtocol.PING, "PING")
+            data.lastPing = now
+        return True
+
+    #STATUS feature: queue a status record when one is due, a newer record replaces one still waiting in the outbox
+    def sendStatus(self, data, lightModule, now):
+        if data.statusPeriod is None or now < data.nextStatus or lightModule.connectionStatus != "CONNECTED":
+            return
+        flags = 0
+        if lightModule.lightTriggeredOff == "MOTION":
+            flags |= wireProtocol.FLAG_TRIGGERED_MOTION
+        elif lightModule.lightTriggeredOff == "TIMER":
+            flags |= wireProtocol.FLAG_TRIGGERED_TIMER
+        if lightModule.motionHappening:
+            flags |= wireProtocol.FLAG_MOTION
+        data.statusSeq += 1
+        data.outbox.append(wireProtocol.encodeStatus(data.statusSeq, lightModule.actualState, lightModule.context, flags,
+                                                     lightModule.actualCurrentTime, lightModule.distance), KIND_STATUS)
+        data.nextStatus = max(data.nextStatus + data.statusPeriod, now)#no burst to catch up after a late housekeeping
+
+    #time the next status record is due, None if they are not streamed
+    def statusDeadline(self, data):
+        if data.statusPeriod is None or self.lightModuleDict[data.connid].connectionStatus != "CONNECTED":
+            return None
+        return data.nextStatus
+
+    #rate is the number of status records per second (at most wireProtocol.MAX_STATUS_RATE), 0 stops them
+    def setStatusRate(self, data, rate):
+        if not rate > 0 or wireProtocol.FEATURE_STATUS not in data.features or not data.framed:
+            data.statusPeriod = None
+            return
+        data.statusPeriod = 1.0 / min(rate, wireProtocol.MAX_STATUS_RATE)#a period of ~0 would keep the status always due
+        data.nextStatus = self.clock.time()
+
+    #time of the next PING or of the heartbeat timeout of a connection, None if it has no heartbeat
+    def heartbeatDeadline(self, data):
+        if wireProtocol.FEATURE_HEARTBEAT not in data.features or self.lightModuleDict[data.connid].connectionStatus != "CONNECTED":
+            return None
+        if data.lastPing >= data.lastReceived:#already pinged, waiting for the answer
+            return min(data.lastPing + self.heartbeatInterval, data.lastReceived + self.heartbeatTimeout)
+        return data.lastReceived + self.heartbeatInterval
+
+    #legacy trigger notification: resent every second until a TRIGGEROFFCONFIRMED arrives
+    def sendTriggerMessages(self, data, lightModule, now):
         #if we have already sent a message telling the base station that the light has been triggered off
         #but we haven't yet received confirmation that the base station knows the light has been triggered off for the past second, then reattempt to tell it this
-        if lightModule.lightTriggeredOff == "MOTION" and lightModule.triggerMessageSent == True and time.time() - lightModule.lightTriggerConfirmationTime > 1:
-            data.messages += [b";MOTIONTRIGGERED"]
-            lightModule.lightTriggerConfirmationTime = time.time()#record the time we told the base station the light turned off
-        elif lightModule.lightTriggeredOff == "TIMER" and lightModule.triggerMessageSent == True and time.time() - lightModule.lightTriggerConfirmationTime > 1:
-            data.messages += [b";TIMERTRIGGERED"]
-            lightModule.lightTriggerConfirmationTime = time.time()#record the time we told the base station the light turned off
+        if lightModule.lightTriggeredOff == "MOTION" and lightModule.triggerMessageSent == True and now - lightModule.lightTriggerConfirmationTime > 1:
+            self.queueReply(data, REPLY_MOTIONTRIGGERED)
+            lightModule.lightTriggerConfirmationTime = now#record the time we told the base station the light turned off
+        elif lightModule.lightTriggeredOff == "TIMER" and lightModule.triggerMessageSent == True and now - lightModule.lightTriggerConfirmationTime > 1:
+            self.queueReply(data, REPLY_TIMERTRIGGERED)
+            lightModule.lightTriggerConfirmationTime = now#record the time we told the base station the light turned off
         
         #if the light has been triggered off by the timer or the motion sensor, we inform the base station
         if lightModule.lightTriggeredOff == "MOTION" and lightModule.triggerMessageSent == False:
             lightModule.triggerMessageSent = True#this triggerMessageSent variable signifies we have attempted to tell the base station 
-            data.messages += [b";MOTIONTRIGGERED"]#inform the base station that the light is off due to motion trigger
-            lightModule.lightTriggerConfirmationTime = time.time()#record the time we told the base station the light turned off
+            self.queueReply(data, REPLY_MOTIONTRIGGERED)#inform the base station that the light is off due to motion trigger
+            lightModule.lightTriggerConfirmationTime = now#record the time we told the base station the light turned off
         elif lightModule.lightTriggeredOff == "TIMER" and lightModule.triggerMessageSent == False:
             lightModule.triggerMessageSent = True
-            data.messages += [b";TIMERTRIGGERED"]#inform the base station that the light is off due to timer finishing
-            lightModule.lightTriggerConfirmationTime = time.time()#record the time we told the base station the light turned off
-
+            self.queueReply(data, REPLY_TIMERTRIGGERED)#inform the base station that the light is off due to timer finishing
+            lightModule.lightTriggerConfirmationTime = now#record the time we told the base station the light turned off
+
+    #SEQ feature: every trigger is an event with its own sequence number, resent by the retransmit queue until
+    #the base station acknowledges that number
+    def sendTriggerEvents(self, data, lightModule, now):
+        if lightModule.lightTriggeredOff != "NO" and (lightModule.triggerMessageSent == False or data.triggerSeq is None):
+            if lightModule.lightTriggeredOff == "MOTION":
+                payload = REPLY_MOTIONTRIGGERED.payload
+            else:
+                payload = REPLY_TIMERTRIGGERED.payload
+            data.triggerSeq = data.retransmit.add(payload, now)
+            lightModule.lastTriggerSeq = data.triggerSeq
+            lightModule.triggerMessageSent = True
+            lightModule.lightTriggerConfirmationTime = now
+            self.queueTriggerEvent(data, data.retransmit.pending[data.triggerSeq])
+        for event in data.retransmit.due(now):
+            self.queueTriggerEvent(data, event)
+
+    def queueTriggerEvent(self, data, event):
+        self.queueMessage(data, event.payload + b"_" + str(event.seq).encode('utf-8'), "TRIGGER_%d" % event.seq)
+
+    #time of the next thing housekeeping has to do (trigger resend of the SEQ feature, heartbeat, connection attempt or timeout,
+    #held legacy message), None if there is nothing to do until a socket event
+    def deadline(self):
+        deadlines = [data.retransmit.deadline() for data in self.connData.values()]
+        deadlines += [data.parser.deadline() for data in self.connData.values()]
+        deadlines += [self.heartbeatDeadline(data) for data in self.connData.values()]
+        deadlines += [self.statusDeadline(data) for data in self.connData.values()]
+        deadlines += [connection.deadline() for connection in self.connections.values()]
+        deadlines = [d for d in deadlines if d is not None]
+        if not deadlines:
+            return None
+        return min(deadlines)
 
 #NOW must make it wait for confirmation the piui knows the light has turned off, and then set lightModule.TriggeredOff = "NO"
 
+    #the commands understood from the base station, see commandTable
+    def registerCommands(self):
+        self.commands = commandTable.commandTable()
+        self.commands.register(b"TRIGGEROFFCONFIRMED", self.cmd_triggerOffConfirmed)
+        self.commands.registerPrefix(b"TRIGGEROFFCONFIRMED_", self.cmd_triggerEventsConfirmed)
+        self.commands.register(b"CHANGE STATE", self.cmd_changeState)
+        self.commands.register(b"CONFIRM STATE", self.cmd_confirmState)
+        self.commands.register(b"GET STATE", self.cmd_getState)
+        self.commands.register(b"CONNECTED", self.cmd_connected)
+        self.commands.registerPrefix(wireProtocol.HELLOACK, self.cmd_helloAck)
+        self.commands.registerPrefix(b"CHANGENAME_", self.cmd_changeName)
+        self.commands.register(b"CONFIRMNAMECHANGE", self.cmd_confirmNameChange)
+        self.commands.register(b"GETNAME", self.cmd_getName)
+        self.commands.register(b"RESETTIMER", self.cmd_resetTimer)
+        self.commands.registerPrefix(wireProtocol.STATUS_RATE, self.cmd_statusRate)
+        self.commands.register(wireProtocol.PING, self.cmd_ping)
+        self.commands.register(wireProtocol.PONG, self.cmd_pong)
+
+    #handle the legacy message the parser has held (it may have continued in the next read) once it has waited long enough,
+    #see wireProtocol.streamParser; returns True if there was one
+    def processExpired(self, data, lightModule, now):
+        messages = data.parser.expired(now)
+        for (msgType, recv_data) in messages:
+            self.processMessage(data, lightModule, recv_data)
+        return len(messages) > 0
+
+    #handle one message received from the base station
+    def processMessage(self, data, lightModule, recv_data):
+        print("    received", repr(recv_data), "from connection", data.connid)
+        #data.recv_total += len(recv_data)
+        if wireProtocol.FEATURE_CORRID in data.features:
+            (recv_data, data.correlation) = wireProtocol.splitCorrelation(recv_data)
+        self.commands.dispatch(data, lightModule, recv_data)
+        data.correlation = None
+
+    #if the base station receives confirmation that the base station knows the light has been triggered off
+    #reset all the relevant trigger variables (except for lightModule.motionHappening, which might still be True) so that
+    #the pi0 stops telling the base station the light has been triggered off
+    def cmd_triggerOffConfirmed(self, data, lightModule, argument):
+        if wireProtocol.FEATURE_SEQ in data.features:
+            return#with SEQ only acks by number count, a bare ack could be for an older trigger
+        lightModule.triggerMessageSent = False
+        lightModule.lightTriggeredOff = "NO"
+        #note that there is an extremely slim chance that this TRIGGEREDOFFCONFIRMED is actually from a previous off cycle of the light,
+        #but this is not that important right now since the pi0 will still call the above triggered message at least once for this base station cycle
+
+    #SEQ feature: the base station acknowledges trigger events by number, full command is TRIGGEROFFCONFIRMED_<seq>,<seq>,...
+    #an ack of an older event only takes it out of the retransmit queue, the current trigger stays until its own number is acked
+    def cmd_triggerEventsConfirmed(self, data, lightModule, argument):
+        now = self.clock.time()
+        for seq in wireProtocol.parseSeqList(argument):
+            if data.retransmit.ack(seq, now) and seq == data.triggerSeq:
+                data.triggerSeq = None
+                lightModule.triggerMessageSent = False
+                lightModule.lightTriggeredOff = "NO"
+
+    #if the piui requests the light changes state
+    def cmd_changeState(self, data, lightModule, argument):
+        if lightModule.lightTriggeredOff == "TIMER":
+            pass#the user cannot change the light state if this is the exact moment the timer has triggered to be off, and the wifi is currently processing the timer trigger
+        elif lightModule.motionHappening == True:
+            #if there is motion currently being detected, then don't turn the light on and inform the base station (Note that
+            # we will not confirm that the base station received this because the base station should already know the light is off)
+            self.queueReply(data, REPLY_MOTIONTRIGGERED)
+        else:
+            #otherwise turn the light on or off
+            lightModule.changeWifiState()
+
+    #if the piui requests to confirm whether the light has changed state
+    def cmd_confirmState(self, data, lightModule, argument):
+        stateConfirmation = lightModule.confirmState()
+        if stateConfirmation[0] == False:#if the light has not yet changed state
+            if stateConfirmation[1] == "ON":
+                self.queueReply(data, REPLY_STATENOTCHANGED_ON)#if the light is on
+            else:
+                self.queueReply(data, REPLY_STATENOTCHANGED_OFF)#if the light is off
+        else:#if the light has successfully changed state
+            if stateConfirmation[1] == "ON":
+                self.queueReply(data, REPLY_STATECHANGED_ON)
+            else:
+                self.queueReply(data, REPLY_STATECHANGED_OFF)
+
+    #if the piui asks what state the light is currently in
+    def cmd_getState(self, data, lightModule, argument):
+        if lightModule.motionHappening == True:
+            #if there is motion currently being detected, then inform the base station
+            self.queueReply(data, REPLY_MOTIONTRIGGERED)
+        elif lightModule.actualState == "ON":#if the light is send a message to the piui saying such, and vice versa
+            self.queueReply(data, REPLY_STATEIS_ON)
+        elif lightModule.actualState == "OFF":
+            self.queueReply(data, REPLY_STATEIS_OFF)
+
+    #the piui tells the light module that it has successfully connected wifi
+    def cmd_connected(self, data, lightModule, argument):
+        lightModule.connect()
+        if data.connid in self.connections:
+            self.connections[data.connid].handshakeDone()#the connection works, the next failure starts from the shortest backoff
+        if self.features:
+            self.queueMessage(data, wireProtocol.helloMessage(self.features), keep=True)#offer the protocol features, old base stations ignore this
+
+    #the base station answers the HELLO with the features both sides will use
+    def cmd_helloAck(self, data, lightModule, argument):
+        data.features = wireProtocol.usableFeatures(wireProtocol.parseFeatures(wireProtocol.HELLOACK + argument) & set(self.features))
+        print("    connection", data.connid, "uses features", sorted(data.features))
+        if wireProtocol.FEATURE_FRAMED in data.features:
+            data.outbox.append(wireProtocol.FRAME_START_MESSAGE, keep=True)#last legacy message, everything after it is framed
+            data.framed = True
+        self.pushChanges(data, lightModule)#the station starts from the current values
+        self.setStatusRate(data, self.statusRate)
+
+    #PUSH feature: send the state, name and timer that changed since they were last pushed on this connection
+    def pushChanges(self, data, lightModule):
+        if wireProtocol.FEATURE_PUSH not in data.features:
+            return
+        for (field, value, payload, kind) in [
+                ("state", lightModule.actualState, wireProtocol.PUSH_STATE + bytes(lightModule.actualState, 'utf-8'), KIND_PUSHSTATE),
+                ("name", lightModule.actualName, wireProtocol.PUSH_NAME + bytes(lightModule.actualName, 'utf-8'), KIND_PUSHNAME),
+                ("timer", lightModule.actualCurrentTime, wireProtocol.PUSH_TIMER + b"%d" % lightModule.actualCurrentTime, KIND_PUSHTIMER)]:
+            if data.pushed.get(field) != value:
+                self.queueMessage(data, payload, kind)
+                data.pushed[field] = value
+
+    #piui name change commands, full command is CHANGENAME_newName
+    def cmd_changeName(self, data, lightModule, argument):
+        lightModule.changeWifiName(argument.decode('utf-8'))#set the name of the light to the name in the wifi message
+
+    def cmd_confirmNameChange(self, data, lightModule, argument):
+        if lightModule.confirmNameChange(argument) == False:#check whether the light name has been changed
+            self.queueReply(data, REPLY_NAMENOTCHANGED)#confirm that the name has not been changed with the response NAMENOTCHANGED
+        else:
+            self.queueMessage(data, b"NAMECHANGED_"+bytes(lightModule.actualName,'utf-8'), KIND_NAMECHANGED)#confirm that the name has been changed woth the response NAMECHANGED_newName
+
+    #if the piui asks what name the light currently has
+    def cmd_getName(self, data, lightModule, argument):
+        self.queueMessage(data, b"NAMEIS_"+bytes(lightModule.actualName,'utf-8'), KIND_NAMEIS)
+
+    #STATUS feature: the base station sets the rate of the status records, full command is STATUSRATE_<records per second>
+    def cmd_statusRate(self, data, lightModule, argument):
+        try:
+            rate = float(argument)
+        except ValueError:
+            rate = math.nan
+        if not math.isfinite(rate):#inf or nan would break the status deadline
+            print("    bad status rate", repr(argument), "from connection", data.connid)
+            return
+        self.setStatusRate(data, rate)
+
+    def cmd_resetTimer(self, data, lightModule, argument):
+        lightModule.resetTimerRequested = True
+
+    #HEARTBEAT feature: the base station checks that the light module is alive
+    def cmd_ping(self, data, lightModule, argument):
+        self.queueMessage(data, wireProtocol.PONG, "PONG", keep=True)
+
+    def cmd_pong(self, data, lightModule, argument):
+        pass#receiving anything already counts as a sign of life, see lastReceived
+
+    #queue a message (without the ";") to be sent to the base station, in the encoding used by the connection
+    #kind is one of the KIND_ constants if a newer message of the same kind makes this one useless
+    #a reply to a command with a correlation id gets the id (CORRID feature) and is never replaced, it answers that one request
+    #keep=True for messages the outbox must never drop when it is full: correlated replies (a pipelined request would go
+    #unanswered) and the negotiation and heartbeat messages (losing one breaks the protocol for the rest of the connection)
+    def queueMessage(self, data, payload, kind=None, keep=False):
+        if data.correlation is not None:
+            payload = wireProtocol.withCorrelation(payload, data.correlation)
+            kind = None
+            keep = True
+        if data.framed:
+            data.outbox.append(wireProtocol.encodeFrame(payload), kind, keep)
+        else:
+            data.outbox.append(wireProtocol.encodeLegacy(payload), kind, keep)
+
+    #queue one of the REPLY_ constants, which are already encoded
+    def queueReply(self, data, reply):
+        if data.correlation is not None:
+            self.queueMessage(data, reply.payload)
+        elif data.framed:
+            data.outbox.append(reply.framed, reply.kind)
+        else:
+            data.outbox.append(reply.legacy, reply.kind)
+
+    #connect state and reconnection counters of a light module, see connectionManager
+    def connectionStats(self, connid=1):
+        return self.connections[connid].stats()
+
+    #metrics of the outgoing queue of a light module: messages waiting, the most that have waited,
+    #and how many were dropped (queue full) or replaced by a newer message of the same kind
+    def outboxStats(self, connid=1):
+        box = self.connData[connid].outbox
+        return {"depth": len(box), "maxDepth": box.maxDepth, "dropped": box.dropped, "coalesced": box.coalesced}
+
+    #read everything the socket has (at most self.maxRead bytes)
+    #returns [list of chunks read, True if the base station has disconnected]
+    def readSocket(self, sock):
+        chunks = []
+        total = 0
+        while total < self.maxRead:
+            try:
+                chunk = sock.recv(4096)
+            except BlockingIOError:
+                break #nothing more to read for now
+            except OSError:
+                return [chunks, True] #if read failed then it is disconnected from base station
+            if not chunk:
+                return [chunks, True] #an empty read means the base station has closed the connection
+            chunks.append(chunk)
+            total += len(chunk)
+        return [chunks, False]
+
+    def service_connection(self, key, mask):
+        sock = key.fileobj
+        data = key.data
+        lightModule = self.lightModuleDict[data.connid]
+
+        #a connecting socket becomes ready when the connect has finished
+        if self.connections[data.connid].state == connectionManager.CONNECTING:
+            if not self.finishConnect(data):
+                return
+
         #receiving data
         if mask & selectors.EVENT_READ:
-            try: 
-                #split the incoming messages based on the semicolon delimeter and put them into a list
-                recv_data_list = sock.recv(1024).split(b";")  # Should be ready to read
-            except:
-                recv_data_list = False #if read failed then it is disconnected from base station
-
-            if recv_data_list==False or len(recv_data_list) == 1:# if it's False or only [b''] then the base station has disconnected
-                recv_data_list = False
-            
-            if recv_data_list:
-                for recv_data in recv_data_list:#for each incoming message separated by a ";"
-                    print("    received", repr(recv_data), "from connection", data.connid)
-                    #data.recv_total += len(recv_data)
-                    
-                    #if the base station receives confirmation that the base station knows the light has been triggered off
-                    #reset all the relevant trigger variables (except for lightModule.motionHappening, which might still be True) so that
-                    #the pi0 stops telling the base station the light has been triggered off
-                    if (recv_data == b"TRIGGEROFFCONFIRMED"):
-                        lightModule.triggerMessageSent = False
-                        lightModule.lightTriggeredOff = "NO"
-                        #note that there is an extremely slim chance that this TRIGGEREDOFFCONFIRMED is actually from a previous off cycle of the light,
-                        #but this is not that important right now since the pi0 will still call the above triggered message at least once for this base station cycle
-
-                    #if the piui requests the light changes state
-                    if (recv_data == b"CHANGE STATE"):
-                        if lightModule.lightTriggeredOff == "TIMER":
-                            pass#the user cannot change the light state if this is the exact moment the timer has triggered to be off, and the wifi is currently processing the timer trigger
-                        elif lightModule.motionHappening == True:
-                            #if there is motion currently being detected, then don't turn the light on and inform the base station (Note that
-                            # we will not confirm that the base station received this because the base station should already know the light is off)
-                            data.messages += [b";MOTIONTRIGGERED"]
-                        else:
-                            #otherwise turn the light on or off
-                            lightModule.changeWifiState()
-
-                    '''THIS IS OLD AND NO LONGER NEEDED, we must now only change wifiState and then only confirm the light is on when it has actually been turned on
-                    #ACTUALLY NEVERMIND SOMETHING LIKE THIS IS GOOD TO HAVE AS SOON AS THE STATE IS CHANGED...
-                    if lightModule.wifiState == "OFF":
-                        data.messages += [b"TURNED OFF"]
-                    else:
-                        data.messages += [b"TURNED ON"]
-                    '''
-                    #if the piui requests to confirm whether the light has changed state
-                    if (recv_data == b"CONFIRM STATE"):
-                        stateConfirmation = lightModule.confirmState()
-                        if stateConfirmation[0] == False:#if the light has not yet changed state
-                            if stateConfirmation[1] == "ON":
-                                data.messages += [b";STATENOTCHANGED_ON"]#if the light is on
-                            else:
-                                data.messages += [b";STATENOTCHANGED_OFF"]#if the light is off
-                        else:#if the light has successfully changed state
-                            if stateConfirmation[1] == "ON":
-                                data.messages += [b";STATECHANGED_ON"]
-                            else:
-                                data.messages += [b";STATECHANGED_OFF"]
-                    #if the piui asks what state the light is currently in
-                    if (recv_data == b"GET STATE"):
-                        if lightModule.motionHappening == True:
-                            #if there is motion currently being detected, then inform the base station
-                            data.messages += [b";MOTIONTRIGGERED"]
-                        elif lightModule.actualState == "ON":#if the light is send a message to the piui saying such, and vice versa
-                            data.messages += [b";STATEIS_ON"]
-                        elif lightModule.actualState == "OFF":
-                            data.messages += [b";STATEIS_OFF"]
-                    #the piui tells the light module that it has successfully connected wifi
-                    if (recv_data == b"CONNECTED"):
-                        lightModule.connect()
-
-                    #piui name change commands#ADD IN FOR GET NAME COMMAND DDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDDD
-                    if (isinstance(recv_data, bytes) and len(recv_data)>7 and recv_data[0:7] == b"CHANGEN"):#full command is CHANGENAME_newName
-                        lightModule.changeWifiName(recv_data[11:].decode('utf-8'))#set the name of the light to the name in the wifi message
-                    if (recv_data==b'CONFIRMNAMECHANGE'):#full command is CONFIRMCHANGENAME
-                        if lightModule.confirmNameChange(recv_data[17:]) == False:#check whether the light name has been changed
-                            data.messages += [b";NAMENOTCHANGED"]#confirm that the name has not been changed with the response NAMENOTCHANGED
-                        else:
-                            data.messages += [b";NAMECHANGED_"+bytes(lightModule.actualName,'utf-8')]#confirm that the name has been changed woth the response NAMECHANGED_newName
-                    #if the piui asks what name the light currently has
-                    if (recv_data == b"GETNAME"):
-                        data.messages += [b";NAMEIS_"+bytes(lightModule.actualName,'utf-8')]
-
-                    if (recv_data == b"RESETTIMER"):
-                        lightModule.resetTimerRequested = True
-
-            if not recv_data_list: #or data.recv_total == data.msg_total: #if it gets disconnected from the base station
-                print("    closing socket", data.connid)
-                self.sel.unregister(sock)
-                sock.close()
-                lightModule.disconnect()#properly disconnect the light module socket
+            self.readEvents += 1
+            [chunks, disconnected] = self.readSocket(sock)
+            if chunks:
+                data.lastReceived = self.clock.time()
+            for chunk in chunks:
+                #the parser splits legacy messages on the ";" delimiter and reassembles messages and frames split across reads
+                for (msgType, recv_data) in data.parser.feed(chunk, data.lastReceived):
+                    if msgType == wireProtocol.MSG_TEXT:
+                        self.processMessage(data, lightModule, recv_data)
+
+            if disconnected: #or data.recv_total == data.msg_total: #if it gets disconnected from the base station
                 #self.lightModuleDict.pop(data.connid)#we are no elimintating the light module when the base station gets disconnected
-                self.attemptReconnection(data.connid)#attempt to reconnect the light module
-        
-        #if the current light module has passed 2 seconds since attempting to connect to base station without response, reattempt connection
-        #nevermind... the below if statement should not be used
-        #if not data.messages:#must check to make sure that no incoming messages were just received
-
-        #if the light is currently disconnected and the last attempt to connect was greater than 2 seconds ago...
-        if (lightModule.connectionStatus == "NOTYETCONNECTED" or lightModule.connectionStatus == "DISCONNECTED") and time.time()-lightModule.lastConnectionAttemptTime > 2:
-            print("    closing socket", data.connid)
-            self.sel.unregister(sock)
-            sock.close()
-            lightModule.disconnect()#properly disconnect the light module socket
-            self.attemptReconnection(data.connid)
+                self.connectionFailed(data)#reconnect the light module after a backoff
+                return
 
         if mask & selectors.EVENT_WRITE and lightModule.connectionStatus == "CONNECTED":
-            if not data.outb and data.messages:
-                data.outb = data.messages.pop(0)
-            if data.outb:
-                print("    sending", repr(data.outb), "to connection", data.connid)
-                sent = sock.send(data.outb)  # Should be ready to write
-                data.outb = data.outb[sent:]
+            if data.outbox:
+                print("    sending", data.outbox.peek(), "to connection", data.connid)
+                try:
+                    data.outbox.flush(sock)#all the queued messages in one sendmsg() call
+                except OSError:
+                    self.connectionFailed(data)#the base station has gone away
+                    return
+
+        self.updateInterest(data)#add write interest for the replies just queued, or drop it once everything is sent
+
+    #offline mode: hand messages from the simulated base station to a light module, as if they had been received
+    def receive(self, connid, recv_data_list):
+        data = self.connData[connid]
+        self.readEvents += 1
+        data.lastReceived = self.clock.time()
+        for recv_data in recv_data_list:
+            self.processMessage(data, self.lightModuleDict[connid], recv_data)
+
+    #offline mode: returns (and clears) the messages the light module has sent to the base station
+    def takeMessages(self, connid):
+        data = self.connData[connid]
+        if self.lightModuleDict[connid].connectionStatus != "CONNECTED":
+            return []
+        return data.outbox.take()
     '''
-    This function returns the state of the light wifi command in the light dict with the highest connID on this pi0
-    (obviously there would be usually only 1 light module for a given pi0... but this format is useful for testing)
-
-    ####################################
-    ACTUALLY SHOULD CHANGE IT TO WORK WITH THE LIGHT OF CONNID=1 FOR SIMPLICITY
-    ####################################
+    This function returns the state of the light wifi command of the light with the given connid on this pi0
+    (connid 1, the first light, by default; usually there is only 1 light module for a given pi0)
 
     Outputs:
-        - None if there are no light modules initialized
+        - None if there is no light module with this connid
         - State if there is a light module, a list with the following elements in order: 
             -"CONNECTED"/"NOTYETCONNECTED"/"DISCONNECTED"
             -"ON"/"OFF" (None if not yet changed by piui ##### actually no. Now it is always either on/off; at the beginning it matches what the light starts as)
@@ -353,7 +728,7 @@ class wifiCommunicator():
 
     Note that we have not dealt with the edge case of the piui disconnecting... ie ["DISCONNECTED", "ON"]
     ''' 
-    def getState(self):#REMAKE THIS FUNCTION BASED ON THE NEW LIGHTMODULE MODIFICATIONS
+    def getState(self, connid=1):#REMAKE THIS FUNCTION BASED ON THE NEW LIGHTMODULE MODIFICATIONS
         '''
         state = None
         highestConnID = -1
@@ -367,14 +742,22 @@ class wifiCommunicator():
                     state = ["CONNECTED", "OFF", lightModule.wifiName]
 
         '''
-        if 1 not in self.lightModuleDict:
+        lightModule = self.lightModuleDict.get(connid)
+        if lightModule is None:
             return None
-        lightModule = self.lightModuleDict[1]
         if lightModule.resetTimerRequested == False:
             return [lightModule.connectionStatus, lightModule.wifiState, lightModule.wifiName, False]
         else:
             lightModule.resetTimerRequested = False
             return [lightModule.connectionStatus, lightModule.wifiState, lightModule.wifiName, True]
+
+    #the getState() of every light in one pass, as a dict connid -> state list (resetTimer is cleared like in getState)
+    def snapshot(self):
+        states = {}
+        for connid, lightModule in self.lightModuleDict.items():
+            states[connid] = [lightModule.connectionStatus, lightModule.wifiState, lightModule.wifiName, lightModule.resetTimerRequested]
+            lightModule.resetTimerRequested = False
+        return states
     
     '''
     Tells the wifiCommunicator class about the actual state of the light
@@ -384,17 +767,19 @@ class wifiCommunicator():
     Input parameters:
         -stateInput: "ON"/"OFF"
         -nameInput (string)
-        -currentTime
+        -currentTime: seconds left on the timer of the light (-1 if no timer is set), None if not known
         -context ("IDLE"/"MOTION"/"TIMER"/"ON")
+        -connid: the light this is about (1, the first light, by default)
+        -distance: the last distance (cm) measured, None if not known (sent in the status records)
     where nameOfLight is the name of the light, currentTime is the currentTime the light has been on for, and 
     triggeredOFF is boolean whether the motion sensor has been triggered
     '''
-    def confirmState(self, stateInput, nameInput, currentTime, context):#REMAKE THIS FUNCTION BASED ON THE NEW LIGHTMODULE MODIFICATIONS
+    def confirmState(self, stateInput, nameInput, currentTime, context, connid=1, distance=None):#REMAKE THIS FUNCTION BASED ON THE NEW LIGHTMODULE MODIFICATIONS
         #something along the lines of self.actualLightState = actualLightState
-        if 1 not in self.lightModuleDict:#check if the light modules have been initialized yet
+        if connid not in self.lightModuleDict:#check if the light modules have been initialized yet
             return None
         else:
-            lightModule = self.lightModuleDict[1]
+            lightModule = self.lightModuleDict[connid]
             if stateInput == "ON":#set the light module's actual state to match what the main loop program on the pi0 is saying
                 lightModule.changeActualState("ON")
                 lightModule.lightTriggeredOff = "NO"#the light is no longer being triggered to be off
@@ -409,10 +794,22 @@ class wifiCommunicator():
                 elif context == "TIMER":
                     lightModule.triggerLightOff("TIMER")#the light has been triggered to turn off by the timer
             lightModule.changeActualName(nameInput)#set the light module's actual name to match what the main loop program is saying            
-
-    def checkWifi(self):
+            if currentTime is not None:
+                lightModule.actualCurrentTime = int(currentTime)
+            lightModule.context = context
+            if distance is not None:
+                lightModule.distance = distance
+            if connid in self.connData:
+                self.pushChanges(self.connData[connid], lightModule)
+
+    #timeout is the longest time (s) to wait for the base station; 0 only services what is already ready
+    def checkWifi(self, timeout=1):
         try:
-            events = self.sel.select(timeout=1)
+            for connid in list(self.connData):
+                self.housekeeping(self.connData[connid])
+            if self.offline:
+                return
+            events = self.sel.select(timeout=timeout)
             if events:
                 for key, mask in events:
                     self.service_connection(key, mask)
@@ -421,3 +818,48 @@ class wifiCommunicator():
                 return
         except KeyboardInterrupt:
             print("    caught keyboard interrupt, exiting")
+
+
+#more requests than the outbox bound, pipelined in one write, must all be answered (CORRID feature)
+def test_pipelinedRequests(count=100):
+    import contextlib
+    import io
+    with contextlib.redirect_stdout(io.StringIO()):
+        wifi = wifiCommunicator(selectors.DefaultSelector(), ["ON", "lamp", 0], clock=simClock.virtualClock(), offline=True)
+        wifi.receive(1, [b"CONNECTED", wireProtocol.helloAckMessage(wifi.features)])
+        wifi.takeMessages(1)
+        data = wifi.connData[1]
+        chunk = b"".join([wireProtocol.encodeFrame(b"GET STATE@%d" % i) for i in range(0, count)])
+        wifi.receive(1, [message for (msgType, message) in data.parser.feed(wireProtocol.FRAME_START_MESSAGE + chunk)])
+    parser = wireProtocol.streamParser()
+    parser.framed = True
+    replies = [message for (msgType, message) in parser.feed(b"".join(wifi.takeMessages(1))) if b"@" in message]
+    if replies != [b"STATEIS_ON@%d" % i for i in range(0, count)] or wifi.outboxStats()["dropped"] != 0:
+        print("Error. Pipelined replies:", len(replies), "of", count, wifi.outboxStats())
+        return False
+    print("pipelined requests OK")
+    return True
+
+
+#the base station cannot make the status records due all the time (STATUS feature)
+def test_statusRate():
+    import contextlib
+    import io
+    with contextlib.redirect_stdout(io.StringIO()):
+        wifi = wifiCommunicator(selectors.DefaultSelector(), ["ON", "lamp", 0], clock=simClock.virtualClock(), offline=True)
+        wifi.receive(1, [b"CONNECTED", wireProtocol.helloAckMessage(wifi.features)])
+        data = wifi.connData[1]
+        periods = []
+        for rate in [b"2", b"inf", b"nan", b"-inf", b"1e9", b"x", b"0"]:
+            wifi.receive(1, [wireProtocol.STATUS_RATE + rate])
+            periods.append(data.statusPeriod)
+    if periods != [0.5, 0.5, 0.5, 0.5, 1.0 / wireProtocol.MAX_STATUS_RATE, 1.0 / wireProtocol.MAX_STATUS_RATE, None]:
+        print("Error. Status periods:", periods)
+        return False
+    print("status rate OK")
+    return True
+
+
+if __name__ == "__main__":
+    test_pipelinedRequests()
+    test_statusRate()
@@ -0,0 +1,379 @@
+'''Background sampling of the ultrasonic rangers.
+
+A rangeSampler thread reads every ranger (anything with get_distance(), eg. a GroveUltrasonicRanger) over and
+over and keeps the last samples of each in a ringBuffer. After every round it publishes the filtered distance,
+so the control cycle gets the latest value with one attribute read instead of waiting for 30 echoes:
+
+    sampler = rangeSampler([ranger0, ranger1, ranger2])
+    sampler.start()
+    distance = sampler.latest()     # None until the first round is done, latest(timeout) waits for full buffers
+    sampler.stop()
+
+With a tracker (distanceTracker) every round also updates a Kalman filter across the rangers, whose distance
+follows a surface that moves between the scans of the controller.
+
+A concurrentScanner reads the rangers at the same time on a small thread pool, each ranger a little later than
+the one before (stagger) so one ranger does not hear the ping of another. A scan then takes about the time of
+one ranger's readings instead of the sum of all three. The results are merged as each ranger finishes, a ranger
+that has not answered within the timeout is left out of that scan. Can be used on its own or for the rounds of
+a rangeSampler:
+
+    scanner = concurrentScanner([ranger0, ranger1, ranger2])
+    distance = scanner.scan(samples=10)
+    sampler = rangeSampler(scanner.rangers, scanner=scanner)
+
+fixedScan() is the scan of the blocking getReadings(): samples rounds of every ranger. sequentialScan() reads
+round after round and stops as soon as the 95% confidence interval of the distance is narrower than +- tolerance
+(at least minSamples, at most maxSamples rounds), so steady readings take 3 rounds instead of 10:
+
+    distance, samples = sequentialScan([ranger0, ranger1, ranger2], tolerance=1)   # cm for Grove rangers
+
+Note the Grove driver times the echo in Python, so on a loaded single core Pi a reading can be delayed by the
+other threads; compare with scans of one ranger after the other (stagger and timeout are there to tune this) before relying on it.
+'''
+import math
+import threading
+import time
+import concurrent.futures
+
+BUFFER_SIZE = 10    # samples kept per ranger (the blocking getReadings() took 10)
+INTERVAL = 0.05     # s of rest between two rounds, the rangers busy-wait for their echo
+STAGGER = 0.005     # s between the starts of two rangers in a concurrent scan
+SCAN_TIMEOUT = 1    # s a concurrent scan waits for the rangers
+MIN_SAMPLES = 3     # rounds a sequential scan always reads
+TOLERANCE = 0.01    # half width of the confidence interval a sequential scan stops at, in the unit of the readings (1 cm in m)
+
+# 0.975 quantiles of Student's t distribution for 1 to 30 degrees of freedom (95% two sided confidence intervals)
+T_QUANTILES = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160, 2.145,
+               2.131, 2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048,
+               2.045, 2.042]
+
+
+class ringBuffer:
+    '''The last size samples of one ranger. Written by the sampler thread only and read by any thread without a
+    lock: a sample is stored in its slot before written is advanced (one assignment, atomic under the GIL),
+    so readers never see a slot that has not been filled.'''
+    def __init__(self, size=BUFFER_SIZE):
+        self.size = size
+        self.slots = [0.0] * size
+        self.written = 0    # samples written so far, sample n is in slot n % size
+
+    def __len__(self):
+        return min(self.written, self.size)
+
+    def append(self, value):
+        self.slots[self.written % self.size] = value
+        self.written += 1
+
+    def latest(self):
+        # The last sample, None if there is none
+        if self.written == 0:
+            return None
+        return self.slots[(self.written - 1) % self.size]
+
+    def values(self):
+        # The samples held, oldest first
+        written = self.written
+        if written < self.size:
+            return self.slots[0:written]
+        start = written % self.size
+        return self.slots[start:] + self.slots[0:start]
+
+
+def meanOfMeans(buffers):
+    # The filter of the blocking getReadings(): the mean of each ranger, then the mean of those
+    means = [sum(buffer.values()) / len(buffer) for buffer in buffers if len(buffer)]
+    if not means:
+        return None
+    return sum(means) / len(means)
+
+
+def tQuantile(dof):
+    # Multiplier of the standard error for a 95% confidence interval estimated with dof degrees of freedom
+    if dof < 1:
+        return math.inf
+    if dof > len(T_QUANTILES):
+        return 1.96
+    return T_QUANTILES[dof - 1]
+
+
+def fixedScan(rangers, samples=BUFFER_SIZE, estimator=meanOfMeans):
+    # samples readings of every ranger, one round after the other, returns the estimate of them
+    buffers = [ringBuffer(samples) for ranger in rangers]
+    for i in range(0, samples):
+        for (ranger, buffer) in zip(rangers, buffers):
+            buffer.append(ranger.get_distance())
+    return estimator(buffers)
+
+
+def sequentialScan(rangers, tolerance=TOLERANCE, maxSamples=BUFFER_SIZE, minSamples=MIN_SAMPLES):
+    # Reads rounds of every ranger until the 95% confidence interval of the mean of the rounds is within
+    # +- tolerance or maxSamples rounds are read. Returns (distance, rounds read), the distance being the mean of
+    # means like fixedScan(). The variance of the round means is kept with Welford's update, so a round costs O(1)
+    count = 0
+    mean = 0.0
+    squares = 0.0   # sum of squared differences from the mean
+    while count < maxSamples:
+        value = sum([ranger.get_distance() for ranger in rangers]) / len(rangers)
+        count += 1
+        delta = value - mean
+        mean += delta / count
+        squares += delta * (value - mean)
+        if count >= minSamples and tQuantile(count - 1) * math.sqrt(squares / (count - 1) / count) <= tolerance:
+            break
+    return (mean, count)
+
+
+class concurrentScanner:
+    def __init__(self, rangers, stagger=STAGGER, timeout=SCAN_TIMEOUT, estimator=meanOfMeans):
+        self.rangers = rangers
+        self.stagger = stagger
+        self.timeout = timeout
+        self.estimator = estimator
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(rangers), thread_name_prefix="ranger")
+        self.late = 0   # rangers left out of a scan because they did not answer in time
+
+    def readRanger(self, ranger, samples, delay):
+        if delay > 0:
+            time.sleep(delay)
+        return [ranger.get_distance() for i in range(0, samples)]
+
+    def scan(self, samples=BUFFER_SIZE, buffers=None):
+        # Reads samples times every ranger, the ranger i starting i * stagger s after the first. The readings are
+        # added to buffers (one ringBuffer per ranger, new ones if None) as each ranger finishes, returns the
+        # estimate of the buffers (None if no ranger answered)
+        if buffers is None:
+            buffers = [ringBuffer(max(samples, 1)) for ranger in self.rangers]
+        futures = {}
+        for (i, ranger) in enumerate(self.rangers):
+            futures[self.pool.submit(self.readRanger, ranger, samples, i * self.stagger)] = buffers[i]
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout=self.timeout):
+                for value in future.result():
+                    futures[future].append(value)
+        except concurrent.futures.TimeoutError:
+            self.late += len([future for future in futures if not future.done()])
+        return self.estimator(buffers)
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+class rangeSampler(threading.Thread):
+    # estimator(buffers) turns the ring buffers into one distance
+    # scanner: a concurrentScanner to read the rangers of a round at the same time, None to read them one by one
+    # tracker: a distanceTracker fed with the readings of every round (None for a ranger that gave none)
+    def __init__(self, rangers, size=BUFFER_SIZE, interval=INTERVAL, estimator=meanOfMeans, scanner=None, tracker=None):
+        threading.Thread.__init__(self, name="rangeSampler", daemon=True)
+        self.rangers = rangers
+        self.buffers = [ringBuffer(size) for ranger in rangers]
+        self.interval = interval
+        self.estimator = estimator
+        self.scanner = scanner
+        self.tracker = tracker
+        self.filtered = None    # (distance, time.time() of the round it was computed after), replaced after every round
+        self.rounds = 0
+        self.fresh = 0      # rounds since the sampler was (re)started
+        self.ready = threading.Event()      # set once every buffer is full of readings taken since the last resume
+        self.sampling = threading.Event()   # cleared while paused
+        self.sampling.set()
+        self.stopping = threading.Event()
+        # Held for every round: the echoes of rangers read at the same time interfere, so a foreground scan of the
+        # same rangers takes it too
+        self.rangerLock = threading.Lock()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.sampling.wait()
+            if self.stopping.is_set():
+                break
+            with self.rangerLock:
+                written = [buffer.written for buffer in self.buffers]
+                if self.scanner is not None:
+                    self.scanner.scan(1, self.buffers)
+                else:
+                    for (ranger, buffer) in zip(self.rangers, self.buffers):
+                        buffer.append(ranger.get_distance())
+            self.filtered = (self.estimator(self.buffers), time.time())
+            if self.tracker is not None:
+                self.tracker.update([buffer.latest() if buffer.written > before else None
+                                     for (buffer, before) in zip(self.buffers, written)], self.filtered[1])
+            self.rounds += 1
+            self.fresh += 1
+            if self.fresh >= self.buffers[0].size:
+                self.ready.set()
+            self.stopping.wait(self.interval)
+
+    def pause(self):
+        # Stops sampling after the current round (every reading busy-waits for an echo, so an idle module does not
+        # sample). The tracker keeps its state
+        self.sampling.clear()
+
+    def resume(self):
+        # Samples again. The old readings are stale: latest(timeout) waits for buffers full of new ones
+        if self.sampling.is_set():
+            return
+        self.ready.clear()
+        self.filtered = None
+        self.fresh = 0
+        self.sampling.set()
+
+    def paused(self):
+        return not self.sampling.is_set()
+
+    def latest(self, timeout=None):
+        # Latest filtered distance, None if there is none yet. With a timeout, first waits up to timeout s for the
+        # buffers to fill, so the first distance is filtered like the later ones
+        if timeout and not self.ready.is_set():
+            self.ready.wait(timeout)
+        filtered = self.filtered
+        if filtered is None:
+            return None
+        return filtered[0]
+
+    def age(self):
+        # s since the latest filtered distance was computed, None if there is none yet
+        filtered = self.filtered
+        if filtered is None:
+            return None
+        return time.time() - filtered[1]
+
+    def stop(self):
+        self.stopping.set()
+        self.sampling.set()
+        if self.is_alive():
+            self.join()
+
+
+def test_ringBuffer():
+    buffer = ringBuffer(4)
+    if buffer.values() != [] or len(buffer) != 0 or buffer.latest() is not None:
+        print("Error. New buffer not empty")
+        return False
+    for i in range(0, 3):
+        buffer.append(i)
+    if buffer.values() != [0, 1, 2]:
+        print("Error. Partly filled buffer:", buffer.values())
+        return False
+    for i in range(3, 10):
+        buffer.append(i)
+    if buffer.values() != [6, 7, 8, 9] or len(buffer) != 4 or buffer.latest() != 9:
+        print("Error. Wrapped buffer:", buffer.values())
+        return False
+    if meanOfMeans([buffer, ringBuffer(4)]) != 7.5:
+        print("Error. Empty buffer counted in the mean")
+        return False
+    print("ringBuffer OK")
+    return True
+
+
+def test_concurrentScanner():
+    class fixedRanger:
+        def __init__(self, value, delay):
+            self.value = value
+            self.delay = delay
+        def get_distance(self):
+            time.sleep(self.delay)
+            return self.value
+
+    # The ranger that does not answer in time is left out, the others are merged
+    scanner = concurrentScanner([fixedRanger(1.0, 0.001), fixedRanger(2.0, 0.001), fixedRanger(9.0, 0.5)], stagger=0, timeout=0.2)
+    buffers = [ringBuffer(3) for ranger in scanner.rangers]
+    distance = scanner.scan(3, buffers)
+    scanner.close()
+    if distance != 1.5 or scanner.late != 1 or [len(buffer) for buffer in buffers] != [3, 3, 0]:
+        print("Error. Late ranger not left out:", distance, scanner.late)
+        return False
+    print("concurrentScanner OK")
+    return True
+
+
+def test_sequentialScan():
+    class listRanger:
+        def __init__(self, values):
+            self.values = list(values)
+        def get_distance(self):
+            return self.values.pop(0)
+
+    # Readings that agree stop after minSamples rounds, scattered ones use the whole budget
+    steady = [listRanger([2.0, 2.001, 1.999] * 4) for i in range(0, 3)]
+    scattered = [listRanger([2.0, 2.3, 1.7, 2.2, 1.8] * 2) for i in range(0, 3)]
+    (distance, samples) = sequentialScan(steady)
+    (scatteredDistance, scatteredSamples) = sequentialScan(scattered)
+    if abs(distance - 2.0) > 1e-9 or samples != MIN_SAMPLES or scatteredSamples != BUFFER_SIZE or abs(scatteredDistance - 2.0) > 1e-9:
+        print("Error. Sequential scan:", distance, samples, scatteredDistance, scatteredSamples)
+        return False
+    if fixedScan([listRanger([1.0] * 10), listRanger([3.0] * 10)]) != 2.0:
+        print("Error. Fixed scan")
+        return False
+    print("sequentialScan OK")
+    return True
+
+
+def test_pause():
+    class countingRanger:
+        def __init__(self):
+            self.reads = 0
+        def get_distance(self):
+            self.reads += 1
+            return 2.0
+
+    # No reads while paused, and after a resume latest(timeout) waits for buffers of new readings
+    rangers = [countingRanger() for i in range(0, 3)]
+    sampler = rangeSampler(rangers, size=3, interval=0.001)
+    sampler.start()
+    if sampler.latest(timeout=1) != 2.0:
+        print("Error. Sampler gave no distance")
+        sampler.stop()
+        return False
+    sampler.pause()
+    with sampler.rangerLock:
+        reads = rangers[0].reads
+    time.sleep(0.05)
+    pausedReads = rangers[0].reads - reads
+    sampler.resume()
+    resumed = sampler.latest(timeout=1)
+    fresh = sampler.fresh
+    sampler.stop()
+    if pausedReads != 0 or resumed != 2.0 or fresh < 3 or sampler.is_alive():
+        print("Error. Paused sampler:", pausedReads, resumed, fresh)
+        return False
+    print("rangeSampler pause OK")
+    return True
+
+
+if __name__ == "__main__":
+    test_ringBuffer()
+    test_concurrentScanner()
+    test_sequentialScan()
+    test_pause()
+
+    # Benchmark: what a control cycle waits for a distance: blocking scan, concurrent scan and the sampler
+    # (rangers 2 m away with the latency of real ones, see Ultrasonic_Test)
+    import Ultrasonic_Test
+    sensor = Ultrasonic_Test.Ultrasonic_sim(0, 1, 2, latency=True)
+    sensor.setDistance(2.0)
+    rangers = [sensor.dist0, sensor.dist1, sensor.dist2]
+    start = time.perf_counter()
+    blocking = fixedScan(rangers)
+    blockingTime = time.perf_counter() - start
+
+    scanner = concurrentScanner(rangers)
+    start = time.perf_counter()
+    concurrentDistance = scanner.scan()
+    concurrentTime = time.perf_counter() - start
+    scanner.close()
+
+    sampler = rangeSampler(rangers)
+    sampler.start()
+    sampler.latest(timeout=1)
+    start = time.perf_counter()
+    for i in range(0, 1000):
+        distance = sampler.latest()
+    samplerTime = (time.perf_counter() - start) / 1000
+    sampler.stop()
+    print("%d readings of each of %d rangers at %.1f m (echo time %.1f ms):" % (
+        BUFFER_SIZE, len(rangers), blocking, 1e3 * Ultrasonic_Test.echoTime(blocking)))
+    print("    blocking scan:   %6.1f ms" % (1e3 * blockingTime))
+    print("    concurrent scan: %6.1f ms (stagger %.0f ms, %.2f m)" % (1e3 * concurrentTime, 1e3 * STAGGER, concurrentDistance))
+    print("    sampler:         %6.4f ms per reading (%.2f m, %d rounds sampled)" % (1e3 * samplerTime, distance, sampler.rounds))
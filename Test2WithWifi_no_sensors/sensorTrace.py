@@ -0,0 +1,249 @@
+'''Recording of the PIR and ultrasonic sensors into a binary trace, and replay of the trace into the simulation.
+
+A trace file is MAGIC, the HEADER and then one 9 byte record per sensor event:
+
+    HEADER = struct "!dd"    start time (s since the epoch), unit of the ranger readings (m per unit)
+    RECORD = struct "!IBf"   time (ms since the start), sensor id, value
+
+The sensor ids are PIR + 0..2 (value 1.0, a detection) and RANGER + 0..2 (value: the reading, in the unit of the
+ranger, CENTIMETRE for the Grove driver). The replay hands the readings on in m, the unit of the simulation.
+The file is only ever appended to: a recorder started on an existing trace keeps its start time and unit, and a
+record cut short by a power loss is ignored by readTrace(). A uint32 of ms covers 49 days of recording. Traces
+of the first format (MAGIC_V1, no unit) were all recorded in cm.
+
+Recording, on the hardware (see test1_smartUV.py --record):
+
+    recorder = traceRecorder("room.trace")
+    sensor = Ultrasonic(13, 19, 12, background=True, recorder=recorder)   # every reading of the three rangers
+    pir = PIR(9, 11, 5, recorder=recorder)                                 # every detection
+    ...
+    recorder.close()
+
+Replay: a traceReplay plays the records on a simClock, one scheduled callback at a time (the trace is streamed,
+hours of readings are not held in memory). Detections go to PIR_sim.setReadings(), readings (converted to m
+with the unit of the header) to Ultrasonic_sim.replayReading(). The speed is that of the clock: virtualClock as fast as possible, realClock 1x,
+scaledClock(N) N times faster. traceReplay.py runs sim_smartUV on a trace.
+'''
+import os
+import struct
+import threading
+import time
+import collections
+
+MAGIC = b"LMTRACE2"
+MAGIC_V1 = b"LMTRACE1"      # first format: HEADER_V1, ranger readings in cm
+HEADER = struct.Struct("!dd")
+HEADER_V1 = struct.Struct("!d")
+
+METRE = 1.0
+CENTIMETRE = 0.01           # unit of GroveUltrasonicRanger.get_distance()
+RECORD = struct.Struct("!IBf")
+
+PIR = 0         # sensor id of PIR sensor 0, + 1 and + 2 for the others
+RANGER = 16     # sensor id of ultrasonic ranger 0
+SENSORS = 3     # of each kind
+
+FLUSH_INTERVAL = 1.0    # s, longest time a record stays in the file buffer
+
+traceRecord = collections.namedtuple("traceRecord", ["time", "sensor", "value"])   # time in s since the start
+traceHeader = collections.namedtuple("traceHeader", ["start", "unit", "size"])   # unit: m per ranger unit, size: bytes
+
+
+class traceRecorder:
+    # unit: m per unit of the ranger readings recorded (CENTIMETRE for the Grove driver)
+    def __init__(self, path, timeSource=time.time, unit=CENTIMETRE):
+        self.path = path
+        self.timeSource = timeSource
+        self.lock = threading.Lock()    # the sensor callbacks and the range sampler record from their own threads
+        self.records = 0
+        exists = os.path.exists(path) and os.path.getsize(path) >= len(MAGIC_V1) + HEADER_V1.size
+        if exists:
+            header = readHeader(path)
+            if header.unit != unit:
+                raise ValueError("%s holds readings in %g m, not %g m" % (path, header.unit, unit))
+            self.start = header.start
+            trimPartial(path)
+        self.file = open(path, "ab")
+        if not exists:
+            self.start = timeSource()
+            self.file.write(MAGIC + HEADER.pack(self.start, unit))
+        self.flushedAt = timeSource()
+
+    def record(self, sensor, value):
+        # Appends one record, stamped now
+        with self.lock:
+            if self.file is None:
+                return
+            now = self.timeSource()
+            self.file.write(RECORD.pack(max(0, int(round((now - self.start) * 1000))), sensor, value))
+            self.records += 1
+            if now - self.flushedAt >= FLUSH_INTERVAL:
+                self.file.flush()
+                self.flushedAt = now
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class recordingRanger:
+    '''Records every reading of a ranger (anything with get_distance()) and hands it on.'''
+    def __init__(self, ranger, recorder, sensor):
+        self.ranger = ranger
+        self.recorder = recorder
+        self.sensor = sensor    # sensor id, RANGER + index
+
+    def get_distance(self):
+        distance = self.ranger.get_distance()
+        self.recorder.record(self.sensor, distance)
+        return distance
+
+
+def readHeader(path):
+    # traceHeader of the trace at path
+    with open(path, "rb") as traceFile:
+        header = traceFile.read(len(MAGIC) + HEADER.size)
+    if header[0:len(MAGIC)] == MAGIC and len(header) == len(MAGIC) + HEADER.size:
+        (start, unit) = HEADER.unpack_from(header, len(MAGIC))
+        return traceHeader(start, unit, len(MAGIC) + HEADER.size)
+    if header[0:len(MAGIC_V1)] == MAGIC_V1 and len(header) >= len(MAGIC_V1) + HEADER_V1.size:
+        return traceHeader(HEADER_V1.unpack_from(header, len(MAGIC_V1))[0], CENTIMETRE, len(MAGIC_V1) + HEADER_V1.size)
+    raise ValueError("%s is not a sensor trace" % path)
+
+
+def trimPartial(path):
+    # Cuts off a record left incomplete by an interrupted recording, so appended records line up again
+    size = os.path.getsize(path)
+    extra = (size - readHeader(path).size) % RECORD.size
+    if extra:
+        with open(path, "r+b") as traceFile:
+            traceFile.truncate(size - extra)
+
+
+def readTrace(path, chunkRecords=4096):
+    # The traceRecords of the trace at path, in file order (a generator, the file is read chunk by chunk).
+    # The readings are in the unit of the header
+    header = readHeader(path)
+    with open(path, "rb") as traceFile:
+        traceFile.seek(header.size)
+        while True:
+            chunk = traceFile.read(chunkRecords * RECORD.size)
+            whole = len(chunk) - len(chunk) % RECORD.size
+            for (ms, sensor, value) in RECORD.iter_unpack(chunk[0:whole]):
+                yield traceRecord(ms / 1000.0, sensor, value)
+            if len(chunk) < chunkRecords * RECORD.size:
+                return
+
+
+def writeTrace(path, records, start=0.0, unit=METRE):
+    # Writes records (traceRecord or (time, sensor, value)) into a new trace, eg. a generated one
+    with open(path, "wb") as traceFile:
+        traceFile.write(MAGIC + HEADER.pack(start, unit))
+        for (when, sensor, value) in records:
+            traceFile.write(RECORD.pack(int(round(when * 1000)), sensor, value))
+
+
+class traceReplay:
+    '''Plays trace records on a simClock into PIR_sim (detections) and Ultrasonic_sim (readings, in m: unit is the
+    m per unit of the records, see readHeader). Only the next record is scheduled at any time; the record at t s
+    is played at start + t of the clock.'''
+    def __init__(self, records, clock, motionSensor=None, distanceSensor=None, start=None, unit=METRE):
+        self.records = iter(records)
+        self.unit = unit
+        self.clock = clock
+        self.motionSensor = motionSensor
+        self.distanceSensor = distanceSensor
+        self.start = start
+        if self.start is None:
+            self.start = clock.time()
+        self.done = False
+        self.lastTime = 0.0     # s into the trace of the last record played
+        # counters
+        self.detections = 0
+        self.readings = 0
+        self.skipped = 0        # records of sensors nothing was given for, or unknown sensor ids
+        self.scheduleNext()
+
+    def scheduleNext(self):
+        record = next(self.records, None)
+        if record is None:
+            self.done = True
+            return
+        self.clock.callAt(self.start + record[0], self.play, record)
+
+    def play(self, record):
+        (when, sensor, value) = record
+        self.lastTime = when
+        if PIR <= sensor < PIR + SENSORS and self.motionSensor is not None:
+            self.motionSensor.setReadings(sensor - PIR)
+            self.detections += 1
+        elif RANGER <= sensor < RANGER + SENSORS and self.distanceSensor is not None:
+            self.distanceSensor.replayReading(sensor - RANGER, value * self.unit)
+            self.readings += 1
+        else:
+            self.skipped += 1
+        self.scheduleNext()
+
+
+def test_sensorTrace():
+    import tempfile
+    import simClock
+    path = os.path.join(tempfile.mkdtemp(), "test.trace")
+    now = [100.0]
+    recorder = traceRecorder(path, timeSource=lambda: now[0])
+    class fixedRanger:
+        def get_distance(self):
+            return 201.5
+    ranger = recordingRanger(fixedRanger(), recorder, RANGER + 2)
+    now[0] = 100.25
+    ranger.get_distance()
+    now[0] = 101.0
+    recorder.record(PIR + 1, 1.0)
+    recorder.close()
+    with open(path, "ab") as traceFile:
+        traceFile.write(b"\x00\x01")     # record cut short
+    recorder = traceRecorder(path, timeSource=lambda: now[0])  # appends after the cut
+    now[0] = 102.0
+    recorder.record(PIR, 1.0)
+    recorder.close()
+    records = list(readTrace(path))
+    if records != [(0.25, RANGER + 2, 201.5), (1.0, PIR + 1, 1.0), (2.0, PIR, 1.0)] or os.path.getsize(path) != len(MAGIC) + HEADER.size + 3 * RECORD.size:
+        print("Error. Trace read back:", records)
+        return False
+    if readHeader(path) != (100.0, CENTIMETRE, len(MAGIC) + HEADER.size):
+        print("Error. Header read back:", readHeader(path))
+        return False
+
+    class motionSink:
+        def __init__(self):
+            self.played = []
+        def setReadings(self, sensor):
+            self.played.append((clock.time(), "motion", sensor))
+        def replayReading(self, ranger, value):
+            self.played.append((clock.time(), ranger, value))
+    clock = simClock.virtualClock(50)
+    sink = motionSink()
+    replay = traceReplay(readTrace(path), clock, sink, sink, unit=readHeader(path).unit)
+    clock.sleep(10)
+    if sink.played != [(50.25, 2, 2.015), (51.0, "motion", 1), (52.0, "motion", 0)] or not replay.done:
+        print("Error. Replay:", sink.played)
+        return False
+
+    # The simulation gets the recorded distance, in m, from a trace in cm and from one in m
+    import Ultrasonic_Test
+    for (unit, reading) in [(CENTIMETRE, 201.5), (METRE, 2.015)]:
+        writeTrace(path, [(0.1, RANGER, reading), (0.2, RANGER + 1, reading)], unit=unit)
+        sensor = Ultrasonic_Test.Ultrasonic_sim(0, 0, 0, clock)
+        traceReplay(readTrace(path), clock, None, sensor, unit=readHeader(path).unit)
+        clock.sleep(1)
+        if abs(sensor.distance - 2.015) > 1e-6:
+            print("Error. Replayed distance %g m for a recorded %g in %g m" % (sensor.distance, reading, unit))
+            return False
+    print("sensorTrace OK")
+    return True
+
+
+if __name__ == "__main__":
+    test_sensorTrace()
@@ -27,7 +27,9 @@
 ##  - Timer.TO:         Timeout flag. True when time=0. Reset to False. 
 
 
+import sys
 import selectors
+import threading
 import RPi.GPIO as GPIO
 import controlLamp
 from time_track_2 import *
@@ -35,6 +37,8 @@ from time_track_2 import *
 from Motion_Sensors_test import *
 from Ultrasonic_Test import *
 import multiconnClientClass2
+import asyncControl
+import asyncWifi
 
 '''
 # State constants
@@ -87,32 +91,67 @@ class sim_smartUV:
         #Declare wifi parameters
         self.wifiName = "defaultName"
         self.wifi = None
+        self.wifiTimeout = 0    ## longest time (s) checkWifi() may block waiting for the base station (main() does the waiting)
+        self.asyncWifi = False  ## True to use asyncWifi.asyncWifiCommunicator (set by asyncControl, needs a running event loop)
+        self.lampLock = threading.Lock()    ## serialises lamp GPIO writes between the control loop and the motion callback
+        self.wakeUp = threading.Event()     ## set by the motion sensor to cut main()'s sleep short
 
         self.setup_GPIO()       # Setup GPIO
 
         # Initialize utility classes with respective GPIO pins
-        self.distanceSensor = Ultrasonic_sim(GPIO_DIST0, GPIO_DIST1, GPIO_DIST2)
+        self.distanceSensor = Ultrasonic_sim(GPIO_DIST0, GPIO_DIST1, GPIO_DIST2, tracking=True)
         self.motionSensor   = PIR_sim(GPIO_PIR0, GPIO_PIR1, GPIO_PIR2)
         self.timer          = TimeTrack()
         self.context        = IDLE
+
+        # Motion turns the lamp off from the sensor callback, without waiting for the next cycle
+        self.motionSensor.setKillSwitch(self.lamp_kill)
     
     def main(self):
         """ Main function to loop through when system is not in IDLE state.
         """
+        self.motionSensor.setListener(self.wakeUp.set)
         while True:
-            self.pre_cycle()    # Check connection and update information from PyUI
-            
-            if (self.state==IDLE):
-                self.state_IDLE()
-            elif (self.state==INITIAL):
-                self.state_INITIAL()
-            elif (self.state==ACTIVE):
-                self.state_ACTIVE()
+            self.cycle()
+            self.wakeUp.wait(self.sleepTime())     # Sleeps 1s, or less if motion is detected
+            self.wakeUp.clear()
 
-            self.post_cycle()   # Confirms state and context with PyUI
-            self.print_state()
-            time.sleep(1)
+        return 0
 
+    def sleepTime(self):
+        """ Time (s) to sleep before the next cycle: 1s, or less if the wifi has a trigger to resend or a connection to retry before then
+        """
+        wait = 1
+        if self.wifi is not None:
+            deadline = self.wifi.deadline()
+            if deadline is not None:
+                wait = max(0, min(wait, deadline - self.wifi.clock.time()))
+        return wait
+
+    def main_async(self):
+        """ Event driven version of main(). Runs a cycle as soon as wifi data, motion or a timer deadline arrives
+            instead of once a second. See asyncControl.py
+        """
+        controller = asyncControl.asyncController(self)
+        controller.run()
+        return 0
+
+    def cycle(self):
+        """ Runs one pass of the state machine.
+        """
+        self.pre_cycle()    # Check connection and update information from PyUI
+        # The rangers are only sampled while the distance is needed
+        self.distanceSensor.setSampling(self.state in (INITIAL, ACTIVE))
+        
+        if (self.state==IDLE):
+            self.state_IDLE()
+        elif (self.state==INITIAL):
+            self.state_INITIAL()
+        elif (self.state==ACTIVE):
+            self.state_ACTIVE()
+
+        self.post_cycle()   # Confirms state and context with PyUI
+        self.print_state()
         return 0
     
     #------------------- Raspberry PI GPIO Functions ----------------------------------#
@@ -133,11 +172,15 @@ class sim_smartUV:
         return True
 
     def lamp_turnOn(self):
-        """ Turns lamp on 
+        """ Turns lamp on, unless motion has been detected since the last pre_cycle
         """
-        GPIO.output(GPIO_lamp, GPIO.HIGH)
+        with self.lampLock:
+            if (self.motionSensor.pending()):
+                print ("Motion detected, lamp stays off")
+                return False
+            GPIO.output(GPIO_lamp, GPIO.HIGH)
+            self.lampON = 1
         print ("Turning lamp ON")
-        self.lampON = 1
         return True
 
     def lamp_turnOff(self):
@@ -148,6 +191,15 @@ class sim_smartUV:
         self.lampON = 0
         return True
         
+    def lamp_kill(self):
+        """ Safety fast path, called from the motion sensor callback. Turns lamp and warning off straight away.
+            lampON is left as is so state_IDLE still pauses the timer on the next cycle.
+        """
+        with self.lampLock:
+            GPIO.output(GPIO_lamp, GPIO.LOW)
+            GPIO.output(GPIO_warning, GPIO.LOW)
+        return True
+
     def warning_turnOn(self):
         """ Turns warning on
         """
@@ -198,12 +250,18 @@ class sim_smartUV:
         """
         State when UV light emitting
         """
+        # Follow the distance while emitting, a moved fixture or cart shows up without a new scan
+        tracked = self.distanceSensor.trackedDistance()
+        if tracked is not None:
+            self.dist = tracked
+
         # check timer 
         self.timer.check()
 
         # Turn on lamp if currently off
         if (self.lampON==0):
-            self.lamp_turnOn()      # Turns lamp off
+            if not self.lamp_turnOn():
+                return 0            # Motion detected, pre_cycle moves to IDLE on the next cycle
             self.warning_turnOn()   # Turns warning off
             self.timer.startTimer()
             self.context = ACTIVE
@@ -234,7 +292,10 @@ class sim_smartUV:
             else:
                 initialStateList = ["OFF", self.wifiName, 0]                
 
-            self.wifi = multiconnClientClass2.wifiCommunicator(sel, initialStateList)
+            if self.asyncWifi:
+                self.wifi = asyncWifi.asyncWifiCommunicator(initialStateList)
+            else:
+                self.wifi = multiconnClientClass2.wifiCommunicator(sel, initialStateList)
             print ("Connected")
 
         if (self.state==IDLE):
@@ -258,7 +319,7 @@ class sim_smartUV:
         #-------------------------------------------#
 
         # Check connection
-        self.wifi.checkWifi() # This updates the internal memory
+        self.wifi.checkWifi(self.wifiTimeout) # This updates the internal memory
 
         # Fetch updated data from checkwifi()
         (Connection, wifiState, self.wifiName, resetTimer) = self.wifi.getState()
@@ -313,10 +374,11 @@ class sim_smartUV:
                 self.context = HUMAN
             
         # self.wifi.confirmState(self.state, self.context)
+        timeLeft = self.timer.timeLeft()  # seconds left on the timer, pushed to the base station
         if self.state == ACTIVE:    
-            self.wifi.confirmState("ON", self.wifiName, None, self.context)
+            self.wifi.confirmState("ON", self.wifiName, timeLeft, self.context, distance=self.dist)
         else:
-            self.wifi.confirmState("OFF", self.wifiName, None, self.context)
+            self.wifi.confirmState("OFF", self.wifiName, timeLeft, self.context, distance=self.dist)
 
         return 0
 
@@ -336,4 +398,7 @@ class sim_smartUV:
 
 if __name__ == "__main__":
     mySmartUV = sim_smartUV()
-    mySmartUV.main()
+    if "--async" in sys.argv:
+        mySmartUV.main_async()
+    else:
+        mySmartUV.main()
@@ -7,45 +7,113 @@ Last modified: October 26, 2020
 '''
 import time 
 from grove_ultrasonic_ranger import *
+import rangeSampler
+import distanceTracker
+import sensorTrace
 
 class Ultrasonic:
-    def __init__(self,pin0,pin1,pin2):
+    # background=True samples the rangers continuously in a rangeSampler thread, getReadings() then returns at once
+    # concurrent=True reads the three rangers at the same time (stagger s apart), see rangeSampler.concurrentScanner
+    # estimator: a distanceEstimator (eg. distanceEstimator.centimetreEstimator(), the driver reads cm) to drop
+    # echo glitches instead of averaging them in, the blocking scan then stops early once the readings agree
+    # sequential=True stops the blocking scan once the distance is known to +- tolerance cm (rangeSampler.sequentialScan)
+    # tracking=True follows the distance with a distanceTracker fed by the background sampler (implies background),
+    # see trackedDistance()
+    # recorder: a sensorTrace.traceRecorder to record every reading of the rangers into
+    def __init__(self,pin0,pin1,pin2,background=False,concurrent=False,stagger=rangeSampler.STAGGER,estimator=None,
+                 sequential=False,tolerance=100*rangeSampler.TOLERANCE,tracking=False,recorder=None):
         self.dist0 = GroveUltrasonicRanger(pin0)
         self.dist1 = GroveUltrasonicRanger(pin1)
         self.dist2 = GroveUltrasonicRanger(pin2)
+        if recorder is not None:
+            self.dist0 = sensorTrace.recordingRanger(self.dist0, recorder, sensorTrace.RANGER + 0)
+            self.dist1 = sensorTrace.recordingRanger(self.dist1, recorder, sensorTrace.RANGER + 1)
+            self.dist2 = sensorTrace.recordingRanger(self.dist2, recorder, sensorTrace.RANGER + 2)
+        self.estimator = estimator
+        self.sequential = sequential
+        self.tolerance = tolerance
+        rangeFilter = rangeSampler.meanOfMeans
+        if estimator is not None:
+            rangeFilter = estimator
+        self.scanner = None
+        if concurrent:
+            self.scanner = rangeSampler.concurrentScanner([self.dist0, self.dist1, self.dist2], stagger, estimator=rangeFilter)
+        self.tracker = None
+        if tracking:
+            self.tracker = distanceTracker.centimetreTracker()
+            background = True
+        self.sampler = None
+        if background:
+            self.sampler = rangeSampler.rangeSampler([self.dist0, self.dist1, self.dist2], estimator=rangeFilter, scanner=self.scanner, tracker=self.tracker)
+            self.sampler.start()
 
     def getReadings(self):
         '''Function called in Main control function.
-        Takes average of readings over a defined time interval. Then averages all readings from all sensors.'''
-        start_time = time.time()
-        #seconds = 0.1 #can change time here
-        i=0
-        dist0_read = []
-        dist1_read = []
-        dist2_read = []
-
-        while True:
-            #elapsed_time = time.time() - start_time
-
-            if i<10: 
-            #elapsed_time < seconds:
-                dist0_read.append(self.dist0.get_distance())
-                dist1_read.append(self.dist1.get_distance())
-                dist2_read.append(self.dist2.get_distance()) 
-            i=i+1
-            if i>10: 
-            #elapsed_time >= seconds:
-                i=0
-                break 
-        #print(dist0_read)
-        #print(dist1_read)
-        #print(dist2_read)
-
-        dist_ave =[sum(dist0_read)/len(dist0_read),sum(dist1_read)/len(dist1_read),sum(dist2_read)/len(dist2_read)]
-        dist_final = sum(dist_ave)/len(dist_ave)
+        Takes average of readings over a defined time interval. Then averages all readings from all sensors.
+        With sequential=True: stops reading once the average is known to +- tolerance (3 to 10 readings).
+        With the background sampler: the latest average of its last 10 readings per sensor (the first call waits
+        until it has them). With an estimator: its robust estimate instead of the average, -1 (out of range for
+        controlLamp) if no sensor gave enough valid readings.'''
+        if self.sampler is not None and not self.sampler.paused():
+            dist_final = self.sampler.latest(timeout=5)
+            if dist_final is not None:
+                print(dist_final)
+                return dist_final
+            print("Range sampler has no readings, scanning")
+        if self.sampler is not None:
+            # The sampler thread must not read the rangers during the scan, their echoes would interfere
+            with self.sampler.rangerLock:
+                return self.scanReadings()
+        return self.scanReadings()
+
+    def scanReadings(self):
+        # Blocking scan of the rangers (see getReadings)
+        if self.scanner is not None:
+            dist_final = self.scanner.scan(10)
+            if dist_final is None:
+                print("No valid distance reading")
+                return -1
+            print(dist_final)
+            return dist_final
+        if self.estimator is not None:
+            result = self.estimator.scan(lambda: [self.dist0.get_distance(), self.dist1.get_distance(), self.dist2.get_distance()])
+            if result.distance is None:
+                print("No valid distance reading")
+                return -1
+            print(result.distance, "(confidence %.2f, %d samples)" % (result.confidence, result.samples))
+            return result.distance
+        if self.sequential:
+            (dist_final, samples) = rangeSampler.sequentialScan([self.dist0, self.dist1, self.dist2], self.tolerance)
+            print(dist_final, "(%d samples)" % samples)
+            return dist_final
+        # 10 readings of each sensor, the average of the three sensor averages
+        dist_final = rangeSampler.fixedScan([self.dist0, self.dist1, self.dist2], 10)
         print(dist_final)
         return dist_final
-        #return  dist_final = mean([mean(dist0_read),mean(dist1_read),mean(dist2_read)])
+
+    def setSampling(self, sampling):
+        # Pauses (False) or resumes (True) the background sampler: it busy-waits for every echo, so it only runs
+        # while the distance is needed
+        if self.sampler is None:
+            return
+        if sampling:
+            self.sampler.resume()
+        else:
+            self.sampler.pause()
+
+    def trackedDistance(self):
+        # Latest tracked distance (O(1), no scan), None without tracking or before the first reading
+        if self.tracker is None:
+            return None
+        return self.tracker.distance
+
+    def close(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+        if self.scanner is not None:
+            self.scanner.close()
+            self.scanner = None
 
 if __name__ == "__main__":
     sonar = Ultrasonic(9,11,5)
@@ -2,35 +2,98 @@
 Status: Complete
 Made by: Bipasha Goyal
 Last modified: 6 November 2020
+
+The detections go through a motionEvents.motionChannel like on the hardware (PIR). inject() fires detections
+from several threads at once for stress tests, python3 Motion_Sensors_test.py runs one.
+sensorTrace.traceReplay replays recorded detections through setReadings().
 '''
 import time
+import threading
 #from grove_mini_pir_motion_sensor import *
+from latencyStats import latencyHistogram
+import simClock
+import motionEvents
 
 class PIR_sim:
-    def __init__(self, pin0, pin1, pin2):
+    def __init__(self, pin0, pin1, pin2, clock=None, holdOff=motionEvents.HOLD_OFF):
         #self.motion0 = GroveMiniPIRMotionSensor(pin0)
         #self.motion1 = GroveMiniPIRMotionSensor(pin1)
         #self.motion2 = GroveMiniPIRMotionSensor(pin2)
 
-        self.motDet = False
+        self.listener = None # called for every queued detection, see setListener
+        self.killSwitch = None # turns the lamp off, see setKillSwitch
+        self.killLatency = latencyHistogram("detection to lamp off")
+        self.clock = clock # simClock used by motionAt, and for the event times
+        if self.clock is None:
+            self.clock = simClock.realClock()
+            self.events = motionEvents.motionChannel(3, holdOff) # detections not read by getReadings yet
+        else:
+            self.events = motionEvents.motionChannel(3, holdOff, timeSource=self.clock.time)
+        self.lastEvents = [] # the detections (time, sensor) the last getReadings returned True for
         #def callback():
         #    self.motDet = True
         #self.motion0.on_detect = callback
         #self.motion1.on_detect = callback
         #self.motion2.on_detect = callback
 
-    def setReadings(self):
-        self.motDet = True
+    def setListener(self, listener):
+        # listener() is called every time a detection is queued (lets the controller wake up without polling)
+        self.listener = listener
+
+    def setKillSwitch(self, killSwitch):
+        # Safety fast path: killSwitch() is called straight from the detection to turn the lamp
+        # and warning off, before the state machine and the wifi are told about the motion.
+        self.killSwitch = killSwitch
+
+    def setReadings(self, sensor=0):
+        # A detection by sensor 0, 1 or 2, same path as the sensor callback of PIR
+        start = time.perf_counter()
+        event = self.events.post(sensor) # queued before the kill so the controller cannot turn the lamp back on in between
+        if self.killSwitch is not None:
+            self.killSwitch() # on every detection, debounced or not
+            self.killLatency.addSince(start)
+        if event is not None and self.listener is not None:
+            self.listener()
+
+    def motionAt(self, when, sensor=0):
+        # Schedules a detection at time when (s) of self.clock
+        self.clock.callAt(when, self.setReadings, sensor)
+
+    def inject(self, count, rate=None, threads=3):
+        # Stress test: count detections from threads threads at once (thread i fires for sensor i % 3), about rate
+        # detections/s in total (as fast as they go if None). Returns once all have been fired
+        def fire(sensor, detections):
+            interval = 0
+            if rate:
+                interval = threads / float(rate)
+            nextAt = time.perf_counter()
+            for i in range(0, detections):
+                self.setReadings(sensor)
+                if interval:
+                    nextAt += interval
+                    wait = nextAt - time.perf_counter()
+                    if wait > 0:
+                        time.sleep(wait)
+        workers = [threading.Thread(target=fire, args=(i % 3, count // threads + (i < count % threads)))
+                   for i in range(0, threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
 
     def getInput(self):
         human = input('Human detected?[Y if true]')
         if human == 'Y':
-            self.motDet = True 
+            self.setReadings()
+
+    def pending(self):
+        # True if motion was detected since the last getReadings
+        return self.events.pending()
 
     def getReadings(self):
         # Need to check with Bipasha why there's a while loop here
-        if (self.motDet):
-            self.motDet = False # clears
+        self.lastEvents = self.events.take() # a detection arriving now is kept for the next call
+        if self.lastEvents:
             return True
         return False
 
@@ -46,3 +109,32 @@ class PIR_sim:
         #        #return False
 
 
+if __name__ == "__main__":
+    # Stress test: detections from three threads while a controller thread waits for them and takes them.
+    # Every detection must end up in exactly one of: taken, merged by the debounce, dropped by a full queue
+    for (holdOff, rate) in [(0, None), (motionEvents.HOLD_OFF, None), (0, 20000)]:
+        pir = PIR_sim(0, 1, 2, holdOff=holdOff)
+        kills = [0]
+        def kill():
+            kills[0] += 1
+        pir.setKillSwitch(kill)
+        taken = []
+        done = threading.Event()
+        def controller():
+            while not done.is_set() or pir.pending():
+                if pir.events.wait(timeout=0.1) and pir.getReadings():
+                    taken.extend(pir.lastEvents)
+        consumer = threading.Thread(target=controller)
+        consumer.start()
+        count = 100000
+        start = time.perf_counter()
+        pir.inject(count, rate)
+        elapsed = time.perf_counter() - start
+        done.set()
+        consumer.join()
+        stats = pir.events.stats()
+        lost = count - len(taken) - stats["debounced"] - stats["dropped"]
+        ordered = all(a.time <= b.time for (a, b) in zip(taken, taken[1:]))
+        print("hold off %.1f s, %s: %d detections in %.2f s (%.0f/s), %d taken, %d debounced, %d dropped, %d lost, kills %d, in order %s" % (
+            holdOff, "as fast as possible" if rate is None else "%d/s" % rate, count, elapsed, count / elapsed,
+            len(taken), stats["debounced"], stats["dropped"], lost, kills[0], ordered))
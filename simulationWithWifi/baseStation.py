@@ -0,0 +1,403 @@
+'''Stand-in for the base station (piui access point) on asyncio, speaking the protocol of wireProtocol.
+
+Each light module that connects gets a moduleSession (an asyncio.Protocol, no task or thread per module, so
+thousands of modules can be connected at once). The station:
+    - sends ;CONNECTED when a module connects and answers its HELLO with the features both sides support,
+    - keeps the last state and name each module reported,
+    - acknowledges trigger notifications (TRIGGEROFFCONFIRMED, or TRIGGEROFFCONFIRMED_<seq> with SEQ),
+    - answers PING with PONG (HEARTBEAT),
+    - keeps the state, name and timer the modules push (PUSH), expectState() waits for a pushed state,
+    - tags its requests with correlation ids when the module has CORRID, so requestMany() can send several
+      requests to a module in one write and match every reply to its request,
+    - keeps the last status record of the modules that stream them (STATUS), see setStatusRate(),
+    - sends the commands of the piui: CHANGE STATE, CONFIRM STATE, GET STATE, CHANGENAME_<name>, CONFIRMNAMECHANGE,
+      GETNAME, RESETTIMER. request() also waits for the reply, which is how round trips are measured.
+freeze() makes the station go silent without closing anything (like a base station that lost power or wifi),
+thaw() drops the frozen connections and lets the modules back in.
+
+Usage from code:
+    station = baseStation("127.0.0.1", 50007)
+    await station.start()
+    reply = await station.request(1, b"GET STATE")     # eg. b"STATEIS_OFF"
+
+Usage from the command line (then point the light modules at this host and port):
+    python3 baseStation.py [--host 0.0.0.0] [--port 50007]
+    and type commands as "<module id or all> <command>", eg. "1 CHANGE STATE", "all GET STATE", or "list".
+'''
+import sys
+import asyncio
+import collections
+import time
+import wireProtocol
+import commandTable
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 50007
+
+# Commands that get a reply, with the beginnings of the messages that answer them
+REPLIES = {
+    b"GET STATE": (b"STATEIS_", b"MOTIONTRIGGERED"),
+    b"CONFIRM STATE": (b"STATECHANGED_", b"STATENOTCHANGED_"),
+    b"GETNAME": (b"NAMEIS_",),
+    b"CONFIRMNAMECHANGE": (b"NAMECHANGED_", b"NAMENOTCHANGED"),
+}
+
+
+class moduleSession(asyncio.Protocol):
+    '''Connection of one light module to the base station.'''
+    def __init__(self, station):
+        self.station = station
+        self.id = None
+        self.transport = None
+        self.parser = wireProtocol.streamParser(complete=self.isWholeMessage)
+        self.features = set()       # features negotiated with the module
+        self.framed = False         # whether the station sends frames to this module
+        self.state = None           # last state the module reported ("ON"/"OFF"), None if unknown
+        self.name = None            # last name the module reported
+        self.triggered = None       # last trigger reported ("MOTION"/"TIMER")
+        self.timer = None           # seconds left on the module's timer (-1: none), as pushed by the module
+        self.pushes = 0             # change notifications received (PUSH)
+        self.stateWaiters = []      # [state, future] waiting for the module to push that state
+        self.status = None          # last wireProtocol.statusRecord from the module (STATUS)
+        self.waiters = collections.deque()  # [reply beginnings, future] of the requests waiting for their reply
+        self.tagged = {}            # correlation id -> future of the request waiting for its reply (CORRID)
+        self.connectedAt = None
+        self.lastSeen = None        # time.time() of the last message from the module
+        self.messagesIn = 0
+
+    def isWholeMessage(self, message):
+        # A legacy message that cannot be the start of a longer one is handed over without waiting (see streamParser).
+        # Legacy messages never carry a correlation id (CORRID is only used with FRAMED)
+        return self.station.messages.isComplete(message)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connectedAt = time.time()
+        self.station.sessionStarted(self)
+        if self.station.frozen:
+            transport.pause_reading()
+            return
+        self.sendLegacy(b"CONNECTED")
+
+    def data_received(self, chunk):
+        self.lastSeen = time.time()
+        loop = asyncio.get_running_loop()
+        self.handleMessages(self.parser.feed(chunk, loop.time()))
+        if self.parser.deadline() is not None:
+            loop.call_at(self.parser.deadline(), self.legacyHoldOver)   # the last legacy message may be complete
+
+    def legacyHoldOver(self):
+        # Nothing has been added to the held legacy message for the hold time, it was complete (see streamParser)
+        if self.transport is None or self.transport.is_closing():
+            return
+        loop = asyncio.get_running_loop()
+        self.handleMessages(self.parser.expired(loop.time()))
+        if self.parser.deadline() is not None:
+            loop.call_at(self.parser.deadline(), self.legacyHoldOver)   # woken before the hold was over
+
+    def handleMessages(self, messages):
+        for (msgType, message) in messages:
+            if msgType == wireProtocol.MSG_TEXT:
+                self.messagesIn += 1
+                self.station.handleMessage(self, message)
+            elif msgType == wireProtocol.MSG_STATUS:
+                self.status = wireProtocol.decodeStatus(message)
+                self.station.statusRecords += 1
+
+    def connection_lost(self, exc):
+        futures = [future for (prefixes, future) in list(self.waiters) + self.stateWaiters] + list(self.tagged.values())
+        for future in futures:
+            if not future.done():
+                future.set_exception(ConnectionError("module %s disconnected" % self.id))
+        self.waiters.clear()
+        self.tagged = {}
+        self.stateWaiters = []
+        self.station.sessionEnded(self)
+
+    def sendLegacy(self, payload):
+        self.transport.write(wireProtocol.encodeLegacy(payload))
+        self.station.messagesOut += 1
+
+    def send(self, payload):
+        self.sendMany([payload])
+
+    def sendMany(self, payloads):
+        # All in one write
+        if self.framed:
+            self.transport.write(b"".join(wireProtocol.encodeFrame(payload) for payload in payloads))
+        else:
+            self.transport.write(b"".join(wireProtocol.encodeLegacy(payload) for payload in payloads))
+        self.station.messagesOut += len(payloads)
+
+    def resolve(self, message, correlation=None):
+        # Hands message to the request it answers: the one with its correlation id, or else the first request
+        # waiting for a reply like it. Returns False if none is waiting
+        if correlation is not None:
+            future = self.tagged.pop(correlation, None)
+            if future is None:
+                return False
+            if not future.done():
+                future.set_result(message)
+            return True
+        for waiter in self.waiters:
+            (prefixes, future) = waiter
+            if message.startswith(prefixes):
+                self.waiters.remove(waiter)
+                if not future.done():
+                    future.set_result(message)
+                return True
+        return False
+
+
+class baseStation:
+    # features: protocol features the station accepts (an empty list acts like an old base station)
+    # autoAck: acknowledge trigger notifications as soon as they arrive
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, features=wireProtocol.SUPPORTED_FEATURES, autoAck=True, backlog=4096):
+        self.host = host
+        self.port = port
+        self.features = set(features)
+        self.autoAck = autoAck
+        self.backlog = backlog
+        self.server = None
+        self.sessions = {}          # module id -> moduleSession of the connected modules
+        self.nextId = 1
+        self.listener = None        # called as listener(session, message) for every message
+        self.frozen = False         # see freeze()
+        self.nextCorrelation = 1
+        # counters
+        self.connects = 0
+        self.disconnects = 0
+        self.messagesOut = 0
+        self.triggers = 0
+        self.statusRecords = 0
+        self.registerMessages()
+
+    async def start(self):
+        self.server = await asyncio.get_running_loop().create_server(
+            lambda: moduleSession(self), self.host, self.port, backlog=self.backlog)
+        self.port = self.server.sockets[0].getsockname()[1]    # the real port when port 0 was asked for
+        return self
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        for session in list(self.sessions.values()):
+            session.transport.close()
+
+    def freeze(self):
+        # Stops reading and answering on every connection, new connections are accepted but never get ;CONNECTED
+        self.frozen = True
+        for session in self.sessions.values():
+            session.transport.pause_reading()
+
+    def thaw(self):
+        # Drops the connections made or frozen while frozen, the modules reconnect normally
+        self.frozen = False
+        for session in list(self.sessions.values()):
+            session.transport.abort()
+
+    def sessionStarted(self, session):
+        session.id = self.nextId
+        self.nextId += 1
+        self.sessions[session.id] = session
+        self.connects += 1
+
+    def sessionEnded(self, session):
+        if self.sessions.get(session.id) is session:
+            del self.sessions[session.id]
+        self.disconnects += 1
+
+    # messages understood from the light modules, see commandTable (handlers get the session and the whole message)
+    def registerMessages(self):
+        self.messages = commandTable.commandTable()
+        self.messages.registerPrefix(wireProtocol.HELLO, self.msg_hello)
+        self.messages.register(wireProtocol.FRAME_START, self.msg_ignore)  # the parser switches to frames by itself
+        self.messages.register(b"MOTIONTRIGGERED", self.msg_triggered)
+        self.messages.register(b"TIMERTRIGGERED", self.msg_triggered)
+        self.messages.registerPrefix(b"MOTIONTRIGGERED_", self.msg_triggeredSeq)
+        self.messages.registerPrefix(b"TIMERTRIGGERED_", self.msg_triggeredSeq)
+        self.messages.registerPrefix(b"STATEIS_", self.msg_state)
+        self.messages.registerPrefix(b"STATECHANGED_", self.msg_state)
+        self.messages.registerPrefix(b"STATENOTCHANGED_", self.msg_state)
+        self.messages.registerPrefix(b"NAMEIS_", self.msg_name)
+        self.messages.registerPrefix(b"NAMECHANGED_", self.msg_name)
+        self.messages.register(b"NAMENOTCHANGED", self.msg_ignore)
+        self.messages.registerPrefix(wireProtocol.PUSH_STATE, self.msg_pushState)
+        self.messages.registerPrefix(wireProtocol.PUSH_NAME, self.msg_pushName)
+        self.messages.registerPrefix(wireProtocol.PUSH_TIMER, self.msg_pushTimer)
+        self.messages.register(wireProtocol.PING, self.msg_ping)
+        self.messages.register(wireProtocol.PONG, self.msg_ignore)
+
+    def handleMessage(self, session, message):
+        correlation = None
+        if wireProtocol.FEATURE_CORRID in session.features:
+            (message, correlation) = wireProtocol.splitCorrelation(message)
+        if not self.messages.dispatch(session, message, message):
+            print("base station: unknown message", repr(message), "from module", session.id)
+        session.resolve(message, correlation)
+        if self.listener is not None:
+            self.listener(session, message)
+
+    def msg_ignore(self, session, message, argument):
+        pass
+
+    def msg_hello(self, session, message, argument):
+        session.features = wireProtocol.usableFeatures(wireProtocol.parseFeatures(message) & self.features)
+        session.sendLegacy(wireProtocol.helloAckMessage(sorted(session.features)))
+        session.transport.write(b";")   # ends the HELLOACK, anything after it is framed if FRAMED was accepted
+        session.framed = wireProtocol.FEATURE_FRAMED in session.features
+
+    def msg_pushState(self, session, message, argument):
+        session.state = argument.decode('utf-8')
+        session.pushes += 1
+        waiting = []
+        for (state, future) in session.stateWaiters:
+            if state == session.state:
+                if not future.done():
+                    future.set_result(state)
+            else:
+                waiting.append([state, future])
+        session.stateWaiters = waiting
+
+    def msg_pushName(self, session, message, argument):
+        session.name = argument.decode('utf-8')
+        session.pushes += 1
+
+    def msg_pushTimer(self, session, message, argument):
+        session.timer = int(argument)
+        session.pushes += 1
+
+    def msg_ping(self, session, message, argument):
+        session.send(wireProtocol.PONG)
+
+    def msg_triggered(self, session, message, argument):
+        session.triggered = message[:-len(b"TRIGGERED")].decode('utf-8')
+        session.state = "OFF"
+        self.triggers += 1
+        if self.autoAck:
+            session.send(b"TRIGGEROFFCONFIRMED")
+
+    def msg_triggeredSeq(self, session, message, argument):
+        session.triggered = message.split(b"TRIGGERED_")[0].decode('utf-8')
+        session.state = "OFF"
+        self.triggers += 1
+        if self.autoAck:
+            session.send(b"TRIGGEROFFCONFIRMED_" + argument)
+
+    def msg_state(self, session, message, argument):
+        session.state = argument.decode('utf-8')
+
+    def msg_name(self, session, message, argument):
+        session.name = argument.decode('utf-8')
+
+    # commands of the piui
+    def send(self, moduleId, command):
+        self.sessions[moduleId].send(command)
+
+    def broadcast(self, command):
+        for session in self.sessions.values():
+            session.send(command)
+
+    def request(self, moduleId, command):
+        # Sends command and returns a future with the module's reply (None right away for commands without reply)
+        return self.requestMany(moduleId, [command])[0]
+
+    def requestMany(self, moduleId, commands):
+        # Sends the commands in one write, returns a future for each (see request). Without CORRID the replies
+        # are matched by their beginning, in order, so only send different commands at once to old modules
+        session = self.sessions[moduleId]
+        futures = []
+        payloads = []
+        for command in commands:
+            future = asyncio.get_running_loop().create_future()
+            if command not in REPLIES:
+                future.set_result(None)
+            elif wireProtocol.FEATURE_CORRID in session.features:
+                correlation = b"%d" % self.nextCorrelation
+                self.nextCorrelation += 1
+                session.tagged[correlation] = future
+                command = wireProtocol.withCorrelation(command, correlation)
+            else:
+                session.waiters.append([REPLIES[command], future])
+            futures.append(future)
+            payloads.append(command)
+        session.sendMany(payloads)
+        return futures
+
+    def expectState(self, moduleId, state):
+        # Future done when the module pushes state ("ON"/"OFF"), needs the PUSH feature (see request() otherwise)
+        session = self.sessions[moduleId]
+        future = asyncio.get_running_loop().create_future()
+        session.stateWaiters.append([state, future])
+        return future
+
+    def setStatusRate(self, moduleId, rate):
+        # Asks the module for rate status records per second (0 stops them), needs the STATUS feature
+        self.send(moduleId, wireProtocol.STATUS_RATE + b"%g" % rate)
+
+    def changeState(self, moduleId):
+        self.send(moduleId, b"CHANGE STATE")
+
+    def changeName(self, moduleId, name):
+        self.send(moduleId, b"CHANGENAME_" + name.encode('utf-8'))
+
+    def resetTimer(self, moduleId):
+        self.send(moduleId, b"RESETTIMER")
+
+    def summary(self):
+        lines = ["%d modules connected (%d connects, %d disconnects, %d triggers)" % (
+            len(self.sessions), self.connects, self.disconnects, self.triggers)]
+        for session in self.sessions.values():
+            lines.append("    %5d  %-21s state=%-4s timer=%-4s name=%s features=%s" % (
+                session.id, "%s:%d" % session.transport.get_extra_info("peername")[0:2], session.state,
+                session.timer, session.name, ",".join(sorted(session.features))))
+        return "\n".join(lines)
+
+
+def consoleCommand(station, line):
+    # "<module id or all> <command>" or "list", returns the text to print
+    line = line.strip()
+    if not line:
+        return ""
+    if line == "list":
+        return station.summary()
+    (target, command) = (line.split(" ", 1) + [""])[0:2]
+    command = command.encode('utf-8')
+    if target == "all":
+        station.broadcast(command)
+        return "sent to %d modules" % len(station.sessions)
+    try:
+        station.send(int(target), command)
+    except (ValueError, KeyError):
+        return "no module %s" % target
+    return ""
+
+
+async def console(host, port):
+    station = await baseStation(host, port).start()
+    station.listener = lambda session, message: print("module %d: %s" % (session.id, message.decode('utf-8', 'replace')))
+    print("base station listening on %s:%d" % (host, station.port))
+    loop = asyncio.get_running_loop()
+    def readLine():
+        line = sys.stdin.readline()
+        if not line:
+            loop.stop()
+            return
+        output = consoleCommand(station, line)
+        if output:
+            print(output)
+    loop.add_reader(sys.stdin.fileno(), readLine)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    host = DEFAULT_HOST
+    port = DEFAULT_PORT
+    if "--host" in sys.argv:
+        host = sys.argv[sys.argv.index("--host") + 1]
+    if "--port" in sys.argv:
+        port = int(sys.argv[sys.argv.index("--port") + 1])
+    try:
+        asyncio.run(console(host, port))
+    except (KeyboardInterrupt, RuntimeError):
+        pass
@@ -0,0 +1,225 @@
+'''Robust distance estimate from the readings of the ultrasonic rangers.
+
+The readings are a samples x sensors array (NaN where a reading is missing). For each sensor:
+    - readings outside validRange are dropped (no echo, ranger too close),
+    - readings further than outlierMads scaled MADs from the sensor's median are dropped (eg. a 5 m multipath
+      echo among 2 m readings, which would push a plain mean out of the 0.5 - 3 m that controlLamp accepts),
+    - the sensor estimate is the median (method "median") or the trimmed mean ("trimmed") of what is left, a
+      sensor with fewer than minValidFraction of its readings left is masked out.
+The distance is the median of the sensors that are not masked out. Its confidence (0 to 1) is the share of valid
+readings times how small the standard error of the distance is against tolerance: 1 for readings that agree
+well within tolerance, falling to 0 as they scatter or get dropped.
+
+The defaults are for readings in m (Ultrasonic_sim), centimetreEstimator() gives one for the cm of the Grove
+driver.
+
+scan() reads round after round and stops as soon as the 95% confidence interval of the distance (from its
+standard error) is within +- maxHalfWidth, so readings that agree take minSamples rounds instead of maxSamples. An estimator is also a rangeSampler estimator (see __call__).
+
+NumPy is imported on first use, the modules importing this one keep working on a Pi without it.
+
+    estimator = distanceEstimator()
+    result = estimator.estimate([[2.01, 2.00, 1.99], [5.10, 2.01, 2.00], [2.00, 2.02, 2.01]])
+    result.distance, result.confidence      # 2.005, 0.87 (the 5.10 is out of validRange, 8 of 9 readings used)
+'''
+import collections
+import math
+import rangeSampler
+
+numpy = None    # set by loadNumpy()
+
+MIN_VALID = 0.02            # m, closer is not a real echo
+MAX_VALID = 4.0             # m, further is the ranger giving up on the echo
+OUTLIER_MADS = 3.5          # readings this many scaled MADs from the sensor median are outliers
+MAD_SCALE = 1.4826          # MAD * MAD_SCALE estimates the standard deviation of normal readings
+RESOLUTION = 0.005          # m, smallest spread taken as real (identical readings have a MAD of 0)
+TOLERANCE = 0.02            # m, standard error at which the confidence is down to about 0.6
+TRIM = 0.2                  # share of readings cut at each end by the trimmed mean
+MIN_VALID_FRACTION = 0.5    # a sensor needs this share of valid readings to count
+MIN_SAMPLES = rangeSampler.MIN_SAMPLES      # rounds scan() always reads
+MAX_SAMPLES = rangeSampler.BUFFER_SIZE      # rounds scan() reads at most (the fixed scan reads 10)
+MAX_HALF_WIDTH = rangeSampler.TOLERANCE     # m, half width of the confidence interval at which scan() stops
+
+distanceEstimate = collections.namedtuple("distanceEstimate", [
+    "distance",     # the estimate, None if no sensor has enough valid readings
+    "confidence",   # 0 to 1
+    "stderr",       # standard error of the distance (inf if unknown)
+    "halfWidth",    # half width of the 95% confidence interval of the distance (inf if unknown)
+    "sensors",      # estimate of each sensor (NaN if masked out)
+    "sensorValid",  # whether each sensor counts
+    "valid",        # samples x sensors mask of the readings used
+    "samples",      # rounds of readings
+])
+
+
+def loadNumpy():
+    global numpy
+    if numpy is None:
+        import numpy as module
+        numpy = module
+    return numpy
+
+
+class distanceEstimator:
+    def __init__(self, method="median", validRange=(MIN_VALID, MAX_VALID), outlierMads=OUTLIER_MADS,
+                 resolution=RESOLUTION, tolerance=TOLERANCE, trim=TRIM, minValidFraction=MIN_VALID_FRACTION,
+                 minSamples=MIN_SAMPLES, maxSamples=MAX_SAMPLES, maxHalfWidth=MAX_HALF_WIDTH):
+        if method not in ("median", "trimmed"):
+            raise ValueError("unknown method %r" % method)
+        self.method = method
+        self.validRange = validRange    # in the unit of the readings, eg. (2, 400) for rangers giving cm
+        self.outlierMads = outlierMads
+        self.resolution = resolution
+        self.tolerance = tolerance
+        self.trim = trim
+        self.minValidFraction = minValidFraction
+        self.minSamples = minSamples
+        self.maxSamples = maxSamples
+        self.maxHalfWidth = maxHalfWidth
+        self.last = None    # distanceEstimate of the last call
+
+    def estimate(self, readings):
+        np = loadNumpy()
+        x = np.array(readings, dtype=float)
+        if x.ndim == 1:
+            x = x[:, np.newaxis]    # one sensor
+        samples = x.shape[0]
+        valid = np.isfinite(x) & (x >= self.validRange[0]) & (x <= self.validRange[1])
+
+        # MAD outlier rejection, per sensor (column)
+        masked = np.where(valid, x, np.nan)
+        with np.errstate(all="ignore"):
+            median = _nanmedian(np, masked)
+            spread = np.maximum(MAD_SCALE * _nanmedian(np, np.abs(masked - median)), self.resolution)
+            valid &= np.abs(x - median) <= self.outlierMads * spread
+        masked = np.where(valid, x, np.nan)
+        counts = valid.sum(axis=0)
+        sensorValid = counts >= max(1, math.ceil(self.minValidFraction * samples))
+
+        with np.errstate(all="ignore"):
+            if self.method == "median":
+                sensors = _nanmedian(np, masked)
+            else:
+                sensors = self.trimmedMean(np, masked, counts)
+        sensors = np.where(sensorValid, sensors, np.nan)
+
+        if not sensorValid.any():
+            self.last = distanceEstimate(None, 0.0, math.inf, math.inf, sensors, sensorValid, valid, samples)
+            return self.last
+        distance = float(np.median(sensors[sensorValid]))
+        used = valid & sensorValid
+        residuals = (x - sensors)[used]    # how far the readings are from their sensor's estimate
+        n = int(used.sum())
+        if n > 1:
+            # spread of the readings around their sensors plus spread between the sensors
+            within = MAD_SCALE * float(np.median(np.abs(residuals))) / math.sqrt(n)
+            between = float(np.std(sensors[sensorValid])) / math.sqrt(int(sensorValid.sum()))
+            stderr = math.hypot(within, between)
+        else:
+            stderr = math.inf
+        share = n / float(x.size)
+        confidence = share * math.exp(-0.5 * (stderr / self.tolerance) ** 2)
+        halfWidth = rangeSampler.tQuantile(n - 1) * stderr
+        self.last = distanceEstimate(distance, confidence, stderr, halfWidth, sensors, sensorValid, valid, samples)
+        return self.last
+
+    def trimmedMean(self, np, masked, counts):
+        # Mean of each column without the trim share at both ends, ignoring NaN (sorted to the end of each column)
+        ordered = np.sort(masked, axis=0)
+        cut = np.floor(self.trim * counts).astype(int)
+        rank = np.arange(masked.shape[0])[:, np.newaxis]
+        keep = (rank >= cut) & (rank < counts - cut)
+        return np.where(keep, ordered, 0.0).sum(axis=0) / np.maximum(keep.sum(axis=0), 1)
+
+    def scan(self, readRound):
+        # readRound() returns one reading per sensor. Reads minSamples rounds, then one more round at a time until
+        # the confidence interval is within +- maxHalfWidth or maxSamples rounds are read. Returns the distanceEstimate
+        rounds = [readRound() for i in range(0, self.minSamples)]
+        result = self.estimate(rounds)
+        while result.halfWidth > self.maxHalfWidth and len(rounds) < self.maxSamples:
+            rounds.append(readRound())
+            result = self.estimate(rounds)
+        return result
+
+    def __call__(self, buffers):
+        # rangeSampler estimator: the distance of the readings in the ring buffers (one per sensor), None if none
+        np = loadNumpy()
+        columns = [buffer.values() for buffer in buffers]
+        x = np.full((max([len(column) for column in columns] + [1]), len(columns)), np.nan)
+        for (i, column) in enumerate(columns):
+            x[len(x) - len(column):, i] = column     # the newest readings line up at the bottom
+        return self.estimate(x).distance
+
+
+def centimetreEstimator(method="median", **options):
+    # A distanceEstimator for readings in cm (GroveUltrasonicRanger.get_distance()), the defaults are in m
+    settings = {"validRange": (100 * MIN_VALID, 100 * MAX_VALID), "resolution": 100 * RESOLUTION, "tolerance": 100 * TOLERANCE,
+                "maxHalfWidth": 100 * MAX_HALF_WIDTH}
+    settings.update(options)
+    return distanceEstimator(method, **settings)
+
+
+def _nanmedian(np, x):
+    # nanmedian of each column, NaN for columns without any value (without the all-NaN warning)
+    result = np.full(x.shape[1], np.nan)
+    some = np.isfinite(x).any(axis=0)
+    if some.any():
+        result[some] = np.nanmedian(x[:, some], axis=0)
+    return result
+
+
+def test_distanceEstimator():
+    import random
+    rng = random.Random(1)
+    readings = [[2.9 + rng.gauss(0, 0.005) for sensor in range(0, 3)] for sample in range(0, 10)]
+    readings[3][1] = 3.9    # multipath echoes, inside validRange
+    readings[6][2] = 3.8
+
+    mean = sum(sum(row) for row in readings) / 30.0
+    for method in ["median", "trimmed"]:
+        result = distanceEstimator(method).estimate(readings)
+        if abs(result.distance - 2.9) > 0.01 or result.valid[3][1] or result.valid[6][2] or result.confidence < 0.8:
+            print("Error. %s: glitch not rejected" % method, result)
+            return False
+    if abs(mean - 2.9) < 0.05:
+        print("Error. The plain mean was expected to be pulled off by the echoes")
+        return False
+
+    # A broken sensor (no echo at all) is masked out, the other two carry the estimate
+    broken = [[2.0, 0.0, 2.01] for sample in range(0, 10)]
+    result = distanceEstimator().estimate(broken)
+    if list(result.sensorValid) != [True, False, True] or abs(result.distance - 2.005) > 1e-9:
+        print("Error. Broken sensor not masked:", result)
+        return False
+
+    # Scattered readings give a low confidence, nothing valid gives no distance
+    scattered = [[2.0 + rng.gauss(0, 0.3) for sensor in range(0, 3)] for sample in range(0, 10)]
+    if distanceEstimator().estimate(scattered).confidence > 0.5 or distanceEstimator().estimate([[9.0, 9.0]]).distance is not None:
+        print("Error. Confidence of bad readings")
+        return False
+
+    # scan() stops early on readings that agree, reads the whole budget on scattered ones
+    estimator = distanceEstimator()
+    agreeing = estimator.scan(lambda: [1.5 + rng.gauss(0, 0.002) for sensor in range(0, 3)])
+    noisy = estimator.scan(lambda: [1.5 + rng.gauss(0, 0.2) for sensor in range(0, 3)])
+    if agreeing.samples != MIN_SAMPLES or noisy.samples != MAX_SAMPLES:
+        print("Error. Samples taken:", agreeing.samples, noisy.samples)
+        return False
+    print("distanceEstimator OK")
+    return True
+
+
+if __name__ == "__main__":
+    test_distanceEstimator()
+
+    # Benchmark: estimates per second of a 10 x 3 array
+    import time
+    estimator = distanceEstimator()
+    readings = [[2.0, 2.01, 1.99]] * 10
+    count = 2000
+    for method in ["median", "trimmed"]:
+        estimator.method = method
+        start = time.perf_counter()
+        for i in range(0, count):
+            estimator.estimate(readings)
+        print("%-7s: %.0f us per estimate" % (method, 1e6 * (time.perf_counter() - start) / count))
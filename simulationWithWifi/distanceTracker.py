@@ -0,0 +1,159 @@
+'''Continuous distance tracking across the three ultrasonic rangers (constant position Kalman filter).
+
+The distance to the surface is modelled as constant, drifting by at most processNoise (m^2 of variance per s).
+Each round of readings (one per sensor, None for a missing one) updates it one reading at a time with the
+scalar Kalman update, each sensor with its own measurement variance. That variance is learnt from the sensor's
+innovations (reading minus predicted distance), so a noisy sensor gets less weight than a steady one. A round
+costs O(sensors), reading the distance costs O(1):
+
+    tracker = distanceTracker()
+    tracker.update([2.01, 1.99, 2.00], time.time())     # after every round, eg. by a rangeSampler
+    tracker.distance, tracker.deviation()               # at any time
+
+Readings outside validRange are ignored, readings further than gate standard deviations from the prediction are
+rejected (echo glitches). When every reading of moveRounds rounds in a row is rejected the surface has moved (a
+fixture or a cart): the tracker restarts at the median of the last round and counts a move, so the controller can
+react without a new blocking scan.
+
+The defaults are for readings in m (Ultrasonic_sim), centimetreTracker() gives one for the cm of the Grove driver.
+'''
+import math
+
+MIN_VALID = 0.02            # m, closer is not a real echo
+MAX_VALID = 4.0             # m, further is the ranger giving up on the echo
+PROCESS_NOISE = 1e-5        # m^2 the variance of the distance grows by per s
+SENSOR_VARIANCE = 1e-4      # m^2, measurement variance a sensor starts with (1 cm standard deviation)
+MIN_VARIANCE = 2.5e-5       # m^2, a sensor is never trusted beyond 5 mm
+VARIANCE_WEIGHT = 0.05      # weight of the latest innovation in the learnt sensor variance
+GATE = 4.0                  # standard deviations from the prediction a reading may be
+MOVE_ROUNDS = 3             # rounds of rejected readings taken as a move of the surface
+
+
+class distanceTracker:
+    def __init__(self, sensors=3, validRange=(MIN_VALID, MAX_VALID), processNoise=PROCESS_NOISE,
+                 sensorVariance=SENSOR_VARIANCE, minVariance=MIN_VARIANCE, gate=GATE, moveRounds=MOVE_ROUNDS):
+        self.validRange = validRange
+        self.processNoise = processNoise
+        self.minVariance = minVariance
+        self.gate = gate
+        self.moveRounds = moveRounds
+        self.distance = None    # tracked distance, None before the first valid reading
+        self.variance = math.inf    # variance of the tracked distance
+        self.sensorVariances = [sensorVariance] * sensors   # learnt measurement variance of each sensor
+        self.updated = None     # time of the last update
+        self.gatedRounds = 0    # rounds in a row with every reading rejected
+        # counters
+        self.rounds = 0
+        self.rejected = 0       # readings rejected by the gate
+        self.moves = 0          # restarts after the surface moved
+
+    def deviation(self):
+        # Standard deviation of the tracked distance
+        return math.sqrt(self.variance)
+
+    def update(self, readings, now):
+        # One round of readings (None for a sensor that gave none) taken at time now (s). Returns the distance
+        valid = [(i, reading) for (i, reading) in enumerate(readings)
+                 if reading is not None and self.validRange[0] <= reading <= self.validRange[1]]
+        if not valid:
+            return self.distance
+        self.rounds += 1
+        if self.distance is None:
+            self.restart(valid, now)
+            return self.distance
+        self.variance += self.processNoise * max(0.0, now - self.updated)
+        self.updated = now
+        accepted = 0
+        for (i, reading) in valid:
+            innovation = reading - self.distance
+            expected = self.variance + self.sensorVariances[i]   # variance of the innovation
+            if innovation * innovation > self.gate * self.gate * expected:
+                self.rejected += 1
+                continue
+            # the innovation variance less the distance's own variance is the sensor's
+            learnt = (1 - VARIANCE_WEIGHT) * self.sensorVariances[i] + VARIANCE_WEIGHT * (innovation * innovation - self.variance)
+            gain = self.variance / expected
+            self.distance += gain * innovation
+            self.variance *= 1 - gain
+            self.sensorVariances[i] = max(self.minVariance, learnt)
+            accepted += 1
+        if accepted:
+            self.gatedRounds = 0
+        else:
+            self.gatedRounds += 1
+            if self.gatedRounds >= self.moveRounds:
+                self.moves += 1
+                print("Distance changed from %.2f to about %.2f" % (self.distance, sorted([reading for (i, reading) in valid])[len(valid) // 2]))
+                self.restart(valid, now)
+        return self.distance
+
+    def restart(self, valid, now):
+        # Starts over at the median of the readings, as uncertain as the sensors that gave them
+        values = sorted([reading for (i, reading) in valid])
+        self.distance = values[len(values) // 2]
+        self.variance = max([self.sensorVariances[i] for (i, reading) in valid])
+        self.updated = now
+        self.gatedRounds = 0
+
+
+def centimetreTracker(**options):
+    # A distanceTracker for readings in cm (GroveUltrasonicRanger.get_distance()), the defaults are in m
+    settings = {"validRange": (100 * MIN_VALID, 100 * MAX_VALID), "processNoise": 1e4 * PROCESS_NOISE,
+                "sensorVariance": 1e4 * SENSOR_VARIANCE, "minVariance": 1e4 * MIN_VARIANCE}
+    settings.update(options)
+    return distanceTracker(**settings)
+
+
+def test_distanceTracker():
+    import random
+    rng = random.Random(2)
+    tracker = distanceTracker()
+    now = 0.0
+    # Sensor 2 is ten times noisier than the others, sensor 0 glitches now and then
+    for i in range(0, 200):
+        now += 0.05
+        readings = [2.0 + rng.gauss(0, 0.005), 2.0 + rng.gauss(0, 0.005), 2.0 + rng.gauss(0, 0.05)]
+        if i % 20 == 7:
+            readings[0] = 3.9
+        tracker.update(readings, now)
+    if abs(tracker.distance - 2.0) > 0.005 or tracker.sensorVariances[2] < 10 * tracker.sensorVariances[0] or tracker.rejected < 10 or tracker.moves:
+        print("Error. Steady distance:", tracker.distance, tracker.sensorVariances, tracker.rejected, tracker.moves)
+        return False
+
+    # A cart is moved under the lamp: the tracker follows within a few rounds
+    for i in range(0, 10):
+        now += 0.05
+        tracker.update([1.2 + rng.gauss(0, 0.005), 1.2 + rng.gauss(0, 0.005), None], now)
+    if tracker.moves != 1 or abs(tracker.distance - 1.2) > 0.01:
+        print("Error. Move not followed:", tracker.distance, tracker.moves)
+        return False
+    if distanceTracker().update([9.0, None, 0.0], 0) is not None:
+        print("Error. Invalid readings used")
+        return False
+    print("distanceTracker OK")
+    return True
+
+
+if __name__ == "__main__":
+    test_distanceTracker()
+
+    # Benchmark: cost of a round and of reading the distance, error against the mean of the last 10 rounds
+    import random
+    import time
+    rng = random.Random(3)
+    rounds = [[2.0 + rng.gauss(0, 0.01) for sensor in range(0, 3)] for i in range(0, 10000)]
+    tracker = distanceTracker()
+    start = time.perf_counter()
+    errors = []
+    for (i, readings) in enumerate(rounds):
+        tracker.update(readings, 0.05 * i)
+        errors.append(abs(tracker.distance - 2.0))
+    updateTime = (time.perf_counter() - start) / len(rounds)
+    start = time.perf_counter()
+    for i in range(0, 100000):
+        distance = tracker.distance
+    readTime = (time.perf_counter() - start) / 100000
+    windowErrors = [abs(sum([sum(readings) for readings in rounds[i - 10:i]]) / 30.0 - 2.0) for i in range(10, len(rounds))]
+    print("update: %.1f us per round of 3 readings, distance: %.3f us per read" % (1e6 * updateTime, 1e6 * readTime))
+    print("mean error: tracker %.2f mm, mean of the last 10 rounds %.2f mm" % (
+        1e3 * sum(errors[100:]) / len(errors[100:]), 1e3 * sum(windowErrors) / len(windowErrors)))
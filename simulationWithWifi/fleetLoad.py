@@ -0,0 +1,291 @@
+'''Load test: a fleet of simulated light modules against one local base station (baseStation.py).
+
+Every module is a complete sim_smartUV (state machine, PIR_sim, Ultrasonic_sim) run by an asyncControl controller
+with its asyncWifi communicator, all of a process sharing one event loop. The modules can be spread over
+several processes, the base station always runs in the main process. Reported:
+    - connect time: from the start of a module until it is CONNECTED,
+    - GET STATE round trip, seen from the base station with 100 requests in flight,
+    - status sweep: GET STATE, GETNAME and CONFIRM STATE of every module (100 modules at a time), one request after
+      the other, then all three in one write with correlation ids (CORRID feature),
+    - status stream: every module asked for --status-rate status records per second (STATUS feature), records
+      received per second and CPU of the main process,
+    - CHANGE STATE to confirmed: CHANGE STATE, then CONFIRM STATE every ms until the module answers STATECHANGED_ON
+      (includes the controller cycle that turns the lamp on),
+    - CHANGE STATE to pushed: the same, but the module pushes STATE_ON by itself (PUSH feature), no polling,
+    - reconnect storm: the base station drops every connection, time until all modules are back and the most
+      connections accepted in any 100 ms,
+    - dead base station: with every lamp on, the base station goes silent (baseStation.freeze), time until each
+      module has noticed (HEARTBEAT) and its lamp is off,
+    - CPU (idle, connected) and RSS per module.
+
+Usage: python3 fleetLoad.py [--modules 1000] [--processes 1] [--requests 2000] [--idle 5] [--status-rate 10]
+'''
+import sys
+import os
+import asyncio
+import bisect
+import contextlib
+import multiprocessing
+import queue
+import resource
+import time
+import baseStation
+import asyncControl
+import latencyStats
+import sim_smartUV
+
+
+def option(name, default):
+    if name in sys.argv:
+        return type(default)(sys.argv[sys.argv.index(name) + 1])
+    return default
+
+def currentRSS():
+    # Resident memory (bytes) of this process
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def cpuTime():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def hostModules(count, host, port, results, stop, idle, frozenAt):
+    # Runs count modules in this event loop, reports to results (a queue) and runs until stop is set.
+    # frozenAt (a shared double) is set to the time.time() the base station went silent
+    rss = currentRSS()
+    start = time.time()
+    modules = [sim_smartUV.sim_smartUV(wifiHost=host, wifiPort=port) for i in range(0, count)]
+    controllers = [asyncControl.asyncController(uv) for uv in modules]
+    tasks = [asyncio.get_running_loop().create_task(controller.main()) for controller in controllers]
+
+    connectTimes = [None] * count
+    waiting = count
+    while waiting:
+        await asyncio.sleep(0.005)
+        for i in range(0, count):
+            if connectTimes[i] is None and modules[i].wifi is not None and modules[i].wifi.lightModuleDict[1].connectionStatus == "CONNECTED":
+                connectTimes[i] = time.time() - start
+                waiting -= 1
+    results.put(("connected", connectTimes, (currentRSS() - rss) / count))
+
+    await asyncio.sleep(0.2)
+    cpu = cpuTime()
+    await asyncio.sleep(idle)
+    results.put(("idle", (cpuTime() - cpu) / idle / count))
+
+    while frozenAt.value == 0:
+        await asyncio.sleep(0.01)
+    lit = [uv.lampON == 1 for uv in modules]   # the lamp timer may already have switched some off
+    detectTimes = [None] * count
+    offTimes = [None] * count
+    waiting = count
+    while waiting and time.time() - frozenAt.value < 30:
+        await asyncio.sleep(0.005)
+        for i in range(0, count):
+            if detectTimes[i] is None and modules[i].wifi.lightModuleDict[1].connectionStatus != "CONNECTED":
+                detectTimes[i] = time.time() - frozenAt.value
+                if not lit[i]:
+                    waiting -= 1
+            if detectTimes[i] is not None and lit[i] and offTimes[i] is None and modules[i].lampON == 0:
+                offTimes[i] = time.time() - frozenAt.value
+                waiting -= 1
+    results.put(("dead", [t for t in detectTimes if t is not None], [t for t in offTimes if t is not None]))
+
+    while not stop.is_set():
+        await asyncio.sleep(0.05)
+    reconnects = sum(uv.wifi.connectionStats()["connects"] - 1 for uv in modules)
+    results.put(("done", reconnects))
+    for task in tasks:
+        task.cancel()
+    for uv in modules:
+        uv.wifi.close()
+    await asyncio.sleep(0.1)
+
+def moduleProcess(count, host, port, results, stop, idle, frozenAt):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        asyncio.run(hostModules(count, host, port, results, stop, idle, frozenAt))
+
+
+async def collect(results, kind, count):
+    # Waits for count reports of the given kind from the module hosts
+    reports = []
+    while len(reports) < count:
+        try:
+            report = results.get_nowait()
+        except queue.Empty:
+            await asyncio.sleep(0.01)
+            continue
+        if report[0] == kind:
+            reports.append(report[1:])
+    return reports
+
+async def commandToConfirmed(station, moduleId, histogram):
+    # Returns the number of CONFIRM STATE requests it took
+    polls = 1
+    station.changeState(moduleId)
+    start = time.perf_counter()
+    while await station.request(moduleId, b"CONFIRM STATE") != b"STATECHANGED_ON":
+        await asyncio.sleep(0.001)
+        polls += 1
+    histogram.addSince(start)
+    station.changeState(moduleId)   # back off for the next round
+    while await station.request(moduleId, b"CONFIRM STATE") != b"STATECHANGED_OFF":
+        await asyncio.sleep(0.001)
+    return polls
+
+async def commandToPushed(station, moduleId, histogram):
+    pushed = station.expectState(moduleId, "ON")
+    station.changeState(moduleId)
+    start = time.perf_counter()
+    await pushed
+    histogram.addSince(start)
+    pushed = station.expectState(moduleId, "OFF")
+    station.changeState(moduleId)   # back off for the next round
+    await pushed
+
+async def switchOn(station, moduleId):
+    pushed = station.expectState(moduleId, "ON")
+    station.changeState(moduleId)
+    await pushed
+
+async def run(modules, processes, requests, idle, statusRate, out):
+    station = await baseStation.baseStation(port=0).start()
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    stop = context.Event()
+    frozenAt = context.Value("d", 0)
+    counts = [modules // processes + (1 if i < modules % processes else 0) for i in range(0, processes)]
+    workers = []
+    if processes == 1:
+        asyncio.get_running_loop().create_task(hostModules(modules, station.host, station.port, results, stop, idle, frozenAt))
+    else:
+        for count in counts:
+            worker = context.Process(target=moduleProcess, args=(count, station.host, station.port, results, stop, idle, frozenAt))
+            worker.start()
+            workers.append(worker)
+
+    reports = await collect(results, "connected", processes)
+    connect = latencyStats.latencyHistogram("connect time")
+    for (connectTimes, rss) in reports:
+        for t in connectTimes:
+            connect.add(t)
+    rss = sum(r[1] * c for (r, c) in zip(reports, counts)) / modules
+
+    stationCpu = cpuTime()
+    reports = await collect(results, "idle", processes)
+    stationCpu = (cpuTime() - stationCpu) / idle
+    idleCpu = sum(r[0] * c for (r, c) in zip(reports, counts)) / modules
+
+    ids = sorted(station.sessions)
+    roundTrip = latencyStats.latencyHistogram("GET STATE round trip")
+    async def getState(moduleId):
+        start = time.perf_counter()
+        await station.request(moduleId, b"GET STATE")
+        roundTrip.addSince(start)
+    for i in range(0, requests, 100):
+        await asyncio.gather(*[getState(ids[(i + j) % len(ids)]) for j in range(0, min(100, requests - i))])
+
+    sweep = [b"GET STATE", b"GETNAME", b"CONFIRM STATE"]
+    oneByOne = latencyStats.latencyHistogram("status sweep, one request at a time")
+    pipelined = latencyStats.latencyHistogram("status sweep, pipelined")
+    async def sweepOneByOne(moduleId):
+        start = time.perf_counter()
+        for command in sweep:
+            await station.request(moduleId, command)
+        oneByOne.addSince(start)
+    async def sweepPipelined(moduleId):
+        start = time.perf_counter()
+        await asyncio.gather(*station.requestMany(moduleId, sweep))
+        pipelined.addSince(start)
+    sweepTimes = []
+    for sweepModule in [sweepOneByOne, sweepPipelined]:
+        start = time.perf_counter()
+        for i in range(0, len(ids), 100):
+            await asyncio.gather(*[sweepModule(moduleId) for moduleId in ids[i:i + 100]])
+        sweepTimes.append(time.perf_counter() - start)
+
+    for moduleId in ids:
+        station.setStatusRate(moduleId, statusRate)
+    await asyncio.sleep(0.5)
+    (records, streamCpu) = (station.statusRecords, cpuTime())
+    await asyncio.sleep(idle)
+    (records, streamCpu) = ((station.statusRecords - records) / idle, (cpuTime() - streamCpu) / idle)
+    for moduleId in ids:
+        station.setStatusRate(moduleId, 0)
+
+    confirmed = latencyStats.latencyHistogram("CHANGE STATE to confirmed")
+    polls = []
+    for i in range(0, min(requests, len(ids)), 50):
+        polls += await asyncio.gather(*[commandToConfirmed(station, moduleId, confirmed) for moduleId in ids[i:i + 50]])
+    pushed = latencyStats.latencyHistogram("CHANGE STATE to pushed")
+    for i in range(0, min(requests, len(ids)), 50):
+        await asyncio.gather(*[commandToPushed(station, moduleId, pushed) for moduleId in ids[i:i + 50]])
+
+    # Reconnect storm: drop every connection at once
+    before = station.connects
+    connects = [(time.time(), before)]
+    for session in list(station.sessions.values()):
+        session.transport.abort()
+    start = time.time()
+    while station.connects - before < modules and time.time() - start < 60:
+        await asyncio.sleep(0.01)
+        connects.append((time.time(), station.connects))
+    stormTime = time.time() - start
+    back = len(station.sessions)
+    times = [t for (t, c) in connects]
+    peak = max(connects[bisect.bisect_right(times, t + 0.1) - 1][1] - c for (t, c) in connects)
+
+    # Dead base station: every lamp on, then the station goes silent without closing the connections
+    while len(station.sessions) < modules:
+        await asyncio.sleep(0.01)
+    ids = sorted(station.sessions)
+    for i in range(0, len(ids), 100):
+        await asyncio.gather(*[switchOn(station, moduleId) for moduleId in ids[i:i + 100]])
+    station.freeze()
+    frozenAt.value = time.time()
+    detect = latencyStats.latencyHistogram("dead base station to detected")
+    off = latencyStats.latencyHistogram("dead base station to lamp off")
+    for (detectTimes, offTimes) in await collect(results, "dead", processes):
+        for t in detectTimes:
+            detect.add(t)
+        for t in offTimes:
+            off.add(t)
+    station.thaw()
+
+    stop.set()
+    reconnects = sum(r[0] for r in await collect(results, "done", processes))
+    for worker in workers:
+        worker.join()
+    station.close()
+
+    print("%d modules in %d process(es)" % (modules, processes), file=out)
+    print(connect.report().splitlines()[0], file=out)
+    print(roundTrip.report().splitlines()[0] + " (100 in flight)", file=out)
+    for (histogram, sweepTime) in zip([oneByOne, pipelined], sweepTimes):
+        print(histogram.report().splitlines()[0] + " (whole fleet in %.2f s)" % sweepTime, file=out)
+    print("status stream: %.0f records/s from %d modules asked for %g/s each (main process %.1f%% CPU)" % (
+        records, len(ids), statusRate, 100 * streamCpu), file=out)
+    print(confirmed.report().splitlines()[0] + " (%.1f CONFIRM STATE per change)" % (sum(polls) / len(polls)), file=out)
+    print(pushed.report().splitlines()[0] + " (no polling)", file=out)
+    print("reconnect storm: %d of %d modules back in %.2f s, at most %d connections in 100 ms, %d reconnects seen by the modules" % (
+        back, modules, stormTime, peak, reconnects), file=out)
+    print(detect.report().splitlines()[0], file=out)
+    print(off.report().splitlines()[0] + " (%d modules still on when it went silent)" % off.count, file=out)
+    print("per module: %.3f%% CPU idle, %.1f kB RSS (main process with the base station: %.2f%% CPU idle)" % (
+        100 * idleCpu, rss / 1024, 100 * stationCpu), file=out)
+
+
+if __name__ == "__main__":
+    modules = option("--modules", 1000)
+    processes = option("--processes", 1)
+    # two sockets per module when everything runs on one machine
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < 2 * modules + 100 and soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, 2 * modules + 100), hard))
+    out = sys.stdout
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        asyncio.run(run(modules, processes, option("--requests", 2000), option("--idle", 5), option("--status-rate", 10.0), out))
@@ -0,0 +1,119 @@
+'''Motion detections of the PIR sensors, passed from the sensor callbacks to the controller.
+
+A motionChannel queues one motionEvent (time, sensor) per detection. post() is called from the sensor callback
+threads, take() hands the controller every event queued since its last take() in one step, so a detection
+arriving while the controller reads is queued for the next take() instead of being cleared with the flag:
+
+    channel = motionChannel()
+    channel.post(1)                 # sensor callback: sensor 1 saw motion
+    if channel.wait(timeout=1):     # controller: blocks until there is an event (or timeout s)
+        events = channel.take()     # [motionEvent(time=..., sensor=1)]
+
+Debounce: a PIR held high by someone standing still fires over and over. A detection of a sensor whose last event
+is still queued and less than holdOff s old is merged into it (counted in debounced). Once the controller has
+taken the events the next detection is always queued, so debouncing never hides motion from the controller.
+
+The times are time.monotonic() (a simClock's time for the simulation, see timeSource). The queue keeps at most
+capacity events, the oldest ones are dropped first (counted in dropped); pending() stays True either way.
+'''
+import collections
+import threading
+import time
+
+HOLD_OFF = 0.5      # s, detections of a sensor this close to its queued event are merged into it
+CAPACITY = 1000     # events kept until the controller takes them
+
+motionEvent = collections.namedtuple("motionEvent", ["time", "sensor"])
+
+
+class motionChannel:
+    def __init__(self, sensors=3, holdOff=HOLD_OFF, capacity=CAPACITY, timeSource=time.monotonic):
+        self.holdOff = holdOff
+        self.timeSource = timeSource
+        self.events = collections.deque()
+        self.capacity = capacity
+        self.queuedAt = [None] * sensors   # time of each sensor's event in the queue, None if it has none
+        self.lastSeen = [None] * sensors   # time of each sensor's last detection
+        self.condition = threading.Condition()
+        # counters
+        self.posted = 0         # events queued
+        self.debounced = 0      # detections merged into a queued event
+        self.dropped = 0        # events dropped because the queue was full
+
+    def post(self, sensor):
+        # Detection by sensor (index), returns the motionEvent queued or None if it was merged into a queued one
+        with self.condition:
+            now = self.timeSource()
+            self.lastSeen[sensor] = now
+            queuedAt = self.queuedAt[sensor]
+            if queuedAt is not None and now - queuedAt < self.holdOff:
+                self.debounced += 1
+                return None
+            event = motionEvent(now, sensor)
+            if len(self.events) >= self.capacity:
+                self.events.popleft()
+                self.dropped += 1
+            self.events.append(event)
+            self.queuedAt[sensor] = now
+            self.posted += 1
+            self.condition.notify_all()
+            return event
+
+    def pending(self):
+        # True if there are events the controller has not taken yet
+        return len(self.events) > 0
+
+    def wait(self, timeout=None):
+        # Blocks until there is an event to take or timeout s have passed, returns pending()
+        with self.condition:
+            return self.condition.wait_for(self.pending, timeout)
+
+    def take(self):
+        # Every queued event, oldest first, the queue is left empty
+        with self.condition:
+            events = list(self.events)
+            self.events.clear()
+            self.queuedAt = [None] * len(self.queuedAt)
+            return events
+
+    def stats(self):
+        return {"posted": self.posted, "debounced": self.debounced, "dropped": self.dropped, "queued": len(self.events)}
+
+
+def test_motionChannel():
+    now = [0.0]
+    channel = motionChannel(holdOff=0.5, capacity=3, timeSource=lambda: now[0])
+    channel.post(0)
+    now[0] = 0.1
+    if channel.post(0) is not None or channel.post(2) is None:
+        print("Error. Repeated detection not merged or other sensor merged")
+        return False
+    now[0] = 0.7
+    channel.post(0)    # holdOff after the queued one: new event
+    if [(event.time, event.sensor) for event in channel.take()] != [(0.0, 0), (0.1, 2), (0.7, 0)] or channel.pending():
+        print("Error. Events taken:", channel.stats())
+        return False
+    now[0] = 0.8
+    if channel.post(0) is None:
+        print("Error. Detection after take() merged into a taken event")
+        return False
+    for sensor in [1, 2, 1]:
+        now[0] += 1
+        channel.post(sensor)
+    if channel.dropped != 1 or [event.sensor for event in channel.take()] != [1, 2, 1]:
+        print("Error. Full queue:", channel.stats())
+        return False
+
+    # wait() returns as soon as another thread posts
+    waiter = threading.Timer(0.05, channel.post, [1])
+    waiter.start()
+    start = time.monotonic()
+    if not channel.wait(timeout=2) or time.monotonic() - start > 1:
+        print("Error. wait() did not wake up")
+        return False
+    print("motionChannel OK")
+    return True
+
+
+if __name__ == "__main__":
+    test_motionChannel()
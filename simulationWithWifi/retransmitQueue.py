@@ -0,0 +1,122 @@
+'''Retransmit queue for the sequence numbered trigger notifications (the SEQ feature, see wireProtocol).
+
+Every trigger event gets its own sequence number and stays in the queue until the base station acknowledges
+that number. Events that are not acknowledged within the retransmission timeout (RTO) are resent and the RTO
+doubles (up to MAX_RTO). The RTO adapts to the connection like TCP's (RFC 6298):
+    SRTT   = 7/8 SRTT + 1/8 RTT
+    RTTVAR = 3/4 RTTVAR + 1/4 |SRTT - RTT|
+    RTO    = SRTT + 4 RTTVAR      (at least MIN_RTO)
+Round trip times are only measured on events acknowledged before any resend (Karn's algorithm), as the ack
+of a resent event could belong to any of its copies.
+
+Usage:
+    queue = retransmitQueue()
+    seq = queue.add(b"MOTIONTRIGGERED", clock.time())   # send it
+    for event in queue.due(clock.time()):               # call regularly, resend what is returned
+        ...
+    queue.ack(seq, clock.time())                        # the base station acknowledged seq
+'''
+import types
+
+INITIAL_RTO = 1.0   # s, the resend period used before the RTO is measured (same as the legacy resend)
+MIN_RTO = 0.2       # s
+MAX_RTO = 4.0       # s, a safety event is never left unsent for longer than this
+
+
+class retransmitQueue:
+    def __init__(self, firstSeq=1):
+        self.nextSeq = firstSeq
+        self.pending = {}           # seq -> event waiting for its ack
+        self.srtt = None            # smoothed round trip time (s), None until the first measurement
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.resends = 0            # number of events resent so far
+        self.acked = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, payload, now):
+        # Queues a new event (payload without its sequence number), returns its sequence number
+        seq = self.nextSeq
+        self.nextSeq += 1
+        self.pending[seq] = types.SimpleNamespace(seq=seq, payload=payload, firstSent=now, due=now + self.rto, retries=0)
+        return seq
+
+    def ack(self, seq, now):
+        # The base station acknowledged seq, returns False for unknown (stale or duplicate) acks
+        event = self.pending.pop(seq, None)
+        if event is None:
+            return False
+        self.acked += 1
+        if event.retries == 0:
+            self.measure(now - event.firstSent)
+        return True
+
+    def measure(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def due(self, now):
+        # Returns the events whose RTO has run out (to be resent), and backs the RTO off for them
+        events = [event for event in self.pending.values() if event.due <= now]
+        if events:
+            self.rto = min(MAX_RTO, self.rto * 2)
+        for event in events:
+            event.retries += 1
+            event.due = now + self.rto
+            self.resends += 1
+        return events
+
+    def deadline(self):
+        # Time of the next resend, None if nothing is waiting for an ack
+        if not self.pending:
+            return None
+        return min(event.due for event in self.pending.values())
+
+
+def test_retransmitQueue():
+    queue = retransmitQueue()
+
+    # Quick acks bring the RTO down from the initial 1s
+    now = 0.0
+    for i in range(0, 20):
+        seq = queue.add(b"MOTIONTRIGGERED", now)
+        now += 0.01
+        if not queue.ack(seq, now) or queue.due(now):
+            print("Error. Event not acknowledged")
+            return False
+    if queue.rto != MIN_RTO:
+        print("Error. RTO did not adapt:", queue.rto)
+        return False
+
+    # A lost event is resent after the RTO, and the RTO backs off
+    seq = queue.add(b"TIMERTRIGGERED", now)
+    if queue.due(now + MIN_RTO / 2):
+        print("Error. Resent too early")
+        return False
+    resent = queue.due(now + MIN_RTO)
+    if [event.seq for event in resent] != [seq] or queue.rto != 2 * MIN_RTO:
+        print("Error. Lost event not resent")
+        return False
+
+    # Selective and stale acks: acking an old number leaves a newer event pending
+    newer = queue.add(b"MOTIONTRIGGERED", now)
+    if not queue.ack(seq, now + 1) or queue.ack(seq, now + 1) or list(queue.pending) != [newer]:
+        print("Error. Stale ack cleared a newer event")
+        return False
+    if queue.rto != 2 * MIN_RTO:
+        print("Error. RTT measured on a resent event")
+        return False
+
+    print("retransmitQueue OK")
+    return True
+
+
+if __name__ == "__main__":
+    test_retransmitQueue()
@@ -27,12 +27,17 @@
 ##  - Timer.TO:         Timeout flag. True when time=0. Reset to False. 
 
 
+import sys
 import selectors
+import threading
 import controlLamp
 from time_track_2 import *
 from Motion_Sensors_test import *
 from Ultrasonic_Test import *
 import multiconnClientClass2
+import simClock
+import asyncControl
+import asyncWifi
 
 """
 # State constants
@@ -69,9 +74,43 @@ GPIO_DIST2      = 12
 sel = selectors.DefaultSelector()
 
 
-class sim_smartUV:
+class GPIO_sim:
+    """ Stands in for RPi.GPIO: keeps the level of the output pins, so the lamp and warning writes do the same
+        work as on the pi (check that the pin is set up, store the level) and their effect can be checked.
+        One per sim_smartUV, several simulated light modules can run in one process.
+    """
+    BCM  = 11
+    OUT  = 0
+    LOW  = 0
+    HIGH = 1
 
     def __init__(self):
+        self.mode = None
+        self.levels = {}        ## output pin -> level
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction):
+        self.levels[pin] = GPIO_sim.LOW
+
+    def output(self, pin, value):
+        if self.mode is None:
+            raise RuntimeError("Please set pin numbering mode using GPIO.setmode(GPIO.BOARD) or GPIO.setmode(GPIO.BCM)")
+        if pin not in self.levels:
+            raise RuntimeError("The GPIO channel has not been set up as an OUTPUT")
+        self.levels[pin] = int(bool(value))
+
+    def input(self, pin):
+        return self.levels[pin]
+
+
+class sim_smartUV:
+
+    # clock:        simClock to run on, real time if None. With a simClock.virtualClock the whole loop runs in simulated time.
+    # wifiOffline:  True to open no sockets, the simulated base station then uses wifi.receive()/wifi.takeMessages()
+    # wifiHost, wifiPort: address of the base station (eg. a local baseStation.py)
+    def __init__(self, clock=None, wifiOffline=False, wifiHost=multiconnClientClass2.BASE_STATION_HOST, wifiPort=multiconnClientClass2.BASE_STATION_PORT):
 
         # Declare parameters
         self.lampON = 0
@@ -83,33 +122,78 @@ class sim_smartUV:
         #Declare wifi parameters
         self.wifiName = "defaultName"
         self.wifi = None
+        self.wifiTimeout = 0    ## longest time (s) checkWifi() may block waiting for the base station (main() does the waiting)
+        self.asyncWifi = False  ## True to use asyncWifi.asyncWifiCommunicator (set by asyncControl, needs a running event loop)
+        self.wifiOffline = wifiOffline
+        self.wifiAddress = (wifiHost, wifiPort)
+        self.clock = clock
+        if self.clock is None:
+            self.clock = simClock.realClock()
+        self.lampLock = threading.Lock()    ## serialises lamp GPIO writes between the control loop and the motion callback
+        self.GPIO = GPIO_sim()              ## simulated lamp and warning pins
+        self.wakeUp = threading.Event()     ## set by the motion sensor to cut main()'s sleep short
 
         self.setup_GPIO()       # Setup GPIO
 
         # Initialize utility classes with respective GPIO pins
-        self.distanceSensor = Ultrasonic_sim(GPIO_DIST0, GPIO_DIST1, GPIO_DIST2)
-        self.motionSensor   = PIR_sim(GPIO_PIR0, GPIO_PIR1, GPIO_PIR2)
-        self.timer          = TimeTrack()
+        self.distanceSensor = Ultrasonic_sim(GPIO_DIST0, GPIO_DIST1, GPIO_DIST2, self.clock, tracking=True)
+        self.motionSensor   = PIR_sim(GPIO_PIR0, GPIO_PIR1, GPIO_PIR2, self.clock)
+        self.timer          = TimeTrack(self.clock)
         self.context        = IDLE
+
+        # Motion turns the lamp off from the sensor callback, without waiting for the next cycle
+        self.motionSensor.setKillSwitch(self.lamp_kill)
     
-    def main(self):
+    def main(self, duration=None):
         """ Main function to loop through when system is not in IDLE state.
+            duration: time (s of self.clock) after which to return, runs forever if None
         """
-        while True:
+        self.motionSensor.setListener(self.wakeUp.set)
+        end = None
+        if duration is not None:
+            end = self.clock.time() + duration
+        while (end is None) or (self.clock.time() < end):
             # self.sim_input()
-            self.pre_cycle()    # Check connection and update information from PyUI
-            
-            if (self.state==IDLE):
-                self.state_IDLE()
-            elif (self.state==INITIAL):
-                self.state_INITIAL()
-            elif (self.state==ACTIVE):
-                self.state_ACTIVE()
+            self.cycle()
+            self.clock.wait(self.wakeUp, self.sleepTime())    # Sleeps 1s, or less if motion is detected
+            self.wakeUp.clear()
+
+        return 0
 
-            self.post_cycle()   # Confirms state and context with PyUI
-            self.print_state()
-            time.sleep(1)
+    def sleepTime(self):
+        """ Time (s) to sleep before the next cycle: 1s, or less if the wifi has a trigger to resend or a connection to retry before then
+        """
+        wait = 1
+        if self.wifi is not None:
+            deadline = self.wifi.deadline()
+            if deadline is not None:
+                wait = max(0, min(wait, deadline - self.wifi.clock.time()))
+        return wait
+
+    def main_async(self):
+        """ Event driven version of main(). Runs a cycle as soon as wifi data, motion or a timer deadline arrives
+            instead of once a second. See asyncControl.py
+        """
+        controller = asyncControl.asyncController(self)
+        controller.run()
+        return 0
 
+    def cycle(self):
+        """ Runs one pass of the state machine.
+        """
+        self.pre_cycle()    # Check connection and update information from PyUI
+        # The rangers are only sampled while the distance is needed
+        self.distanceSensor.setSampling(self.state in (INITIAL, ACTIVE))
+        
+        if (self.state==IDLE):
+            self.state_IDLE()
+        elif (self.state==INITIAL):
+            self.state_INITIAL()
+        elif (self.state==ACTIVE):
+            self.state_ACTIVE()
+
+        self.post_cycle()   # Confirms state and context with PyUI
+        self.print_state()
         return 0
     
     #------------------- Raspberry PI GPIO Functions ----------------------------------#
@@ -118,44 +202,57 @@ class sim_smartUV:
             Ignores the grove library pins, only set up GPIO pins for warnings and UV lamp power control
         """
        
-        ### Set board pin numbering system as BCM  
-        ##GPIO.setmode(GPIO.BCM)
+        # Set board pin numbering system as BCM  
+        self.GPIO.setmode(GPIO_sim.BCM)
 
-        ### Set pin mode for warning and lamps as write
-        ##GPIO.setup(GPIO_warning, GPIO.out)
-        ##GPIO.setup(GPIO_lamp, GPIO.out)
+        # Set pin mode for warning and lamps as write
+        self.GPIO.setup(GPIO_warning, GPIO_sim.OUT)
+        self.GPIO.setup(GPIO_lamp, GPIO_sim.OUT)
 
         print ("Setting up GPIO")
 
         return True
 
     def lamp_turnOn(self):
-        """ Turns lamp on 
+        """ Turns lamp on, unless motion has been detected since the last pre_cycle
         """
-        # GPIO.output(GPIO_lamp, GPIO.HIGH)
+        with self.lampLock:
+            if (self.motionSensor.pending()):
+                print ("Motion detected, lamp stays off")
+                return False
+            self.GPIO.output(GPIO_lamp, GPIO_sim.HIGH)
+            self.lampON = 1
         print ("Turning lamp ON")
-        self.lampON = 1
         return True
 
     def lamp_turnOff(self):
         """ Turns lamp off
         """
-        # GPIO.output(GPIO_lamp, GPIO.LOW)
+        self.GPIO.output(GPIO_lamp, GPIO_sim.LOW)
         print ("Turning lamp off")
         self.lampON = 0
         return True
         
+    def lamp_kill(self):
+        """ Safety fast path, called from the motion sensor callback. Turns lamp and warning off straight away.
+            lampON is left as is so state_IDLE still pauses the timer on the next cycle.
+        """
+        with self.lampLock:
+            self.GPIO.output(GPIO_lamp, GPIO_sim.LOW)
+            self.GPIO.output(GPIO_warning, GPIO_sim.LOW)
+        return True
+
     def warning_turnOn(self):
         """ Turns warning on
         """
-        # GPIO.output(GPIO_warning, GPIO.HIGH)
+        self.GPIO.output(GPIO_warning, GPIO_sim.HIGH)
         print ("Turning warning light on")
         return True
     
     def warning_turnOff(self):
         """ Turns warning off
         """
-        # GPIO.output(GPIO_warning, GPIO.LOW)
+        self.GPIO.output(GPIO_warning, GPIO_sim.LOW)
         print ("Turning warning light off")
         return True
 
@@ -196,12 +293,18 @@ class sim_smartUV:
         """
         State when UV light emitting
         """
+        # Follow the distance while emitting, a moved fixture or cart shows up without a new scan
+        tracked = self.distanceSensor.trackedDistance()
+        if tracked is not None:
+            self.dist = tracked
+
         # check timer 
         self.timer.check()
 
         # Turn on lamp if currently off
         if (self.lampON==0):
-            self.lamp_turnOn()      # Turns lamp off
+            if not self.lamp_turnOn():
+                return 0            # Motion detected, pre_cycle moves to IDLE on the next cycle
             self.warning_turnOn()   # Turns warning off
             self.timer.startTimer()
             self.context = ACTIVE
@@ -227,7 +330,10 @@ class sim_smartUV:
             else:
                 initialStateList = ["OFF", self.wifiName, 0]                
 
-            self.wifi = multiconnClientClass2.wifiCommunicator(sel, initialStateList)
+            if self.asyncWifi:
+                self.wifi = asyncWifi.asyncWifiCommunicator(initialStateList, self.clock, *self.wifiAddress)
+            else:
+                self.wifi = multiconnClientClass2.wifiCommunicator(sel, initialStateList, self.clock, self.wifiOffline, *self.wifiAddress)
             print ("Connected")
             
 
@@ -250,7 +356,7 @@ class sim_smartUV:
         #-------------------------------------------#
 
         # Check connection
-        self.wifi.checkWifi() # This updates the internal memory
+        self.wifi.checkWifi(self.wifiTimeout) # This updates the internal memory
 
         # Fetch updated data from checkwifi()
         (Connection, wifiState, self.wifiName, resetTimer) = self.wifi.getState()
@@ -303,10 +409,11 @@ class sim_smartUV:
             elif self.seeHuman:
                 self.context = HUMAN
 
+        timeLeft = self.timer.timeLeft()  # seconds left on the timer, pushed to the base station
         if self.state == ACTIVE:    
-            self.wifi.confirmState("ON", self.wifiName, None, self.context)
+            self.wifi.confirmState("ON", self.wifiName, timeLeft, self.context, distance=self.dist)
         else:
-            self.wifi.confirmState("OFF", self.wifiName, None, self.context)
+            self.wifi.confirmState("OFF", self.wifiName, timeLeft, self.context, distance=self.dist)
 
         return 0
 
@@ -326,4 +433,7 @@ class sim_smartUV:
 
 if __name__ == "__main__":
     mySmartUV = sim_smartUV()
-    mySmartUV.main()
+    if "--async" in sys.argv:
+        mySmartUV.main_async()
+    else:
+        mySmartUV.main()
@@ -1,10 +1,15 @@
 import time
+import simClock
 
 class TimeTrack:
     
     # Record the start time.
     # The start time is the time at which the lamp is turned on.
-    def __init__(self):
+    # clock is the simClock to read the time from (real time if None).
+    def __init__(self, clock=None):
+        self.clock = clock
+        if self.clock is None:
+            self.clock = simClock.realClock()
         self.active = False
         self.start = 0
         self.count = 0
@@ -18,13 +23,13 @@ class TimeTrack:
 
     def startTimer(self):
         self.active = True 
-        self.start = int(time.time())
+        self.start = int(self.clock.time())
         print ("starting timer")
         return 0
 
     def check(self):
         if (self.active):
-            curr = int (time.time())
+            curr = int (self.clock.time())
             # print ("Current time is: ", curr)
             self.count = self.period - (curr - self.start)
             print ("Current time is: ", self.count)
@@ -40,16 +45,57 @@ class TimeTrack:
         print ("resetting timer")
         return 0
 
+    # Absolute time (s) at which the running timer times out, None when the timer is not running
+    def deadline(self):
+        if (self.active):
+            return self.start + self.period
+        return None
+
     def isSet(self):
         return not (self.period==-1)
 
+    # Seconds left on the timer: the whole period while it is set but not running yet (or paused), -1 when it is not
+    # set. Read from the clock, not from count, which is only updated by check()
+    def timeLeft(self):
+        if not self.isSet():
+            return -1
+        if (self.TO):
+            return 0
+        if (self.active):
+            return max(0, self.period - (int(self.clock.time()) - self.start))
+        return self.period
+
     def pause(self):
         self.active = False
         self.period = self.count
 
 
 
+def test_timeLeft():
+    # A cycle that is starting reports its whole period, not the 0 left in count by the last reset
+    clock = simClock.virtualClock(100.0)
+    timer = TimeTrack(clock)
+    left = [timer.timeLeft()]
+    timer.setPeriod(10)
+    left.append(timer.timeLeft())
+    timer.startTimer()
+    left.append(timer.timeLeft())
+    clock.now += 3
+    left.append(timer.timeLeft())
+    timer.check()
+    timer.pause()
+    left.append(timer.timeLeft())
+    timer.reset()
+    left.append(timer.timeLeft())
+    if left != [-1, 10, 10, 7, 7, -1]:
+        print("Error. Time left on the timer:", left)
+        return False
+    print("timeLeft OK")
+    return True
+
+
 if __name__ == "__main__":
+    test_timeLeft()
 
     myTimer = TimeTrack()
     myTimer.setPeriod(10)
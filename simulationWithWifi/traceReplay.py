@@ -0,0 +1,133 @@
+'''Runs the light module on a recorded sensor trace (see sensorTrace.py and test1_smartUV.py --record).
+
+The PIR detections and ultrasonic readings of the trace are replayed into sim_smartUV's PIR_sim and
+Ultrasonic_sim, and a simulated base station (virtualScenario.simulatedStation) asks for a disinfection every
+--every s. By default the replay runs on a virtualClock, as fast as possible, so hours of room activity take
+seconds; --speed N replays N times faster than real time, --speed 1 in real time. Prints how the control loop
+did: disinfections started, completed and stopped by motion, detections seen.
+
+Usage: python3 traceReplay.py TRACE [--speed N] [--every S] [--verbose]
+       python3 traceReplay.py --generate TRACE [--hours H]     writes a generated trace of room activity
+'''
+import sys
+import os
+import time
+import heapq
+import random
+import contextlib
+import simClock
+import sensorTrace
+import virtualScenario
+from sim_smartUV import *
+
+EVERY = 600             # s between two disinfections asked for by the base station
+RANGER_RATE = 5         # rounds of the three rangers per s in a generated trace (a background sampler)
+VISITS_PER_HOUR = 3     # people coming into the room, in a generated trace
+
+
+def generatedTrace(hours, seed=1):
+    # Time ordered (time, sensor, value) records of a room: rangers reading a surface at 2 m (moved now and
+    # then), people staying 1 to 5 minutes and setting the PIR sensors off every few seconds. Readings in m
+    rng = random.Random(seed)
+    end = hours * 3600.0
+
+    def rangerRecords():
+        distance = 2.0
+        for i in range(0, int(end * RANGER_RATE)):
+            when = i / float(RANGER_RATE)
+            if rng.random() < 1.0 / (RANGER_RATE * 7200):
+                distance = rng.choice([1.5, 2.0, 2.5])     # a cart or a fixture moved
+            for ranger in range(0, sensorTrace.SENSORS):
+                yield (when + 0.002 * ranger, sensorTrace.RANGER + ranger, distance + rng.gauss(0, 0.005))
+
+    def motionRecords():
+        when = rng.expovariate(VISITS_PER_HOUR / 3600.0)
+        while when < end:
+            leave = when + rng.uniform(60, 300)
+            while when < min(leave, end):
+                yield (when, sensorTrace.PIR + rng.randrange(sensorTrace.SENSORS), 1.0)
+                when += rng.uniform(1, 5)
+            when = leave + rng.expovariate(VISITS_PER_HOUR / 3600.0)
+
+    return heapq.merge(rangerRecords(), motionRecords())
+
+
+def traceLength(path):
+    # s from the start of the trace to its last record
+    length = 0.0
+    for record in sensorTrace.readTrace(path):
+        length = record.time
+    return length
+
+
+def replay(path, clock, every=EVERY):
+    log = []
+    uv = sim_smartUV(clock, wifiOffline=True)
+    start = clock.time()
+    station = virtualScenario.simulatedStation(uv, clock, start, log)
+    clock.callAt(start + 0.25, station.poll)
+    clock.callAt(start + 1.5, station.send, b"CONNECTED")
+    def askForDisinfection():
+        station.send(b"CHANGE STATE")
+        clock.callLater(every, askForDisinfection)
+    clock.callAt(start + 3.5, askForDisinfection)
+    player = sensorTrace.traceReplay(sensorTrace.readTrace(path), clock, uv.motionSensor, uv.distanceSensor, start,
+                                     sensorTrace.readHeader(path).unit)
+
+    counts = {"cycles": 0, "started": 0, "completed": 0, "stopped by motion": 0, "detections seen": 0}
+    cycle = uv.cycle
+    def countedCycle():
+        lampBefore = uv.lampON
+        cycle()
+        counts["cycles"] += 1
+        if uv.seeHuman:
+            counts["detections seen"] += len(uv.motionSensor.lastEvents)
+        if lampBefore == 0 and uv.lampON == 1:
+            counts["started"] += 1
+        elif lampBefore == 1 and uv.state == IDLE:
+            if uv.context == TIMER:
+                counts["completed"] += 1
+            elif uv.context == HUMAN:
+                counts["stopped by motion"] += 1
+    uv.cycle = countedCycle
+
+    uv.main(traceLength(path) + 1)
+    counts["merged by the debounce"] = uv.motionSensor.events.debounced
+    return (player, counts)
+
+
+if __name__ == "__main__":
+    if "--generate" in sys.argv:
+        path = sys.argv[sys.argv.index("--generate") + 1]
+        hours = 8.0
+        if "--hours" in sys.argv:
+            hours = float(sys.argv[sys.argv.index("--hours") + 1])
+        sensorTrace.writeTrace(path, generatedTrace(hours), time.time(), sensorTrace.METRE)
+        print("%s: %g h, %d bytes" % (path, hours, os.path.getsize(path)))
+        sys.exit(0)
+
+    path = [arg for (i, arg) in enumerate(sys.argv[1:], 1) if not arg.startswith("--")
+            and sys.argv[i - 1] not in ("--speed", "--every")][0]
+    every = EVERY
+    if "--every" in sys.argv:
+        every = float(sys.argv[sys.argv.index("--every") + 1])
+    if "--speed" in sys.argv:
+        speed = float(sys.argv[sys.argv.index("--speed") + 1])
+        clock = simClock.scaledClock(speed)
+        pace = "%gx" % speed
+    else:
+        clock = simClock.virtualClock()
+        pace = "as fast as possible"
+
+    wallStart = time.time()
+    if "--verbose" in sys.argv:
+        (player, counts) = replay(path, clock, every)
+    else:
+        with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+            (player, counts) = replay(path, clock, every)
+    wall = time.time() - wallStart
+    print("%s: %.2f h of sensor activity, %d readings and %d detections replayed (%d skipped)" % (
+        path, player.lastTime / 3600, player.readings, player.detections, player.skipped))
+    print("replayed %s in %.2f s (%.0fx real time)" % (pace, wall, player.lastTime / max(wall, 1e-9)))
+    for (name, count) in counts.items():
+        print("    %-24s %d" % (name, count))
@@ -0,0 +1,87 @@
+'''Runs a scripted scenario of the light module against a simulated base station.
+
+By default the scenario runs on a simClock.virtualClock and finishes in milliseconds. With --realtime the
+exact same scenario runs on the wall clock, which is how the two modes are compared: both print the same
+timeline of (time, state, context, lamp) changes and the messages sent to the base station.
+
+Usage: python3 virtualScenario.py [--realtime] [--verbose]
+'''
+import sys
+import time
+import contextlib
+import io
+import simClock
+from sim_smartUV import *
+
+# (time (s) from the start, base station message) pairs, motion and distance events are set up in scenario()
+STATION_SCRIPT = [
+    (1.5, b"CONNECTED"),
+    (3.5, b"CHANGE STATE"),     # lamp on, 10s disinfection
+    (12.5, b"CHANGE STATE"),    # back on after the motion at 8.5s
+]
+DURATION = 30
+
+
+class simulatedStation:
+    '''Base station talking to an offline wifiCommunicator. Confirms every trigger it is told about.'''
+    def __init__(self, uv, clock, start, log):
+        self.uv = uv
+        self.clock = clock
+        self.start = start
+        self.log = log
+
+    def send(self, message):
+        self.uv.wifi.receive(1, [message])
+
+    def poll(self):
+        for message in self.uv.wifi.takeMessages(1):
+            self.log.append("%6.1f  station got %s" % (self.clock.time() - self.start, message.decode()))
+            if message.endswith(b"TRIGGERED"):
+                self.send(b"TRIGGEROFFCONFIRMED")
+        self.clock.callLater(0.5, self.poll)
+
+
+def scenario(clock):
+    log = []
+    uv = sim_smartUV(clock, wifiOffline=True)
+    start = clock.time()
+    station = simulatedStation(uv, clock, start, log)
+
+    for (when, message) in STATION_SCRIPT:
+        clock.callAt(start + when, station.send, message)
+    clock.callAt(start + 0.25, station.poll)
+    uv.motionSensor.motionAt(start + 8.5)
+
+    # Record every change of (state, context, lamp) after a cycle
+    cycle = uv.cycle
+    last = [None]
+    def loggedCycle():
+        cycle()
+        now = (uv.state, uv.context, uv.lampON)
+        if now != last[0]:
+            log.append("%6.1f  %-8s %-8s lamp=%d" % (clock.time() - start, uv.state, uv.context, uv.lampON))
+            last[0] = now
+    uv.cycle = loggedCycle
+
+    uv.main(DURATION)
+    return log
+
+
+if __name__ == "__main__":
+    if "--realtime" in sys.argv:
+        clock = simClock.realClock()
+        time.sleep(1.01 - (time.time() % 1))   # start just after a whole second, like the virtual clock
+    else:
+        clock = simClock.virtualClock()
+
+    output = io.StringIO()
+    wallStart = time.time()
+    if "--verbose" in sys.argv:
+        log = scenario(clock)
+    else:
+        with contextlib.redirect_stdout(output):
+            log = scenario(clock)
+    wallTime = time.time() - wallStart
+
+    print("\n".join(log))
+    print("%d s of light module time took %.3f s" % (DURATION, wallTime))
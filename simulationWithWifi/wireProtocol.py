@@ -0,0 +1,358 @@
+'''Wire protocol between the light module and the base station.
+
+Two encodings are spoken on the same TCP stream:
+    - legacy: text messages each preceded by ";" (eg. b";STATEIS_ON"). This is what old base stations use.
+              A legacy message only ends where the next one starts, so streamParser holds the last one of a
+              read until more bytes arrive or it has waited LEGACY_HOLD s (see streamParser.expired).
+    - framed: a HEADER (payload length, message type) followed by the payload. A message split across
+              TCP segments or several messages in one segment are reassembled by streamParser.
+
+Negotiation (always done in legacy messages, so old base stations keep working):
+    1. base station -> module:  ;CONNECTED
+    2. module -> base station:  ;HELLO_<feature>,<feature>,...     (features the module supports)
+    3. base station -> module:  ;HELLOACK_<feature>,...;           (features both sides will use)
+       A station that does not know HELLO ignores it and everything stays legacy.
+    4. If FRAMED was accepted, every byte the station sends after the ";" ending HELLOACK is framed.
+       The module answers with ;FRAMESTART; and every byte it sends after that is framed.
+
+Features:
+    FRAMED  the framed encoding above.
+    SEQ     trigger notifications carry a sequence number (MOTIONTRIGGERED_<seq>, TIMERTRIGGERED_<seq>) and the
+            base station acknowledges them by number (TRIGGEROFFCONFIRMED_<seq>,<seq>,...). Unacknowledged
+            triggers are resent with an adaptive timeout, see retransmitQueue. Without SEQ the module resends
+            every second until a bare TRIGGEROFFCONFIRMED arrives.
+    HEARTBEAT
+            a module that has heard nothing from the base station for a while sends PING, the station answers
+            PONG (either side may ping, the other answers). A connection that stays silent is taken as dead
+            well before TCP would notice.
+    PUSH    the module reports its own changes instead of waiting to be polled: STATE_<ON|OFF> when the light
+            changes state, NAME_<name> when its name changes and TIMER_<s> when the seconds left on its timer
+            change (-1: no timer). The current values are pushed once right after the HELLOACK. GET STATE,
+            CONFIRM STATE and GETNAME keep working.
+    CORRID  (with FRAMED) a command may end with a correlation id, @<digits> (eg. GET STATE@17), and every reply
+            to it ends with the same id (STATEIS_ON@17). The station can then have any number of requests in
+            flight to one module, even several of the same command, and send them all in one write. Messages the
+            module sends by itself (triggers, pushes, PING) carry no id. The id is taken from the last "@", so a
+            name sent in CHANGENAME_ may contain "@" as long as the command is tagged.
+    STATUS  (with FRAMED) the module streams its status as MSG_STATUS frames holding one fixed layout
+            STATUS_RECORD, a station reads it with one struct.unpack_from (decodeStatus) instead of parsing
+            STATEIS_, NAMEIS_ and trigger messages. STATUSRATE_<records per second> starts, changes or (0) stops
+            the stream, the module's statusRate is used until then. Rates above MAX_STATUS_RATE are cut down to
+            it, a rate that is not a finite number is ignored.
+'''
+import struct
+import collections
+
+HEADER = struct.Struct("!HB")   # payload length, message type
+MAX_PAYLOAD = 0xFFFF
+LEGACY_HOLD = 0.05  # s an unterminated legacy message waits for the rest of its bytes before it is taken as complete
+
+# Message types of the framed encoding
+MSG_TEXT = 1    # same text as a legacy message, without the ";"
+MSG_STATUS = 2  # a STATUS_RECORD (STATUS feature)
+
+# Status record (STATUS feature): sequence number, state, context, trigger flags, seconds left on the timer (-1: none),
+# last distance measured (cm, NaN if none yet). 13 bytes, 16 with the frame header
+STATUS_RECORD = struct.Struct("!IBBBhf")
+statusRecord = collections.namedtuple("statusRecord", ["seq", "state", "context", "flags", "timer", "distance"])
+STATES = ["OFF", "ON"]                              # state codes, index = code
+CONTEXTS = ["IDLE", "ACTIVE", "MOTION", "TIMER"]    # context codes, index = code
+UNKNOWN_CODE = 255                                  # state or context not in the lists above
+FLAG_TRIGGERED_MOTION = 1   # the light was triggered off by motion, not yet confirmed by the station
+FLAG_TRIGGERED_TIMER = 2    # the light was triggered off by its timer, not yet confirmed by the station
+FLAG_MOTION = 4             # motion is being seen
+STATUS_RATE = b"STATUSRATE_"
+MAX_STATUS_RATE = 10.0      # status records per second a module sends at most
+
+# Negotiation messages
+HELLO = b"HELLO_"
+HELLOACK = b"HELLOACK_"
+FRAME_START = b"FRAMESTART"
+FRAME_START_MESSAGE = b";" + FRAME_START + b";"   # sent as is, the ";" after it ends the legacy part
+
+# Heartbeat messages (HEARTBEAT feature)
+PING = b"PING"
+PONG = b"PONG"
+
+# Change notifications (PUSH feature)
+PUSH_STATE = b"STATE_"
+PUSH_NAME = b"NAME_"
+PUSH_TIMER = b"TIMER_"
+
+# Correlation ids (CORRID feature)
+CORRELATION_SEPARATOR = b"@"
+
+# Features
+FEATURE_FRAMED = "FRAMED"
+FEATURE_SEQ = "SEQ"
+FEATURE_HEARTBEAT = "HEARTBEAT"
+FEATURE_PUSH = "PUSH"
+FEATURE_CORRID = "CORRID"
+FEATURE_STATUS = "STATUS"
+SUPPORTED_FEATURES = [FEATURE_FRAMED, FEATURE_SEQ, FEATURE_HEARTBEAT, FEATURE_PUSH, FEATURE_CORRID, FEATURE_STATUS]
+# Only used together with FRAMED: status records only come in frames, and a legacy message cannot tell a correlation
+# id split across two reads (GET STATE@1|7) from a whole one, so it could never be handed over without LEGACY_HOLD
+FRAMED_ONLY = [FEATURE_CORRID, FEATURE_STATUS]
+
+
+def encodeLegacy(payload):
+    return b";" + payload
+
+def encodeFrame(payload, msgType=MSG_TEXT):
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError("payload of %d bytes does not fit in a frame" % len(payload))
+    return HEADER.pack(len(payload), msgType) + payload
+
+class cannedReply:
+    '''A message that never changes, encoded once for both encodings. Replies of the same kind
+    supersede each other in the outbox (see outbox.append), None for replies that must all be sent.'''
+    def __init__(self, payload, kind=None):
+        self.payload = payload
+        self.kind = kind
+        self.legacy = encodeLegacy(payload)
+        self.framed = encodeFrame(payload)
+
+def helloMessage(features):
+    return HELLO + ",".join(features).encode('utf-8')
+
+def helloAckMessage(features):
+    return HELLOACK + ",".join(features).encode('utf-8')
+
+def parseFeatures(message):
+    # Feature list of a HELLO_ or HELLOACK_ message
+    features = message.split(b"_", 1)[1].decode('utf-8', 'replace')
+    return set(f for f in features.split(",") if f)
+
+def usableFeatures(features):
+    # The negotiated features without those that need FRAMED when it was not accepted (see FRAMED_ONLY)
+    if FEATURE_FRAMED in features:
+        return set(features)
+    return set(features) - set(FRAMED_ONLY)
+
+def parseSeqList(argument):
+    # Sequence numbers of a TRIGGEROFFCONFIRMED_<seq>,<seq>,... ack, numbers that do not parse are skipped
+    seqs = []
+    for seq in argument.split(b","):
+        try:
+            seqs.append(int(seq))
+        except ValueError:
+            pass
+    return seqs
+
+def splitCorrelation(message):
+    # Returns [message without its correlation id, the id (bytes)], or [message, None] if it has none
+    (head, separator, correlation) = message.rpartition(CORRELATION_SEPARATOR)
+    if separator and correlation.isdigit():
+        return [head, correlation]
+    return [message, None]
+
+def withCorrelation(payload, correlation):
+    return payload + CORRELATION_SEPARATOR + correlation
+
+def statusCode(value, names):
+    if value in names:
+        return names.index(value)
+    return UNKNOWN_CODE
+
+def encodeStatus(seq, state, context, flags, timer, distance):
+    # MSG_STATUS frame of a status record, state and context by name (see STATES and CONTEXTS), distance None if unknown
+    if distance is None:
+        distance = float("nan")
+    record = STATUS_RECORD.pack(seq & 0xFFFFFFFF, statusCode(state, STATES), statusCode(context, CONTEXTS), flags,
+                                max(-1, min(0x7FFF, int(timer))), distance)
+    return encodeFrame(record, MSG_STATUS)
+
+def decodeStatus(payload, offset=0):
+    # statusRecord of a MSG_STATUS payload (state and context as codes)
+    return statusRecord._make(STATUS_RECORD.unpack_from(payload, offset))
+
+def isFrameSwitch(token):
+    # True for the legacy messages after which the sender only sends frames
+    if token == FRAME_START:
+        return True
+    return token.startswith(HELLOACK) and FEATURE_FRAMED in parseFeatures(token)
+
+
+class streamParser:
+    '''Incremental parser for one connection. Starts in legacy mode and switches to frames after
+    a frame switch message (see isFrameSwitch). feed() takes the bytes as they come off the socket
+    and returns the complete messages as (message type, payload) pairs.
+
+    A legacy message is complete once the ";" of the next one arrives. The last one of a chunk is held in tail
+    until then, as it may continue in the next TCP segment; expired() hands it over once it has waited hold s
+    without more bytes arriving (deadline() tells when), or straight away if complete(message) is True (eg. a
+    command no other command starts with). The frame switch messages are always followed by a ";", so the
+    switch is found however the stream is split.'''
+    def __init__(self, hold=LEGACY_HOLD, complete=None):
+        self.framed = False
+        self.buffer = bytearray()   # incomplete frame waiting for the rest of its bytes
+        self.delimiterPending = False   # the ";" ending the frame switch message has not been read yet
+        self.hold = hold
+        self.tail = b""             # legacy message not known to be complete yet
+        self.tailSince = 0.0        # time the last bytes of tail arrived
+        self.complete = complete    # complete(message) is True for a legacy message known to be whole, None for none
+
+    def feed(self, chunk, now=0.0):
+        # now: time the chunk arrived (s, on the clock later passed to expired())
+        messages = []
+        if not self.framed:
+            tokens = (self.tail + chunk).split(b";")
+            self.tail = tokens.pop()    # runs to the end of the chunk, it may not be complete
+            self.tailSince = now
+            chunk = b""
+            for i in range(0, len(tokens)):
+                if tokens[i]:
+                    messages.append((MSG_TEXT, bytes(tokens[i])))
+                if isFrameSwitch(tokens[i]):
+                    self.framed = True
+                    chunk = b";".join(tokens[i + 1:] + [self.tail])   # the rest of the chunk is already framed
+                    self.tail = b""
+                    break
+            if self.tail and self.complete is not None and self.complete(self.tail):
+                messages.append((MSG_TEXT, bytes(self.tail)))
+                self.tail = b""
+        if self.framed:
+            if self.delimiterPending and chunk:
+                if chunk[0:1] == b";":
+                    chunk = chunk[1:]
+                self.delimiterPending = False
+            self.buffer += chunk
+            offset = 0
+            while len(self.buffer) - offset >= HEADER.size:
+                (length, msgType) = HEADER.unpack_from(self.buffer, offset)
+                end = offset + HEADER.size + length
+                if end > len(self.buffer):
+                    break   # wait for the rest of the frame
+                messages.append((msgType, bytes(self.buffer[offset + HEADER.size:end])))
+                offset = end
+            del self.buffer[:offset]
+        return messages
+
+    def expired(self, now):
+        # The held legacy message as a list of one (message type, payload) pair, once nothing has been added to it
+        # for hold s (it was complete after all), [] otherwise
+        if self.framed or not self.tail or now - self.tailSince < self.hold:
+            return []
+        message = bytes(self.tail)
+        self.tail = b""
+        if isFrameSwitch(message):
+            self.framed = True
+            self.delimiterPending = True    # its ";" is still on the way
+        return [(MSG_TEXT, message)]
+
+    def deadline(self):
+        # Time the held legacy message expires, None if there is none
+        if self.framed or not self.tail:
+            return None
+        return self.tailSince + self.hold
+
+
+def test_streamParser():
+    stream = b";CONNECTED;HELLOACK_FRAMED;" + encodeFrame(b"GET STATE") + encodeFrame(b"CHANGENAME_lamp;2") + encodeFrame(b"GETNAME")
+    expected = [b"CONNECTED", b"HELLOACK_FRAMED", b"GET STATE", b"CHANGENAME_lamp;2", b"GETNAME"]
+
+    # Feed the stream in pieces of every size, the result must always be the same
+    for size in range(1, len(stream) + 1):
+        parser = streamParser()
+        messages = []
+        for i in range(0, len(stream), size):
+            messages += parser.feed(stream[i:i + size])
+        if [payload for (msgType, payload) in messages] != expected:
+            print("Error. Piece size %d gave %s" % (size, messages))
+            return False
+
+    # Split in two at every offset, the second piece coming within the hold: nothing is taken as complete early.
+    # Cut right after HELLOACK_FRAMED with its ";" late, the held HELLOACK expires and still switches to frames
+    for cut in range(0, len(stream) + 1):
+        parser = streamParser()
+        messages = parser.feed(stream[0:cut], now=0.0) + parser.expired(LEGACY_HOLD / 2)
+        if cut == 26:
+            messages += parser.expired(LEGACY_HOLD)
+        messages += parser.feed(stream[cut:], now=LEGACY_HOLD)
+        if [payload for (msgType, payload) in messages] != expected or not parser.framed:
+            print("Error. Cut at %d gave %s" % (cut, messages))
+            return False
+
+    # Old base station: no HELLOACK, stays legacy. A command split across reads is put back together, the last
+    # one is held until the hold is over
+    legacy = b";CONNECTED;CHANGENAME_lamp 2;GET STATE"
+    for cut in range(0, len(legacy) + 1):
+        parser = streamParser()
+        messages = parser.feed(legacy[0:cut], now=0.0) + parser.feed(legacy[cut:], now=0.01)
+        if parser.deadline() != 0.01 + LEGACY_HOLD or parser.expired(0.02) != []:
+            print("Error. Legacy message not held:", parser.tail)
+            return False
+        messages += parser.expired(0.01 + LEGACY_HOLD)
+        if messages != [(MSG_TEXT, b"CONNECTED"), (MSG_TEXT, b"CHANGENAME_lamp 2"), (MSG_TEXT, b"GET STATE")] or parser.framed:
+            print("Error. Legacy stream cut at %d gave %s" % (cut, messages))
+            return False
+
+    # A message known to be whole is not held, the start of one is
+    parser = streamParser(complete=lambda message: message in (b"GET STATE", b"CONNECTED"))
+    if parser.feed(b";CONNECTED;GET STATE") != [(MSG_TEXT, b"CONNECTED"), (MSG_TEXT, b"GET STATE")] or parser.feed(b";GET") != [] \
+            or parser.feed(b" STATE") != [(MSG_TEXT, b"GET STATE")] or parser.deadline() is not None:
+        print("Error. Whole legacy message held:", parser.tail)
+        return False
+
+    print("streamParser OK")
+    return True
+
+
+def test_statusRecord():
+    frame = encodeStatus(7, "ON", "ACTIVE", FLAG_MOTION, 42, 123.5)
+    parser = streamParser()
+    parser.framed = True
+    messages = parser.feed(frame[0:5]) + parser.feed(frame[5:])
+    if len(frame) != HEADER.size + STATUS_RECORD.size or [msgType for (msgType, payload) in messages] != [MSG_STATUS]:
+        print("Error. Status frame not parsed:", messages)
+        return False
+    record = decodeStatus(messages[0][1])
+    if record != (7, 1, CONTEXTS.index("ACTIVE"), FLAG_MOTION, 42, 123.5):
+        print("Error. Status record changed:", record)
+        return False
+    record = decodeStatus(encodeStatus(1, "OFF", "?", 0, -1, None)[HEADER.size:])
+    if record.context != UNKNOWN_CODE or record.timer != -1 or record.distance == record.distance:
+        print("Error. Unknown values not kept:", record)
+        return False
+    print("statusRecord OK")
+    return True
+
+
+def test_usableFeatures():
+    # Without FRAMED a legacy command cannot carry a correlation id (it could not be handed over before LEGACY_HOLD)
+    if usableFeatures([FEATURE_SEQ, FEATURE_CORRID, FEATURE_STATUS]) != {FEATURE_SEQ}:
+        print("Error. Frame only features kept without FRAMED")
+        return False
+    if usableFeatures(SUPPORTED_FEATURES) != set(SUPPORTED_FEATURES):
+        print("Error. Features dropped with FRAMED")
+        return False
+    print("usableFeatures OK")
+    return True
+
+
+if __name__ == "__main__":
+    test_streamParser()
+    test_statusRecord()
+    test_usableFeatures()
+
+    # Benchmark: what a station does to take in 100000 status updates, as records or as the text messages
+    import time
+    count = 100000
+    frames = encodeStatus(1, "ON", "ACTIVE", 0, 42, 123.5) * count
+    texts = b"".join(encodeFrame(payload) for payload in [b"STATEIS_ON", b"NAMEIS_lamp", b"TIMER_42"]) * count
+    for (name, stream) in [("status records", frames), ("text messages", texts)]:
+        parser = streamParser()
+        parser.framed = True
+        start = time.perf_counter()
+        state = {}
+        for offset in range(0, len(stream), 65536):
+            for (msgType, payload) in parser.feed(stream[offset:offset + 65536]):
+                if msgType == MSG_STATUS:
+                    record = STATUS_RECORD.unpack_from(payload)
+                    state["state"] = record[1]
+                    state["timer"] = record[4]
+                else:
+                    (key, separator, value) = payload.partition(b"_")
+                    state[key] = value.decode('utf-8')
+        elapsed = time.perf_counter() - start
+        print("%-14s: %7d bytes per update, %.0f updates/s" % (name, len(stream) // count, count / elapsed))